@@ -0,0 +1,433 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import ScanPath # Lane polygons of the 2D scans
+import ScanStorage # Memory-mapped scan files
+from ScanCatalog import scanCatalog # Index of the saved scans
+# Offline analysis of saved scans (1D step/fly/adaptive lines and 2D raster cubes).
+#
+# The spectra are streamed from the memory-mapped scan file in chunks, so a scan never has to fit into
+# memory. Each spectrum gets its baseline removed (a rolling low percentile along the wavelengths, without
+# an offset) and is integrated over the emission window of the scan into one band signal per point; the
+# bands are then detected along the scan axis by their prominence above the noise and fitted with
+# Gaussians. For 2D scans, the band signal is averaged over each lane into a lane profile.
+#
+#   python Analysis.py measurements/gel1.gscan                    # analyze one scan
+#   python Analysis.py --catalog ./measurements --since-days 1    # reprocess the last day on all cores
+#
+# The results are written next to each scan as <name>-analysis.json.
+
+
+def remove_baseline(intensities, window=401, percentile=10):
+    """
+    Removes the slowly varying baseline of spectra: a rolling low percentile along the wavelengths (evaluated
+    every quarter window and interpolated in between), then the residual floor (the median of what is left),
+    so that the noise between the peaks averages to zero. Peaks narrower than most of the window are kept.
+
+    Args:
+    intensities (array): The spectra, one per row (or a single spectrum).
+    window (int): The width of the filter in pixels, wider than the spectral peaks (default is 401).
+    percentile (float): The percentile of each window taken as the baseline (default is 10).
+
+    Returns:
+    array: The spectra with the baseline subtracted, with the shape of intensities.
+    """
+    data = np.asarray(intensities, dtype=float)
+    rows = np.atleast_2d(data)
+    pixels = rows.shape[1]
+    window = min(int(window), pixels) | 1 # odd, and not wider than the spectra
+    half = window // 2
+    knots = np.unique(np.append(np.arange(0, pixels, max(window // 4, 1)), pixels - 1)) # the pixels the filter is evaluated at
+    windows = sliding_window_view(np.pad(rows, ((0, 0), (half, half)), mode='reflect'), window, axis=1)[:, knots]
+    levels = np.percentile(windows, percentile, axis=2)
+    if len(knots) > 1: # linear interpolation between the knots, for all the spectra at once
+        segment = np.clip(np.searchsorted(knots, np.arange(pixels), side='right') - 1, 0, len(knots) - 2)
+        weight = (np.arange(pixels) - knots[segment]) / (knots[segment + 1] - knots[segment])
+        baseline = levels[:, segment] * (1 - weight) + levels[:, segment + 1] * weight
+    else:
+        baseline = levels
+    residual = rows - baseline
+    residual -= np.median(residual, axis=1, keepdims=True) # the percentile lies below the noise, the median of the rest does not
+    return residual.reshape(data.shape)
+
+
+def _moving_average(rows, width):
+    """
+    Returns the moving average of each row over width pixels (odd), reflected at the edges.
+    """
+    half = width // 2
+    sums = np.cumsum(np.pad(rows, ((0, 0), (half + 1, half)), mode='reflect'), axis=1)
+    return (sums[:, width:] - sums[:, :-width]) / width
+
+
+def _written(scan, channel):
+    """
+    Returns the written flags of the points of a channel (the main ones for scan files without flags per channel).
+    """
+    name = ScanStorage.channel_name('written', channel)
+    return scan[name] if name in scan else scan['written']
+
+
+def iter_chunks(scan, chunk=256, channel=0):
+    """
+    Streams the written spectra of a scan in chunks.
+
+    Args:
+    scan (scanStorage): The scan file.
+    chunk (int): The number of grid points per chunk (default is 256).
+    channel (int): The spectrometer channel (default is 0, the main one).
+
+    Yields:
+    tuple: The flat grid indices of the written points of the chunk and their spectra (points, wavelengths).
+    """
+    written = _written(scan, channel).reshape(-1)
+    intensities = scan[ScanStorage.channel_name('intensities', channel)]
+    intensities = intensities.reshape(len(written), intensities.shape[-1]) # a view of the memory map, for 1D and 2D scans
+    for start in range(0, len(written), chunk):
+        rows = np.flatnonzero(written[start:start + chunk]) + start
+        if len(rows):
+            yield rows, intensities[rows] # only these rows are read from the disk
+
+
+def emission_window(scan, window=401, snr=6, chunk=256, channel=0):
+    """
+    Finds the pixels where the scan has emission: where the baseline-free spectrum of any point, smoothed
+    along the wavelengths, rises above snr times its noise. Integrating only these pixels keeps the noise
+    of the pixels without emission out of the band signal.
+
+    Args:
+    scan (scanStorage): The scan file.
+    window (int): The width of the baseline filter in pixels (default is 401); the spectra are smoothed over an eighth of it.
+    snr (float): The smallest smoothed signal, in multiples of its noise (default is 6).
+    chunk (int): The number of points processed at a time (default is 256).
+    channel (int): The spectrometer channel (default is 0, the main one).
+
+    Returns:
+    array: The boolean mask of the pixels (all of them if no emission is found).
+    """
+    width = max(window // 8, 1) | 1
+    top, noise = None, []
+    for rows, spectra in iter_chunks(scan, chunk, channel):
+        smoothed = _moving_average(remove_baseline(spectra, window), width)
+        noise.append(np.median(np.abs(smoothed), axis=1) / 0.6745) # the spread about zero (MAD) of each spectrum
+        top = smoothed.max(axis=0) if top is None else np.maximum(top, smoothed.max(axis=0))
+    if top is None:
+        return np.ones(scan[ScanStorage.channel_name('wavelengths', channel)].shape, dtype=bool)
+    mask = top > snr * np.median(np.concatenate(noise))
+    mask = np.convolve(mask, np.ones(2 * width + 1), mode='same') > 0 # and the tails of the peaks around it
+    return mask if mask.any() else np.ones(len(mask), dtype=bool)
+
+
+def band_signal(scan, window=401, wavelength_range=None, chunk=256, channel=0):
+    """
+    Returns the band signal of every point of a scan: its baseline-free spectrum integrated over a wavelength range.
+
+    Args:
+    scan (scanStorage): The scan file.
+    window (int): The width of the baseline filter in pixels (default is 401).
+    wavelength_range (tuple): The (min, max) wavelengths in nm to integrate (default is None, the emission window of the scan).
+    chunk (int): The number of points processed at a time (default is 256).
+    channel (int): The spectrometer channel (default is 0, the main one).
+
+    Returns:
+    array: The band signal with the grid shape of the scan (NaN where nothing was measured).
+    """
+    if wavelength_range is not None:
+        wavelengths = scan[ScanStorage.channel_name('wavelengths', channel)]
+        pixels = slice(int(np.searchsorted(wavelengths, wavelength_range[0])),
+                       int(np.searchsorted(wavelengths, wavelength_range[1], side='right')))
+    else:
+        pixels = emission_window(scan, window, chunk=chunk, channel=channel)
+    signal = np.full(scan['written'].size, np.nan)
+    for rows, spectra in iter_chunks(scan, chunk, channel):
+        signal[rows] = remove_baseline(spectra, window)[:, pixels].sum(axis=1)
+    return signal.reshape(scan['written'].shape)
+
+
+def fit_peak(x, y):
+    """
+    Fits a Gaussian to a peak with the closed-form weighted log-parabola fit (no iterations).
+
+    Args:
+    x, y (array): The points of the peak (y > 0 near the top).
+
+    Returns:
+    dict: The 'center', 'fwhm', 'height' and 'area' of the Gaussian, or None if the points are not peak-shaped.
+    """
+    keep = y > 0
+    if np.count_nonzero(keep) < 3:
+        return None
+    x, y = x[keep], y[keep]
+    c, b, a = np.polyfit(x, np.log(y), 2, w=y) # ln y = a + b x + c x^2, weighted towards the top
+    if c >= 0:
+        return None
+    sigma = np.sqrt(-1 / (2 * c))
+    center = -b / (2 * c)
+    height = np.exp(a - b**2 / (4 * c))
+    return {'center': float(center), 'fwhm': float(2.3548 * sigma), 'height': float(height),
+            'area': float(height * sigma * np.sqrt(2 * np.pi))}
+
+
+def _prominence(y, peak):
+    """
+    Returns how far a maximum of a profile rises above the higher of the lowest points between it and a higher
+    point (or the end of the profile) on either side.
+    """
+    lows = []
+    for step in (-1, 1):
+        k, low = peak, y[peak]
+        while 0 <= k + step < len(y) and y[k + step] <= y[peak]:
+            k += step
+            low = min(low, y[k])
+        lows.append(low)
+    return y[peak] - max(lows)
+
+
+def profile_noise(signal, clip=3):
+    """
+    Estimates the noise of a profile from the differences of neighbouring points: their median absolute
+    deviation, then their standard deviation without the steep flanks of the bands (sigma clipping).
+
+    Args:
+    signal (array): The profile, ordered by position.
+    clip (float): The differences further than clip standard deviations from their median are left out (default is 3).
+
+    Returns:
+    float: The standard deviation of the noise of one point.
+    """
+    differences = np.diff(np.asarray(signal, dtype=float))
+    if len(differences) == 0:
+        return 0.0
+    deviations = np.abs(differences - np.median(differences))
+    sigma = np.median(deviations) / 0.6745
+    for _ in range(5):
+        kept = differences[deviations <= clip * sigma]
+        if len(kept) < 2 or kept.std() == sigma:
+            break
+        sigma = kept.std()
+    return float(sigma / np.sqrt(2)) # the difference of two points has twice the variance of one
+
+
+def detect_bands(positions, signal, threshold=0.05, min_separation=None, snr=5):
+    """
+    Detects the bands along a profile and fits each of them with a Gaussian.
+
+    A maximum is a band if its prominence (how far it rises above the profile between it and the next higher
+    maximum) is at least threshold times the highest point and snr times the noise of the profile, so that
+    neither the noise nor the shoulders of a band count as bands.
+
+    Args:
+    positions (array): The positions of the profile, in any order (e.g. the non-uniform grid of an adaptive scan).
+    signal (array): The band signal at each position (NaN points are ignored).
+    threshold (float): The smallest prominence as a fraction of the highest point, above the median background (default is 0.05).
+    min_separation (float): Of two maxima closer than this, only the higher one is a band (default is None, keep all).
+    snr (float): The smallest prominence in multiples of the noise of the profile, see profile_noise (default is 5).
+
+    Returns:
+    list: The bands as dicts with 'position' (fitted center), 'fwhm', 'height', 'area' and 'index' (of the maximum in the sorted profile),
+          highest first.
+    """
+    positions = np.asarray(positions, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    valid = ~np.isnan(signal)
+    order = np.argsort(positions[valid])
+    x, y = positions[valid][order], signal[valid][order]
+    if len(y) < 3:
+        return []
+    y = y - np.median(y) # the background between the bands
+    top = y.max()
+    if top <= 0:
+        return []
+    maxima = np.flatnonzero((y[1:-1] > y[:-2]) & (y[1:-1] >= y[2:])) + 1
+    smallest = max(threshold * top, snr * profile_noise(y))
+    maxima = np.array([peak for peak in maxima if _prominence(y, peak) >= smallest], dtype=int)
+    maxima = maxima[np.argsort(y[maxima])[::-1]] # highest first
+    bands = []
+    for peak in maxima:
+        if min_separation is not None and any(abs(x[peak] - x[band['index']]) < min_separation for band in bands):
+            continue
+        # the points of the peak above half its height, on both sides of the maximum
+        half = y[peak] / 2
+        left = peak
+        while left > 0 and y[left - 1] > half and y[left - 1] <= y[left]:
+            left -= 1
+        right = peak
+        while right < len(y) - 1 and y[right + 1] > half and y[right + 1] <= y[right]:
+            right += 1
+        left, right = max(left - 1, 0), min(right + 1, len(y) - 1) # and one point beyond the half maximum
+        fit = fit_peak(x[left:right + 1], y[left:right + 1])
+        if fit is None or not x[left] <= fit['center'] <= x[right]: # too few points: the maximum itself
+            fit = {'center': float(x[peak]), 'fwhm': float(x[right] - x[left]), 'height': float(y[peak]),
+                   'area': float(np.sum((y[left + 1:right + 1] + y[left:right]) / 2 * np.diff(x[left:right + 1])))}
+        bands.append({'position': fit['center'], 'fwhm': fit['fwhm'], 'height': fit['height'], 'area': fit['area'],
+                      'index': int(peak)})
+    return bands
+
+
+def band_spectra(scan, bands, positions, window=401, channel=0):
+    """
+    Adds the emission peak to each band: the wavelength of the maximum of the mean baseline-free spectrum
+    of the points within half a width of the band center. Only these points are read from the scan.
+
+    Args:
+    scan (scanStorage): The scan file (1D).
+    bands (list): The bands of detect_bands.
+    positions (array): The positions of the points of the scan.
+    window (int): The width of the baseline filter in pixels (default is 401).
+    channel (int): The spectrometer channel (default is 0, the main one).
+    """
+    wavelengths = scan[ScanStorage.channel_name('wavelengths', channel)]
+    intensities = scan[ScanStorage.channel_name('intensities', channel)]
+    written = _written(scan, channel) == 1
+    for band in bands:
+        near = np.flatnonzero(written & (np.abs(positions - band['position']) <= max(band['fwhm'], 1e-9) / 2))
+        if len(near) == 0: # a narrow band between two points: the nearest point
+            measured = np.flatnonzero(written)
+            near = measured[[np.argmin(np.abs(positions[measured] - band['position']))]]
+        spectrum = remove_baseline(intensities[near], window).mean(axis=0)
+        band['wavelength'] = float(wavelengths[int(np.argmax(spectrum))])
+
+
+def lane_masks(scan):
+    """
+    Returns the grid points of each lane of a 2D scan: the lane polygons stored with the scan, or the whole grid.
+
+    Args:
+    scan (scanStorage): The scan file (2D).
+
+    Returns:
+    list: One boolean (nx, ny) mask per lane.
+    """
+    x, y = scan['x'], scan['y']
+    lanes = scan.metadata.get('lanes') or []
+    if not lanes:
+        return [np.ones(x.shape, dtype=bool)]
+    return [ScanPath.inside_polygon(x, y, lane) for lane in lanes]
+
+
+def analyze(path, window=401, wavelength_range=None, threshold=0.05, min_separation=None, snr=5, chunk=256, channel=0):
+    """
+    Analyzes one saved scan.
+
+    1D scans: the band signal along the scan, its bands (position, width, height, area, emission peak).
+    2D scans: the lane profiles (band signal along the vertical axis averaged over each lane) and their bands.
+
+    Args:
+    path (str): The path of the scan file.
+    window (int): The width of the baseline filter in pixels (default is 401).
+    wavelength_range (tuple): The (min, max) wavelengths in nm to integrate (default is None, the emission window of the scan).
+    threshold (float): The smallest band prominence relative to the highest point (default is 0.05).
+    min_separation (float): The smallest distance between two bands (default is None).
+    snr (float): The smallest band prominence in multiples of the noise of the profile (default is 5).
+    chunk (int): The number of points processed at a time (default is 256).
+    channel (int): The spectrometer channel (default is 0, the main one).
+
+    Returns:
+    dict: The results (JSON serializable).
+    """
+    start = time.perf_counter()
+    scan = ScanStorage.load_scan(path)
+    signal = band_signal(scan, window, wavelength_range, chunk, channel)
+    result = {'path': path, 'mode': scan.metadata.get('mode'), 'points': int(np.count_nonzero(scan['written']))}
+    if signal.ndim == 1:
+        positions = np.asarray(scan['positions'])
+        order = np.argsort(positions)
+        written = ~np.isnan(signal[order])
+        bands = detect_bands(positions, signal, threshold, min_separation, snr)
+        band_spectra(scan, bands, positions, window, channel)
+        result.update({'positions': positions[order][written].tolist(), 'profile': signal[order][written].tolist(), 'bands': bands})
+    else:
+        ys = scan['y'][0]
+        lanes = []
+        for mask in lane_masks(scan):
+            counts = np.count_nonzero(mask & ~np.isnan(signal), axis=0)
+            with np.errstate(invalid='ignore'):
+                profile = np.nansum(np.where(mask, signal, 0), axis=0) / counts # the mean over the lane at each vertical position
+            measured = counts > 0
+            lanes.append({'positions': ys[measured].tolist(), 'profile': profile[measured].tolist(),
+                          'bands': detect_bands(ys[measured], profile[measured], threshold, min_separation, snr)})
+        result['lanes'] = lanes
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def analyze_file(path, save=True, **options):
+    """
+    Analyzes one scan and saves the results next to it as <name>-analysis.json (runs on the process pool).
+
+    Returns:
+    dict: The results, or {'path', 'error'} if the scan could not be analyzed.
+    """
+    try:
+        result = analyze(path, **options)
+    except Exception as error: # one broken scan must not stop the batch
+        return {'path': path, 'error': f'{type(error).__name__}: {error}'}
+    if save:
+        with open(path[:-len('.gscan')] + '-analysis.json', 'w') as file:
+            json.dump(result, file)
+    return result
+
+
+def analyze_many(paths, workers=None, save=True, **options):
+    """
+    Analyzes many scans in parallel on a process pool, one scan per task.
+
+    Args:
+    paths (list): The paths of the scan files.
+    workers (int): The number of processes (default is None, one per core).
+    save (bool): Whether the results are saved next to each scan (default is True).
+    options: Passed to analyze (window, wavelength_range, threshold, ...).
+
+    Returns:
+    list: The results of each scan, in the order of paths.
+    """
+    task = partial(analyze_file, save=save, **options)
+    if workers == 1 or len(paths) < 2:
+        return [task(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(task, paths))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze saved gel scans.')
+    parser.add_argument('paths', nargs='*', help='scan files to analyze')
+    parser.add_argument('--catalog', help='analyze the complete scans of this measurement directory')
+    parser.add_argument('--since-days', type=float, help='only the scans of the catalog from the last days')
+    parser.add_argument('--workers', type=int, help='number of processes (default is one per core)')
+    parser.add_argument('--window', type=int, default=401, help='width of the baseline filter in pixels')
+    parser.add_argument('--wavelengths', type=float, nargs=2, metavar=('MIN', 'MAX'), help='wavelength range to integrate in nm')
+    parser.add_argument('--threshold', type=float, default=0.05, help='smallest band prominence relative to the highest point')
+    parser.add_argument('--snr', type=float, default=5, help='smallest band prominence in multiples of the noise of the profile')
+    parser.add_argument('--min-separation', type=float, help='smallest distance between two bands')
+    parser.add_argument('--no-save', action='store_true', help='do not write the <name>-analysis.json files')
+    args = parser.parse_args(argv)
+
+    paths = list(args.paths)
+    if args.catalog:
+        since = time.time() - args.since_days * 24 * 3600 if args.since_days is not None else None
+        paths += [row['path'] for row in scanCatalog(args.catalog).find(since=since)]
+    start = time.perf_counter()
+    results = analyze_many(paths, args.workers, save=not args.no_save, window=args.window, wavelength_range=args.wavelengths,
+                           threshold=args.threshold, min_separation=args.min_separation, snr=args.snr)
+    for result in results:
+        name = os.path.basename(result['path'])
+        if 'error' in result:
+            print(f'{name}: {result["error"]}')
+        elif 'bands' in result:
+            print(f'{name}: {len(result["bands"])} bands at ' + ', '.join(f'{band["position"]:.2f}' for band in result['bands']))
+        else:
+            print(f'{name}: ' + '; '.join(f'lane {k + 1}: {len(lane["bands"])} bands' for k, lane in enumerate(result['lanes'])))
+    print(f'{len(results)} scans analyzed in {time.perf_counter() - start:.1f} s')
+    return 0 if all('error' not in result for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
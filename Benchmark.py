@@ -0,0 +1,108 @@
+import argparse
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from Simulation import simulated_engine
+# Scan throughput benchmarks on the simulated stage and spectrometer (no hardware needed).
+#
+#   python Benchmark.py                                   # all scan modes
+#   python Benchmark.py --modes step fly --output new.json
+#   python Benchmark.py --compare old.json                # ratio of points/second against a previous run
+#
+# For each scan mode it reports the points per second, the overhead per point on top of the
+# integration time and the peak Python memory of the scan (tracemalloc).
+
+# The scans of each mode (keyword arguments of scanEngine.run)
+SCANS = {'step': {'mode': 'step', 'start': 100, 'stop': 110, 'step': 0.5},
+         'fly': {'mode': 'fly', 'start': 100, 'stop': 110, 'step': 0.5},
+         'adaptive': {'mode': 'adaptive', 'start': 100, 'stop': 110, 'step': 1, 'min_step': 0.25},
+         'raster': {'mode': 'raster', 'start': 100, 'stop': 104, 'step': 1, 'x_start': 50, 'x_stop': 54}}
+
+
+def benchmark(mode, integration_time, directory, save=True, channels=1, **motion):
+    """
+    Runs one scan on the simulated devices and measures it.
+
+    Args:
+    mode (str): The scan mode (a key of SCANS).
+    integration_time (float): The integration time in microseconds.
+    directory (str): The directory the scan is saved to.
+    save (bool): Whether the scan is saved, so that the storage is part of the measurement (default is True).
+    channels (int): The number of simulated spectrometers (default is 1).
+    motion: The motion profile of the simulated stage (velocity, acceleration, settle_time).
+
+    Returns:
+    dict: The number of points, the duration, points per second, the overhead per point and the peak memory.
+    """
+    scan = SCANS[mode]
+    with contextlib.redirect_stdout(io.StringIO()): # connect and start at the beginning of the scan, the approach is not part of the measurement
+        engine = simulated_engine(integration_time, directory=directory, channels=channels, **motion)
+        engine.stage.move_xy(scan.get('x_start', engine.stage.current_position['1']), scan['start'], wait=True)
+    for spec in engine.spectrometers:
+        spec.wait_for_frame(0) # the acquisition is running
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # the scans print every move
+        count, _ = engine.run(name=f'benchmark-{mode}' if save else None, **scan)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for spec in engine.spectrometers:
+        spec.stop_acquisition()
+    return {'points': count,
+            'seconds': seconds,
+            'points_per_second': count / seconds,
+            'overhead_per_point_ms': (seconds / max(count, 1) - integration_time*1e-6) * 1e3,
+            'peak_memory_kb': peak / 1024}
+
+
+def print_results(results, baseline=None):
+    """
+    Prints the results as a table, with the speed-up against a baseline if given.
+    """
+    columns = ('points', 'seconds', 'points_per_second', 'overhead_per_point_ms', 'peak_memory_kb')
+    print('{:<8}'.format('mode') + ''.join('{:>24}'.format(column) for column in columns) + ('{:>12}'.format('speed-up') if baseline else ''))
+    for mode, result in results.items():
+        line = '{:<8}'.format(mode) + ''.join('{:>24.2f}'.format(result[column]) for column in columns)
+        if baseline and mode in baseline:
+            line += '{:>11.2f}x'.format(result['points_per_second'] / baseline[mode]['points_per_second'])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the scan modes on the simulated devices.')
+    parser.add_argument('--modes', nargs='+', choices=list(SCANS), default=list(SCANS), help='scan modes to run')
+    parser.add_argument('--integration-time', type=float, default=2e4, help='integration time in microseconds')
+    parser.add_argument('--velocity', type=float, default=1.5, help='stage velocity in mm/s')
+    parser.add_argument('--acceleration', type=float, default=20, help='stage acceleration in mm/s^2')
+    parser.add_argument('--settle-time', type=float, default=0.05, help='stage settling time in seconds')
+    parser.add_argument('--channels', type=int, default=1, help='number of simulated spectrometers')
+    parser.add_argument('--no-save', action='store_true', help='do not save the scans')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    motion = {'velocity': args.velocity, 'acceleration': args.acceleration, 'settle_time': args.settle_time}
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in args.modes:
+            results[mode] = benchmark(mode, args.integration_time, directory, save=not args.no_save, channels=args.channels, **motion)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'integration_time': args.integration_time, 'motion': motion, 'results': results}, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,48 +1,77 @@
 import sys
 import threading
-
-import dearpygui.dearpygui as dpg # Import DearPyGui for GUI creation and control
-
-from LinearStage import linearStage # Import the linearStage class to control the linear stage device
-from Spectrometer import spectrometer # Import the spectrometer class to measure spectra
-
-import numpy as np
 from datetime import datetime
-import time # Import time module for handling sleep between measurements
-import glob  # Import glob to check for existing files
 
+import dearpygui.dearpygui as dpg # Import DearPyGui for GUI creation and control
 
+from ScanEngine import scanEngine # Import the scan engine which connects and controls the linear stage and the spectrometer
+import ScanPath # Path planning for the 2D scans
+from GuiRender import renderScheduler, decimate, liveScanView # Rate-limited rendering of the plots and the live scan image
 
-# Instantiate the linearStage class to control the linear stage device
-LS = linearStage()
-LS.connect_and_start()
 
 
-# Instantiate the spectrometer class with a default integration time of 1 second (1e6 microseconds)
+# Instantiate the scan engine with a default integration time of 1 second (1e6 microseconds)
+# The linear stage and the spectrometer are connected the first time they are used (see connect_devices below)
 integration_time = 1e6
-S = spectrometer(integration_time)
-S.connect()
+engine = scanEngine(integration_time)
+
+# Redraws the plots at most 30 times per second and only when their data changed
+renderer = renderScheduler(fps=30)
+plot_width = 750 # pixel width of the spectrum plot, the spectra are decimated to it
+fitted_range = {'y': None} # intensity range the axes were last fitted to
+# Live image of the running scan, painted by the pipeline workers into a preallocated texture
+live_view = liveScanView(width=512, height=256)
+engine.live = live_view
+live_bounds = {'bounds': None} # image bounds the live plot was last set up for
+
+def connect_devices():
+    """
+    Connects the linear stage and the spectrometer in the background, so that the window shows up right away.
+    Starts rendering their data once they are connected.
+    """
+    engine.connect()
+    print('Devices are connected!')
+    renderer.add(lambda: engine.spectrometer.frame_count, update_data) # redraw for every new frame
+    renderer.add(lambda: stage_position(), update_position) # redraw when the stage has moved
+    renderer.add(lambda: engine.timer.steps if engine.timer else 0, update_rates) # redraw after every scan step
+    renderer.add(lambda: live_view.version, update_live) # upload the texture when a spectrum was painted
+    renderer.start()
 
 def update_data():
     """
-    Continuously updates the Wavelength and Intensity values for the plot.
-    The function keeps updating the plot data for each new measurement taken by the spectrometer.
+    Updates the Wavelength and Intensity values for the plot with the latest frame taken by the spectrometer.
+    Called by the render scheduler when a new frame has arrived.
     """
-
-    scan_count = 0
-
-    while True:
-        S.measure() # Measure and update the wavelengths and intensities
-        scan_count+=1
-        # Update the plot with new wavelength and intensity data
-        dpg.set_value('series_data', [S.wavelengths, S.intensities]) # set the intensity and wavelength values to the plot
-        dpg.set_value('current_scan', scan_count) # Update scan count display
+    S = engine.spectrometer
+    frame = S.frame
+    if frame is None: # no frame is measured yet
+        return
+    # Update the plot with new wavelength and intensity data, decimated to the width of the plot
+    wavelengths, intensities = decimate(S.wavelengths, frame['intensities'], plot_width)
+    dpg.set_value('series_data', [wavelengths, intensities]) # set the intensity and wavelength values to the plot
+    dpg.set_value('current_scan', frame['seq']) # Update scan count display
+    # Fit the axes only when the intensities leave the fitted range or shrink to less than half of it
+    low, high = float(intensities.min()), float(intensities.max())
+    fitted = fitted_range['y']
+    if fitted is None or low < fitted[0] or high > fitted[1] or high - low < (fitted[1] - fitted[0]) / 2:
         dpg.fit_axis_data(axis='x_axis') # Fit the x-axis data to the current wavelengths
         dpg.fit_axis_data(axis='y_axis') # Fit the y-axis data to the current intensities
+        fitted_range['y'] = (low, high)
 
-
-# Global variable to stop the scan when necessary
-stop_all = None
+def update_live():
+    """
+    Uploads the live scan image to its texture. Called by the render scheduler when a spectrum was painted into it.
+    Sets up the image bounds and the axes of the live plot when a new scan has started.
+    """
+    dpg.set_value('live_texture', live_view.texture.ravel())
+    if live_view.bounds != live_bounds['bounds']:
+        bounds_min, bounds_max = live_view.bounds
+        dpg.configure_item('live_series', bounds_min=bounds_min, bounds_max=bounds_max)
+        dpg.configure_item('live_x_axis', label=live_view.labels[0])
+        dpg.configure_item('live_y_axis', label=live_view.labels[1])
+        dpg.fit_axis_data(axis='live_x_axis')
+        dpg.fit_axis_data(axis='live_y_axis')
+        live_bounds['bounds'] = live_view.bounds
 
 
 def measure():
@@ -51,50 +80,25 @@ def measure():
 
     - Uses values entered by the user for the start, stop, and step size of the stage movement.
     - At each position, the spectrometer measures the wavelength and intensity values.
-    - Data is optionally saved to files, and the measurement can be interrupted by setting stop_all to True.
+    - In fly scan mode the stage sweeps continuously and the positions are taken from the recorded trajectory.
+    - In adaptive mode the step is refined at the bands, down to a quarter of the step size.
+    - Data is optionally saved to a scan file while it is measured, and the measurement can be interrupted with the STOP button.
+      Without a file name, the scan is saved under the time it started (scan-YYYYMMDD-HHMMSS).
     """
-    # Retrieve user inputs for the scan range and step size
-    _start, _stop, _step = map(float, (dpg.get_value(Start), dpg.get_value(Stop), dpg.get_value(Step)))
-    print('Start: ', _start, 'Stop: ', _stop, 'Step: ', _step)
-    _save = dpg.get_value(Save)
-    print('Save: ', _save)
-    global stop_all # Declare the global variable stop_all for controlling the scan
-
-    pos = [] # List to store position data
-    wave = None # Placeholder for wavelength data
-    ints = [] # List to store intensity data
-
-    for i in np.arange(_start, _stop + _step, _step):
-        # Move the linear stage to the next position
-        LS.move(i, wait=True)
-        pos.append(i)
-        # at each step of the stage, measure the wavelength and intensities (which is updated from the update function continuosly)
-        time.sleep(integration_time*1e-6) # sleep as much as the integration time so that it is ensured that the measurement is done at the next positon!!
-        ints.append(S.intensities) # Store the intensity measurement
-        wave = S.wavelengths # Store the wavelengths measured
-
-        if stop_all: # Check if the scan should be stopped
-            print('Measurement is stopped!')
-            break
-    print('Measurement is complete!')
-
-    if _save:
-        now = datetime.now().strftime("%d.%m.%Y-%H:%M") # Get the current date and time
-        header = (f'integration time [microseconds] = {integration_time}' +
-                  f'\ndate-time = {now}' +
-                  f'\nstart = {_start}, stop = {_stop}, step= {_step}')
-        f_name = dpg.get_value(filename)
-
-        # Prevent overwriting by checking if the file already exists
-        counter = 1
-        while glob.glob(f'./measurements/*{f_name}*') != []: # Check if filename exists
-            f_name = f_name + f'_({str(counter)})'
-            counter +=1
-        # Save data to text files
-        np.savetxt(fname='./measurements/' + f_name + '-data_pos.txt', X=pos, delimiter=' ', header=header, fmt='%.2f') # up to 2 decimals and float
-        np.savetxt(fname='./measurements/' + f_name + '-data_w.txt', X=wave, delimiter=' ', header=header)
-        np.savetxt(fname='./measurements/' + f_name + '-data.txt', X=ints, delimiter=' ', header=header)
-        # np.savetxt(fname='./measurements/' + dpg.get_value(filename) + '-data.txt', X=all_data, delimiter=' ', header='')
+    mode = 'raster' if dpg.get_value(Scan2D) else 'fly' if dpg.get_value(Fly) else 'adaptive' if dpg.get_value(Adaptive) else 'step'
+    name = None
+    if dpg.get_value(Save):
+        name = dpg.get_value(filename).strip()
+        if not name: # Save is checked, so the scan must not get lost
+            name = datetime.now().strftime('scan-%Y%m%d-%H%M%S')
+            dpg.set_value(filename, name)
+            print(f'No file name is given, the scan is saved as {name}')
+    engine.run(mode=mode,
+               start=dpg.get_value(Start), stop=dpg.get_value(Stop), step=dpg.get_value(Step),
+               x_start=dpg.get_value(HStart), x_stop=dpg.get_value(HStop),
+               lanes=ScanPath.parse_lanes(dpg.get_value(Lanes)), path=dpg.get_value(Path),
+               name=name,
+               auto_exposure=dpg.get_value(AutoExposure))
 
 # for reading paul's data
 # def load_data_file(filename):
@@ -109,36 +113,59 @@ def run_measure_thread(): # so that the main program becomes responsive to stop
     """
     Starts the measurement in a separate thread so that the GUI remains responsive.
     """
-    global stop_all
-    stop_all = False # Reset the stop flag
     measure_thread = threading.Thread(target = measure) # Create a new thread for the measurement process
     measure_thread.start() # Start the measurement thread
 
+def take_dark():
+    """
+    Measures the dark spectrum in a separate thread; it is subtracted from the saved spectra from now on.
+    """
+    threading.Thread(target=engine.take_dark).start()
+
+def take_reference():
+    """
+    Measures the reference spectrum in a separate thread; the saved spectra are divided by it from now on.
+    """
+    threading.Thread(target=engine.take_reference).start()
+
 def stop_everything():
     """
-    Stops the measurement and all movements of the linear stage by setting stop_all to True.
+    Stops the measurement and all movements of the linear stage by setting the stop flag of the scan engine.
     Also stops the linear stage immediately.
     """
-    # stopping by global stop_all for wait = True moves
-    global stop_all
-    stop_all = True # Set stop_all to True to interrupt the measurement
-    LS.stop() # Stop the linear stage movement
+    engine.stop() # Interrupt the measurement and stop the linear stage movement
 
 
 
+def stage_position():
+    """
+    Returns the current horizontal and vertical positions of the linear stage, rounded as displayed.
+    """
+    LS = engine.stage
+    return round(LS.current_position['1'],2), round(LS.current_position['2'],2)
+
 def update_position():
     """
-    Continuously updates the position of the linear stage.
-    Displays the current horizontal and vertical positions in the GUI.
+    Updates the position of the linear stage.
+    Displays the current horizontal and vertical positions in the GUI. Called by the render scheduler when the stage has moved.
     """
-    while True:
-        # Get the current position of the horizontal and vertical axes
-        h = round(LS.current_position['1'],2)
-        v = round(LS.current_position['2'],2)
-        # Update the position display on the GUI
-        dpg.set_value(item = 'drag_point_location',value= [h,v])
-        dpg.set_value(item = horizontal_text, value = f'Horizontal: {h}')
-        dpg.set_value(item = vertical_text, value = f'Vertical: {v}')
+    # Get the current position of the horizontal and vertical axes
+    h, v = stage_position()
+    # Update the position display on the GUI
+    dpg.set_value(item = 'drag_point_location',value= [h,v])
+    dpg.set_value(item = horizontal_text, value = f'Horizontal: {h}')
+    dpg.set_value(item = vertical_text, value = f'Vertical: {v}')
+
+def update_rates():
+    """
+    Displays the points per second of the running scan and the phases of its last step.
+    Called by the render scheduler after every scan step.
+    """
+    timer = engine.timer
+    if timer is None: # no scan has started yet
+        return
+    phases = ', '.join(f'{phase} {seconds*1e3:.0f}' for phase, seconds in timer.latest().items())
+    dpg.set_value('scan_rates', f'{timer.rate():.2f} points/s ({phases} ms)')
 
 def move_to_input(sender, app_data, user_data):
     """
@@ -146,10 +173,10 @@ def move_to_input(sender, app_data, user_data):
     """
     if sender == 'horizontal':
         horizontal = float(dpg.get_value(H))
-        LS.move(horizontal, '1', wait=False) # Move the horizontal axis to the specified position
+        engine.stage.move(horizontal, '1', wait=False) # Move the horizontal axis to the specified position
     else:
         vertical = float(dpg.get_value(V))
-        LS.move(vertical, '2', wait=False) # Move the vertical axis to the specified position
+        engine.stage.move(vertical, '2', wait=False) # Move the vertical axis to the specified position
 
 def update_integration_time():
     """
@@ -157,7 +184,7 @@ def update_integration_time():
     """
     global integration_time
     integration_time = float(dpg.get_value(int_T)) # Read the integration time from input
-    S.set_integration_time(integration_time) # Update the spectrometer's integration time
+    engine.set_integration_time(integration_time) # Update the spectrometer's integration time
     print(f'Integration Time is updated to {integration_time} microseconds')
 
 def move_to_click(sender, app_data, user_data):
@@ -167,18 +194,22 @@ def move_to_click(sender, app_data, user_data):
     h, v = dpg.get_plot_mouse_pos()
     h = round(h, 1)
     v = round(v, 1)
-    LS.move(h, '1', wait=False) # Move to the horizontal position
-    LS.move(v, '2', wait=False) # Move to the vertical position
+    engine.stage.move_xy(h, v, wait=False) # Move both axes to the clicked position at the same time
 
 
 # Set up the DearPyGui context and create the main window
 dpg.create_context()
 
+# Texture of the live scan image, the texture array of live_view is uploaded as it is
+with dpg.texture_registry():
+    dpg.add_raw_texture(live_view.width, live_view.height, default_value=live_view.texture.ravel(),
+                        format=dpg.mvFormat_Float_rgba, tag='live_texture')
+
 # Define the primary window with plot for spectrometer data and linear stage position
 with (dpg.window(tag='Primary Window')):
 
     # Plot for displaying the spectrometer data (Wavelength vs Intensity)
-    with dpg.plot(height=450, width=750, pos = [10,10], crosshairs=True): # otherwise due to the positioning of the parameters group, the user cannot interact with buttons/ inputs
+    with dpg.plot(height=450, width=plot_width, pos = [10,10], crosshairs=True): # otherwise due to the positioning of the parameters group, the user cannot interact with buttons/ inputs
         dpg.add_plot_axis(dpg.mvXAxis, label='Wavelength [nm]', tag='x_axis')
         dpg.add_plot_axis(dpg.mvYAxis, label='Counts [a.u]', tag='y_axis')
         dpg.add_line_series([], [], parent='y_axis', tag='series_data')
@@ -199,6 +230,9 @@ with (dpg.window(tag='Primary Window')):
             dpg.add_text('Filename: ')
             filename = dpg.add_input_text(width = 150)
             Save = dpg.add_checkbox(label='Save', tag='save_checkbox', default_value=True)
+            Fly = dpg.add_checkbox(label='Fly scan', tag='fly_checkbox', default_value=False) # continuous sweep instead of step and settle
+            AutoExposure = dpg.add_checkbox(label='Auto exposure', tag='auto_exposure_checkbox', default_value=False) # at most the integration time
+            Adaptive = dpg.add_checkbox(label='Adaptive', tag='adaptive_checkbox', default_value=False) # refine the step at the bands down to a quarter
         
         # Linear Stage Parameters (Start, Stop, Step)
         with dpg.group(horizontal=True, label='Linear Stage Parameters'):
@@ -209,12 +243,33 @@ with (dpg.window(tag='Primary Window')):
             dpg.add_text('Step: ')
             Step = dpg.add_input_text( width=50, default_value= 0.5)
 
+        # 2D scan parameters (horizontal range, optional lane polygons and path planning method)
+        with dpg.group(horizontal=True, label='2D Scan Parameters'):
+            Scan2D = dpg.add_checkbox(label='2D scan', tag='scan_2d_checkbox', default_value=False)
+            dpg.add_text('H Start: ')
+            HStart = dpg.add_input_text( width=50, default_value= 50)
+            dpg.add_text('H Stop: ')
+            HStop = dpg.add_input_text( width=50, default_value= 60)
+            Path = dpg.add_combo(('auto', 'serpentine', 'serpentine_rows', 'nearest'), default_value='auto', width=100)
+        with dpg.group(horizontal=True):
+            dpg.add_text('Lanes: ')
+            Lanes = dpg.add_input_text(width=300, hint='x,y;x,y;... | x,y;...') # lane polygons, empty to scan the rectangle
+
         # Start Scan and Stop buttons
         with dpg.group(horizontal=True):
             dpg.add_button(label='Start Scan', tag='start_scan', callback= run_measure_thread)
             dpg.add_button(label='STOP', tag='stop_scan', callback=stop_everything)
+            dpg.add_button(label='Take Dark', tag='take_dark', callback=take_dark) # with the light source off
+            dpg.add_button(label='Take Reference', tag='take_reference', callback=take_reference) # with the light source on, without the gel
             dpg.add_text(default_value='123', tag='current_scan')
+        dpg.add_text(default_value='', tag='scan_rates') # live timing of the scan steps
     
+    # Live image of the running scan: position x wavelength (1D scans) or the band intensity on the x/y grid (2D scans)
+    with dpg.plot(height=700, width=500, pos = [770,10], label='Live Scan', tag='live_plot'):
+        dpg.add_plot_axis(dpg.mvXAxis, label='Wavelength [nm]', tag='live_x_axis')
+        dpg.add_plot_axis(dpg.mvYAxis, label='Position', tag='live_y_axis')
+        dpg.add_image_series('live_texture', [0, 0], [1, 1], parent='live_y_axis', tag='live_series')
+
     # Group for the stage position plot and moving the stages
     with dpg.group(pos = [500,450]): # compared to the width and height of the viewport!
         with dpg.plot(height=260, width=260, crosshairs=True, label="Stage Position", tag='stage_position'):
@@ -249,15 +304,15 @@ with dpg.item_handler_registry(tag="widget_handler") as handler:
 dpg.bind_item_handler_registry("stage_position", "widget_handler")
 
 # Setup and start the DearPyGui viewport and GUI loop
-dpg.create_viewport(title='GelScanner', width=800, height=800)
+dpg.create_viewport(title='GelScanner', width=1290, height=800)
 dpg.setup_dearpygui()
 dpg.show_viewport()
 dpg.set_primary_window('Primary Window', True)
 
-# Start background threads for updating data and stage position
-update_background_data = threading.Thread(target=update_data).start() # run the function and keep on executing, while the rest is still responsive!
-update_linearStage_position = threading.Thread(target=update_position).start()
+# Connect the devices in the background, then start rendering the data and stage position
+threading.Thread(target=connect_devices, daemon=True).start()
 
 # Start the DearPyGui application
 dpg.start_dearpygui()
+renderer.stop()
 dpg.destroy_context()
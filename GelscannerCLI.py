@@ -0,0 +1,129 @@
+import argparse
+import json
+import sys
+import time
+
+from ScanEngine import scanEngine # Import the scan engine which connects and controls the linear stage and the spectrometer
+from ScanCatalog import scanCatalog # Index of the saved scans
+import ScanPath # Path planning for the 2D scans
+# Command-line entry point for unattended scans without the GUI.
+#
+# Run a single scan:
+#   python GelscannerCLI.py --mode step --start 100 --stop 125 --step 0.5 --name gel1
+#   python GelscannerCLI.py --mode adaptive --start 100 --stop 125 --step 1 --min-step 0.125 --name gel1
+# Run a queue of scans (a JSON file with one scan or a list of scans, keys as in scanEngine.run):
+#   python GelscannerCLI.py --queue overnight.json
+#   [{"mode": "step", "start": 100, "stop": 125, "step": 0.5, "name": "gel1"},
+#    {"mode": "raster", "start": 100, "stop": 125, "step": 1, "x_start": 50, "x_stop": 60, "name": "gel1-2d"}]
+# List the saved scans of the measurement directory:
+#   python GelscannerCLI.py --list
+
+
+def parse_args(argv=None):
+    """
+    Parses the command-line arguments.
+
+    Args:
+    argv (list): The arguments (default is None, use sys.argv).
+
+    Returns:
+    argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Run gel scans without the GUI.')
+    parser.add_argument('--queue', nargs='+', default=[], help='JSON files with the scans to run one after the other')
+    parser.add_argument('--mode', choices=('step', 'fly', 'adaptive', 'raster'), default='step', help='scan mode of a single scan')
+    parser.add_argument('--start', type=float, default=100, help='start position of the vertical axis')
+    parser.add_argument('--stop', type=float, default=125, help='stop position of the vertical axis')
+    parser.add_argument('--step', type=float, default=0.5, help='step size')
+    parser.add_argument('--min-step', type=float, help='finest step size of adaptive scans (default is a quarter of --step)')
+    parser.add_argument('--threshold', type=float, default=0.05, help='relative change of the band signal refined by adaptive scans')
+    parser.add_argument('--x-start', type=float, help='start position of the horizontal axis (raster scans)')
+    parser.add_argument('--x-stop', type=float, help='stop position of the horizontal axis (raster scans)')
+    parser.add_argument('--lanes', default='', help="lane polygons 'x,y;x,y;... | x,y;...' (raster scans)")
+    parser.add_argument('--path', default='auto', help='path planning method (raster scans)')
+    parser.add_argument('--integration-time', type=float, default=1e6, help='integration time in microseconds')
+    parser.add_argument('--auto-exposure', action='store_true',
+                        help='adapt the integration time to each point, at most --integration-time (spectra in counts per second)')
+    parser.add_argument('--average', type=int, default=1, metavar='FRAMES',
+                        help='number of frames averaged into each point of step, adaptive and raster scans (without --auto-exposure)')
+    parser.add_argument('--roi', type=float, nargs=2, metavar=('MIN', 'MAX'), help='wavelength range in nm of the stored spectra')
+    parser.add_argument('--binning', type=int, default=1, help='number of neighbouring pixels summed in the stored spectra')
+    parser.add_argument('--name', help='file name to save the scan as (not saved if omitted)')
+    parser.add_argument('--directory', default='./measurements', help='directory the scans are saved to')
+    parser.add_argument('--spectrometers', nargs='+', metavar='SERIAL',
+                        help="serial numbers of the spectrometers to read at every point, the main one first, or 'all'")
+    parser.add_argument('--list', action='store_true', help='list the saved scans of the directory and exit')
+    parser.add_argument('--reference', action='store_true', help='do the reference run even if the stages are referenced')
+    args = parser.parse_args(argv)
+    if args.mode == 'raster' and not args.queue and not args.list and (args.x_start is None or args.x_stop is None):
+        parser.error('--mode raster needs --x-start and --x-stop') # exits before anything is connected
+    return args
+
+
+def load_queue(paths):
+    """
+    Reads the scans from the queue files. A raster scan without x_start or x_stop raises a ValueError here,
+    so that the queue fails before the first scan and not in the middle.
+
+    Args:
+    paths (list): The JSON files, each holding one scan (dict) or a list of scans.
+
+    Returns:
+    list: The keyword arguments of scanEngine.run for each scan.
+    """
+    jobs = []
+    for path in paths:
+        with open(path) as file:
+            content = json.load(file)
+        jobs.extend(content if isinstance(content, list) else [content])
+    for job in jobs:
+        if isinstance(job.get('lanes'), str):
+            job['lanes'] = ScanPath.parse_lanes(job['lanes'])
+        if job.get('mode') == 'raster' and (job.get('x_start') is None or job.get('x_stop') is None):
+            raise ValueError(f'The raster scan {job} of the queue needs x_start and x_stop!')
+    return jobs
+
+
+def list_scans(directory):
+    """
+    Prints the scans of the catalog of a measurement directory, oldest first.
+    """
+    for row in scanCatalog(directory).find(status=None):
+        created = time.strftime('%d.%m.%Y-%H:%M', time.localtime(row['created']))
+        print(f"{row['name']:<30} {row['mode'] or '':<9} {created}  {row['points'] or 0:>7} points  {row['status']}")
+
+
+def main(argv=None):
+    """
+    Runs the scans given on the command line. Ctrl+C stops the running scan and skips the rest of the queue.
+    """
+    args = parse_args(argv)
+    if args.list:
+        list_scans(args.directory)
+        return 0
+    if args.queue:
+        jobs = load_queue(args.queue)
+    else:
+        jobs = [{'mode': args.mode, 'start': args.start, 'stop': args.stop, 'step': args.step,
+                 'x_start': args.x_start, 'x_stop': args.x_stop, 'lanes': ScanPath.parse_lanes(args.lanes),
+                 'path': args.path, 'name': args.name, 'min_step': args.min_step, 'threshold': args.threshold}]
+
+    serials = 'all' if args.spectrometers == ['all'] else args.spectrometers
+    engine = scanEngine(args.integration_time, directory=args.directory, reference=args.reference, serials=serials)
+    engine.auto_exposure = args.auto_exposure
+    engine.frames_per_point = max(args.average, 1)
+    if args.roi or args.binning > 1:
+        engine.set_processing(args.roi, args.binning)
+    for k, job in enumerate(jobs):
+        print(f'Scan {k + 1}/{len(jobs)}: {job}')
+        try:
+            engine.run(**job)
+        except KeyboardInterrupt:
+            engine.stop()
+            print('Queue is stopped!')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
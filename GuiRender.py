@@ -0,0 +1,243 @@
+import threading
+import time
+
+import numpy as np
+# Rate-limited rendering for the GUI.
+# The acquisition threads only publish their latest value (e.g. spectrometer.frame with its sequence
+# number); the render scheduler looks at the versions of these values at a capped frame rate and
+# redraws an item only when its value has changed. Spectra are decimated to the pixel width of the
+# plot so that DearPyGui never gets more points than it can show.
+# The live scan view builds the image of a running scan (position x wavelength for line scans, the band
+# intensity on the x/y grid for 2D scans) in a preallocated RGBA texture: every stored spectrum only
+# paints its own rows, and the whole image is recolored only when the color range has to grow.
+
+
+def decimate(x, y, width):
+    """
+    Decimates a line to the pixel width of a plot with min/max binning, so that peaks are kept.
+
+    Args:
+    x, y (array): The data of the line.
+    width (int): The number of bins (the pixel width of the plot).
+
+    Returns:
+    tuple: The decimated x and y (two points per bin, the minimum and the maximum), or the data itself if it is short enough.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(y) <= 2 * width:
+        return x, y
+    edges = np.linspace(0, len(y), width + 1).astype(int)[:-1] # first pixel of each bin
+    low = np.minimum.reduceat(y, edges)
+    high = np.maximum.reduceat(y, edges)
+    return np.repeat(x[edges], 2), np.column_stack((low, high)).ravel()
+
+
+def _colormap(size=256):
+    """
+    Returns a dark blue - green - yellow colormap (viridis-like) as a (size, 4) float32 RGBA lookup table.
+    """
+    anchors = np.array([[0.27, 0.00, 0.33], [0.23, 0.32, 0.55], [0.13, 0.57, 0.55], [0.37, 0.79, 0.38], [0.99, 0.91, 0.14]])
+    steps = np.linspace(0, len(anchors) - 1, size)
+    table = np.ones((size, 4), dtype=np.float32)
+    for channel in range(3):
+        table[:, channel] = np.interp(steps, np.arange(len(anchors)), anchors[:, channel])
+    return table
+
+
+COLORMAP = _colormap()
+
+
+class liveScanView:
+    """
+    A class to build the image of a running scan in a preallocated RGBA texture.
+
+    Line scans are shown as a position x wavelength heatmap (one texture band per scan point), 2D scans as
+    the band intensity (sum of the spectrum) on the x/y grid. The scan engine calls begin() when a scan
+    starts and add() from the pipeline workers for every stored spectrum; the GUI uploads the texture
+    whenever version changes.
+
+    Attributes:
+    width, height (int): The size of the texture in pixels.
+    texture (array): The (height, width, 4) float32 RGBA texture, row 0 at the top.
+    bounds (tuple): The ((x min, y min), (x max, y max)) plot coordinates of the image.
+    labels (tuple): The labels of the x and y axes of the image.
+    version (int): Increases with every change of the texture.
+
+    Methods:
+    begin(kind, shape, wavelengths, extent=None): Clears the image for a new scan.
+    add(index, intensities, positions=None): Paints a stored spectrum.
+    """
+    def __init__(self, width=512, height=256):
+        """
+        Args:
+        width, height (int): The size of the texture in pixels (default is 512 x 256).
+        """
+        self.width = width
+        self.height = height
+        self.texture = np.zeros((height, width, 4), dtype=np.float32)
+        self.texture[..., 3] = 1
+        self.bounds = ((0, 0), (1, 1))
+        self.labels = ('', '')
+        self.version = 0
+        self._values = None
+        self._lock = threading.Lock() # the pipeline workers paint at the same time
+
+    def begin(self, kind, shape, wavelengths, extent=None):
+        """
+        Clears the image for a new scan.
+
+        Args:
+        kind (str): 'line' (position x wavelength heatmap) or 'map' (band intensity on the x/y grid).
+        shape (tuple): The grid shape of the scan, (points,) or (nx, ny).
+        wavelengths (array): The wavelengths of the stored spectra.
+        extent (tuple): Line scans: the (first, last) grid positions, the points are placed by their positions
+                        (default is None, by their index). 2D scans: ((x first, x last), (y first, y last)).
+        """
+        with self._lock:
+            self.kind = kind
+            self.extent = extent
+            wavelengths = np.asarray(wavelengths, dtype=float)
+            if kind == 'line':
+                rows, columns = shape[0], min(len(wavelengths), self.width)
+                self._bins = np.linspace(0, len(wavelengths), columns + 1).astype(int)[:-1] # first pixel of each column
+                low, high = extent if extent is not None else (0, rows - 1)
+                self.bounds = ((float(wavelengths[0]), float(low)), (float(wavelengths[-1]), float(high)))
+                self.labels = ('Wavelength [nm]', 'Position' if extent is not None else 'Point')
+            else:
+                columns, rows = shape # x to the right, y upwards
+                (x0, x1), (y0, y1) = extent
+                self.bounds = ((float(x0), float(y0)), (float(x1), float(y1)))
+                self.labels = ('Horizontal', 'Vertical')
+            self._values = np.full((rows, columns), np.nan, dtype=np.float32)
+            # the grid row and column shown at each texture row and column; the last grid row is at the top
+            self._row_map = (rows - 1) - (np.arange(self.height) * rows) // self.height
+            self._column_map = (np.arange(self.width) * columns) // self.width
+            self._range = (np.inf, -np.inf)
+            self.texture[..., :3] = 0
+            self.version += 1
+
+    def add(self, index, intensities, positions=None):
+        """
+        Paints a stored spectrum into the image. Can be called from any thread.
+
+        Args:
+        index (int or tuple): The grid index of the point.
+        intensities (array): The stored (processed) spectrum.
+        positions (float or tuple): The position of the point (default is None).
+        """
+        if self._values is None:
+            return
+        intensities = np.asarray(intensities)
+        with self._lock:
+            if self.kind == 'line':
+                row = index
+                if self.extent is not None and positions is not None: # on the position grid (e.g. adaptive scans)
+                    low, high = self.extent
+                    row = int(round((positions - low) / (high - low) * (len(self._values) - 1))) if high != low else 0
+                if not 0 <= row < len(self._values):
+                    return
+                values = np.add.reduceat(intensities, self._bins) / np.diff(np.append(self._bins, len(intensities)))
+                self._values[row] = values
+            else:
+                ix, row = index
+                values = intensities.sum() # the band intensity
+                self._values[row, ix] = values
+            rows = [row]
+            finite = np.ravel(values)[np.isfinite(values)] # not e.g. a spectrum that could not be normalized
+            low, high = self._range
+            if len(finite) and (finite.min() < low or finite.max() > high): # recolor everything with a wider range, with some headroom
+                low, high = min(low, finite.min()), max(high, finite.max())
+                span = max(high - low, abs(high) * 1e-6, 1e-12)
+                self._range = (low - 0.1 * span, high + 0.5 * span)
+                rows = None
+            self._paint(rows)
+            self.version += 1
+
+    def _paint(self, rows=None):
+        """
+        Colors the given grid rows (None for all of them) into the texture.
+        """
+        low, high = self._range
+        if rows is None:
+            texture_rows = np.arange(self.height)
+        else:
+            texture_rows = np.flatnonzero(np.isin(self._row_map, rows))
+        values = self._values[self._row_map[texture_rows]][:, self._column_map]
+        if not np.isfinite(low): # nothing to scale the colors to yet
+            values = np.full_like(values, np.nan)
+            low, high = 0, 1
+        levels = np.nan_to_num((values - low) / (high - low) * (len(COLORMAP) - 1), nan=-1)
+        colors = COLORMAP[np.clip(levels, 0, len(COLORMAP) - 1).astype(int)]
+        colors[levels < 0] = (0, 0, 0, 1) # not measured yet
+        self.texture[texture_rows] = colors
+
+
+class renderScheduler:
+    """
+    A class to redraw GUI items at a capped frame rate, only when their data changes.
+
+    Attributes:
+    fps (float): The maximum number of redraws per second.
+
+    Methods:
+    add(version, render): Registers an item to redraw whenever version() changes.
+    start(): Starts the render thread.
+    stop(): Stops the render thread.
+    """
+    def __init__(self, fps=30):
+        """
+        Args:
+        fps (float): The maximum number of redraws per second (default is 30).
+        """
+        self.fps = fps
+        self._tasks = [] # [version, render, last version, last error]
+        self._running = False
+        self._thread = None
+
+    def add(self, version, render):
+        """
+        Registers an item to redraw.
+
+        Args:
+        version (callable): Returns a value that changes when the item must be redrawn (e.g. a frame sequence number).
+        render (callable): Redraws the item.
+        """
+        self._tasks.append([version, render, None, None])
+
+    def start(self):
+        """
+        Starts the render thread.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the render thread.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        """
+        Redraws the changed items, then sleeps for the rest of the frame.
+        An item that fails to redraw is tried again at its next change; the other items go on being redrawn.
+        """
+        period = 1 / self.fps
+        while self._running:
+            start = time.perf_counter()
+            for task in self._tasks:
+                try:
+                    current = task[0]()
+                    if current != task[2]:
+                        task[2] = current
+                        task[1]()
+                    task[3] = None
+                except Exception as error:
+                    if repr(error) != task[3]: # once, not at every frame
+                        print(f'Redrawing {getattr(task[1], "__name__", task[1])} failed: {error!r}')
+                        task[3] = repr(error)
+            time.sleep(max(period - (time.perf_counter() - start), 0))
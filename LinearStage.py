@@ -1,54 +1,180 @@
-from pipython import GCSDevice, pitools, datarectools # configuration of data recording
+try:
+    from pipython import GCSDevice, GCSError, pitools, datarectools # configuration of data recording
+except ImportError: # PIPython is only needed for the real stage, the simulated one (Simulation.py) runs without it
+    GCSDevice = pitools = datarectools = None
+    GCSError = Exception
 # import sys
 # Axis '1' is for horizontal movement, Axis '2' is for vertical movement
 # These are the labels used to refer to the axes of the linear stage.
 
+import threading
+import time
+
 class linearStage:
-     """
+    """
     A class to represent and control a linear stage device.
 
     Attributes:
-    pidevice (GCSDevice): The GCSDevice object representing the linear stage hardware.
+    pidevice (GCSDevice): The GCSDevice object representing the linear stage hardware (or a simulated device).
     range (dict): The valid movement range for each axis ('1' for horizontal, '2' for vertical).
-    current_position (dict): The current position of each axis ('1' for horizontal, '2' for vertical).
+    current_position (dict): The current position of each axis ('1' for horizontal, '2' for vertical), kept up to date by the position poller.
+    target_position (dict): The last commanded position of each axis.
+    position_cache (dict): The last poll of the controller: the 'time' (time.time()) it started, and the 'position', 'on_target' and 'moving' state of each axis.
+    max_velocity (float): The highest velocity of the stages in units per second.
+    wait_period (float): The time between two polls (or queries of the controller) while waiting on target, in seconds.
 
     Methods:
-    connect_and_start(): Connects to the linear stage device, initializes it, and sets the range and current position.
-    get_pos(): Updates the current position of each axis.
+    connect_and_start(reference=False): Connects to the linear stage device, initializes it (references it only if needed), and sets the range and current position.
+    is_referenced(): Checks whether both axes are already configured and referenced.
+    get_pos(): Updates the current position (and on-target state) of each axis with one query each.
+    start_polling(rate=20): Starts polling the position and on-target state in the background.
+    stop_polling(): Stops the position poller.
     move(target, axis='2', wait=False): Moves the stage to the target position on the specified axis.
+    move_xy(horizontal, vertical, wait=False): Moves both axes to the target positions at the same time.
+    wait_on_target(axes, timeout=300): Waits until the given axes are on target (on the position cache while polling) and returns when they stopped moving.
+    set_velocity(velocity, axis='2'): Sets the velocity of the specified axis.
+    is_moving(axis='2'): Checks whether the specified axis is still moving.
+    start_sweep(target, velocity, axis='2', numvalues=1024): Starts a constant-velocity move while recording the actual position.
+    end_sweep(): Waits for the sweep to finish and returns the recorded trajectory.
+    abort_sweep(): Stops the sweep without reading its trajectory.
     stop(): Stops all movements immediately.
     """
-    def __init__(self):
+    stages = ['M-404.8PD', 'M-404.8PD'] # The stages connected to the axes '1' and '2'
+    axes = ['1', '2']
+    max_velocity = 50 # mm/s, the M-404.8PD limit
+    wait_period = 0.01 # like pitools.waitontarget, but finer so that a scan step is not delayed by much
+
+    def __init__(self, device=None, recorder=None):
         """
         Initializes the linear stage object, preparing the GCSDevice and setting initial values.
+
+        Args:
+        device: A device with the GCS interface to use instead of the C-843, e.g. Simulation.simulatedGCSDevice (default is None).
+        recorder (callable): Creates the position recorder of a sweep as recorder(device, axis) (default is None, use the PI data recorder).
         """
-        self.pidevice = GCSDevice('C-843') # Initialize the GCSDevice for the linear stage (C-843 model)
+        # Initialize the GCSDevice for the linear stage (C-843 model)
+        self.pidevice = device if device is not None else GCSDevice('C-843')
+        self.recorder = recorder
         self.range = None # Placeholder for axis range, to be defined upon connection
         self.current_position = None # Placeholder for the current position of the axes
+        self.target_position = None # Placeholder for the commanded position of the axes
+        self.position_cache = None # Placeholder for the last poll of the controller
+        self._poller = None # Background thread polling the position
+        self._polling = False # Keeps the poller running
+        self._cache_changed = threading.Condition() # notified by every poll
+        self._waiters = 0 # the threads waiting on target; the poller polls every wait_period while there are any
+        self._wake = threading.Event() # wakes the poller up when a thread starts waiting
+        self._commanded = 0.0 # time.time() right after the last move command was sent
+        self._poll_error = None # the error of the last poll (None if it succeeded)
+        self._sweep = None # Settings of the sweep in progress (axis, previous velocity, data recorder, trigger time)
 
-    def connect_and_start(self):
+    def connect_and_start(self, reference=False):
         """
         Connects to the linear stage device and initializes it.
 
-        Establishes a connection via PCI and performs a startup process.
+        Establishes a connection via PCI and performs a startup process. The reference run is skipped
+        if the stages are already configured and referenced (e.g. by a previous run of the program).
         Retrieves the range and current position for both horizontal and vertical axes.
+
+        Args:
+        reference (bool): If True, the reference run is done even if the stages are already referenced. Default is False.
         """
         self.pidevice.ConnectPciBoard(board=1)  # Connect to the PCI board (C-843 is connected via PCI)
         print(f'connected: {self.pidevice.qIDN().strip()}', '\n') # Print the device ID
-        pitools.startup(self.pidevice, stages=['M-404.8PD', 'M-404.8PD'], refmodes='FRF') # Initialize the stages
-        # Retrieve the range for each axis
-        self.range = {'1': [self.pidevice.qTMN()['1'], self.pidevice.qTMX()['1']], 
-                      '2': [self.pidevice.qTMN()['2'], self.pidevice.qTMX()['2']]}
-        # Retrieve the current position for each axis
-        
-        self.current_position = {'1': self.pidevice.qPOS()['1'], '2': self.pidevice.qPOS()['2']}
+        if not reference and self.is_referenced():
+            print('The stages are already referenced, skipping the reference run.')
+            self.pidevice.SVO(['1', '2'], [True, True]) # make sure that the servos are on
+        else:
+            pitools.startup(self.pidevice, stages=self.stages, refmodes='FRF') # Initialize and reference the stages
+        # Retrieve the range for both axes with one query each (the range does not change, so it is kept)
+        minimum, maximum = self.pidevice.qTMN(self.axes), self.pidevice.qTMX(self.axes)
+        self.range = {axis: [minimum[axis], maximum[axis]] for axis in self.axes}
+        # Retrieve the current position for both axes
+        self.get_pos()
+        self.target_position = dict(self.current_position)
+
+    def is_referenced(self):
+        """
+        Checks whether both axes are configured with the expected stages and already referenced.
+
+        Returns:
+        bool: True if no reference run is needed.
+        """
+        try:
+            configured = self.pidevice.qCST(['1', '2'])
+            referenced = self.pidevice.qFRF(['1', '2'])
+        except GCSError: # e.g. the stages are not configured yet after power-up
+            return False
+        return [configured['1'].strip(), configured['2'].strip()] == self.stages and all(referenced.values())
 
     def get_pos(self):
         """
-        Updates the current position of the linear stage for both axes.
+        Updates the current position, the on-target and the moving state of the linear stage for both axes.
+
+        Returns:
+        dict: The new position cache ('time', 'position', 'on_target', 'moving').
+        """
+        # Retrieve the positions, on-target and moving states of both axes with one query each
+        started = time.time() # the states are at least as new as this, e.g. newer than a move command sent before
+        position = self.pidevice.qPOS(self.axes)
+        on_target = self.pidevice.qONT(self.axes)
+        moving = self.pidevice.IsMoving(self.axes)
+        cache = {'time': started,
+                 'position': {axis: float(position[axis]) for axis in self.axes},
+                 'on_target': {axis: bool(on_target[axis]) for axis in self.axes},
+                 'moving': {axis: bool(moving[axis]) for axis in self.axes}}
+        # replaced as a whole, so that readers never see a half updated cache
+        with self._cache_changed:
+            self.position_cache = cache
+            self.current_position = cache['position']
+            self._cache_changed.notify_all()
+        return cache
+
+    def start_polling(self, rate=20):
+        """
+        Starts polling the position and on-target state of both axes in the background, so that the GUI
+        and the scan engine can read current_position / position_cache without querying the controller.
+        Does nothing if the poller is already running.
+
+        Args:
+        rate (float): The number of polls per second (default is 20).
+        """
+        if self._poller is not None:
+            return
+        self._polling = True
+        self._poller = threading.Thread(target=self._poll, args=(1 / rate,), daemon=True)
+        self._poller.start()
+
+    def _poll(self, period):
+        """
+        Polls the controller every period seconds (every wait_period while a thread waits on target) until the poller is stopped.
+        A failed poll is reported and tried again at the next period.
+        """
+        while self._polling:
+            start = time.time()
+            try:
+                self.get_pos()
+                self._poll_error = None
+            except Exception as error: # e.g. a GCSError; the waiting threads query the controller themselves meanwhile
+                if repr(error) != self._poll_error: # once, not at every poll
+                    print(f'Polling the linear stage failed: {error!r}')
+                with self._cache_changed:
+                    self._poll_error = repr(error)
+                    self._cache_changed.notify_all()
+            wait = self.wait_period if self._waiters else period
+            self._wake.wait(max(wait - (time.time() - start), 0))
+            self._wake.clear()
+
+    def stop_polling(self):
+        """
+        Stops the position poller.
         """
-        # Retrieve and update the current positions for both axes
-        self.current_position = {'1': self.pidevice.qPOS()['1'], '2': self.pidevice.qPOS()['2']}
+        if self._poller is None:
+            return
+        self._polling = False
+        self._wake.set()
+        self._poller.join()
+        self._poller = None
 
     def move(self, target: float, axis = '2', wait=False): # default axis '2' is vertical axis
         """
@@ -60,27 +186,209 @@ class linearStage:
         wait (bool): If True, the function waits until the stage reaches the target position before continuing. Default is False.
 
         Returns:
-        None: If the move is successful, updates the current position. If the target is out of range, prints an error message.
+        None: If the move is successful, updates the target position. If the target is out of range, prints an error message.
         """
         if target >= self.range[axis][0] and target <= self.range[axis][1]:
             # If 'wait' is True, wait for the move to complete
+            self.pidevice.MOV(axis, target) # doesnt wait until the linear stage reaches its target
+            self._commanded = time.time() # only the polls started from now on see the move
             if wait:
-                pitools.moveandwait(self.pidevice, axes=axis , values=target)
-            else:
-                # Move without waiting for completion
-                self.pidevice.MOV(axis, target) # doesnt wait until the linear stage reaches its target
+                self.wait_on_target(axis)
             print('The axis {} is moved to position {:.2f}'.format(axis, target)) # Print the movement status
         else:
             # Print error if the target is out of range
             print('Target is out of LinearStage Range!')
             return None
-        # Update the current position for the specified axis
-        self.current_position[axis] = float(target)
+        self.target_position[axis] = float(target)
+        if wait: # the axis is on target; otherwise the position poller follows the move
+            self.current_position = dict(self.current_position, **{axis: float(target)})
+
+    def move_xy(self, horizontal: float, vertical: float, wait=False):
+        """
+        Moves both axes to the target positions at the same time with a single command.
+
+        Args:
+        horizontal (float): The target position of the horizontal axis ('1').
+        vertical (float): The target position of the vertical axis ('2').
+        wait (bool): If True, the function waits until both axes reach their targets. Default is False.
+
+        Returns:
+        bool: True if the move is started, False if one of the targets is out of range.
+        """
+        targets = {'1': float(horizontal), '2': float(vertical)}
+        if not all(self.range[axis][0] <= target <= self.range[axis][1] for axis, target in targets.items()):
+            print('Target is out of LinearStage Range!')
+            return False
+        self.pidevice.MOV(list(targets), list(targets.values()))
+        self._commanded = time.time() # only the polls started from now on see the move
+        if wait:
+            self.wait_on_target(list(targets))
+        print('The stage is moved to position ({:.2f}, {:.2f})'.format(horizontal, vertical))
+        self.target_position = targets
+        if wait: # both axes are on target; otherwise the position poller follows the move
+            self.current_position = dict(targets)
+        return True
+
+    def wait_on_target(self, axes, timeout=300):
+        """
+        Waits until the given axes are on target: first until they stop moving, then until they have settled.
+
+        While the position poller runs, only the position cache is read: the poller polls every wait_period
+        as long as a thread waits, and only the polls that started after the last move command was sent are used.
+        Otherwise, or when a poll fails, the controller is queried every wait_period.
+
+        Args:
+        axes (str or list): The axis or axes to wait for.
+        timeout (float): The maximum time to wait in seconds (default is 300).
+
+        Returns:
+        float: The time (time.time()) the axes stopped moving; the settling took until the function returned.
+        """
+        end = time.time() + timeout
+        poller = self._poller
+        if poller is not None and poller.is_alive():
+            stopped = self._wait_on_cache([axes] if isinstance(axes, str) else list(axes), poller, end, timeout)
+            if stopped is not None:
+                return stopped
+        while any(self.pidevice.IsMoving(axes).values()):
+            if time.time() > end:
+                raise SystemError('wait_on_target() timed out after {:.1f} seconds'.format(timeout))
+            time.sleep(self.wait_period) # one query per period, the controller is shared with the position poller
+        stopped = time.time()
+        while not all(self.pidevice.qONT(axes).values()):
+            if time.time() > end:
+                raise SystemError('wait_on_target() timed out after {:.1f} seconds'.format(timeout))
+            time.sleep(self.wait_period)
+        return stopped
+
+    def _wait_on_cache(self, axes, poller, end, timeout):
+        """
+        Waits on the position cache until the axes are on target; returns the start of the first poll that found them stopped,
+        or None if the poller fails (the caller then queries the controller).
+        """
+        commanded, stopped = self._commanded, None
+        with self._cache_changed:
+            self._waiters += 1
+            self._wake.set() # poll right away instead of at the end of the slow period
+            try:
+                while True:
+                    if self._poll_error is not None or not poller.is_alive():
+                        return None
+                    cache = self.position_cache
+                    if cache is not None and cache['time'] > commanded: # polled after the move command
+                        if stopped is None and not any(cache['moving'][axis] for axis in axes):
+                            stopped = cache['time']
+                        if stopped is not None and all(cache['on_target'][axis] for axis in axes):
+                            return stopped
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise SystemError('wait_on_target() timed out after {:.1f} seconds'.format(timeout))
+                    self._cache_changed.wait(min(remaining, 1)) # and checks now and then that the poller is alive
+            finally:
+                self._waiters -= 1
+
+    def set_velocity(self, velocity: float, axis = '2'):
+        """
+        Sets the velocity used by the following moves of the given axis.
+
+        Args:
+        velocity (float): The velocity in units per second.
+        axis (str): The axis ('1' for horizontal, '2' for vertical, default is '2').
+        """
+        self.pidevice.VEL(axis, velocity)
+
+    def is_moving(self, axis = '2'):
+        """
+        Checks whether the given axis is still moving.
+
+        Args:
+        axis (str): The axis ('1' for horizontal, '2' for vertical, default is '2').
+
+        Returns:
+        bool: True if the axis is moving, False once it reached its target or has been stopped.
+        """
+        return bool(self.pidevice.IsMoving(axis)[axis])
+
+    def start_sweep(self, target: float, velocity: float, axis = '2', numvalues=1024):
+        """
+        Starts a constant-velocity move (fly scan) to the target while the controller records the actual position.
+
+        The data recorder is triggered by the MOV command itself, so the recorded samples are aligned
+        to the time (time.time()) taken right before the command is sent.
+
+        Args:
+        target (float): The position where the sweep ends.
+        velocity (float): The velocity of the sweep in units per second.
+        axis (str): The axis to sweep ('1' for horizontal, '2' for vertical, default is '2').
+        numvalues (int): The number of position samples recorded over the sweep (default is 1024).
+
+        Returns:
+        bool: True if the sweep is started, False if the target is out of range or the velocity is too high.
+        """
+        if not (self.range[axis][0] <= target <= self.range[axis][1]):
+            print('Target is out of LinearStage Range!')
+            return False
+        if not 0 < velocity <= self.max_velocity:
+            print(f'The sweep velocity {velocity:.2f} is out of the range of the stage (at most {self.max_velocity})!')
+            return False
+        previous_velocity = self.pidevice.qVEL(axis)[axis] # restored at the end of the sweep
+        self.set_velocity(velocity, axis)
+
+        # Record the actual position of the axis, spreading the samples over the expected duration of the sweep
+        duration = abs(target - self.pidevice.qPOS(axis)[axis]) / velocity + 1 # one second of margin for acceleration and settling
+        drec = self._make_recorder(axis)
+        drec.numvalues = numvalues
+        drec.samplefreq = numvalues / duration
+        drec.arm()
+
+        trigger_time = time.time()
+        self.pidevice.MOV(axis, target)
+        self._commanded = time.time() # only the polls started from now on see the move
+        self._sweep = {'axis': axis, 'velocity': previous_velocity, 'recorder': drec, 'time': trigger_time}
+        print('The axis {} is sweeping to position {:.2f} at {:.2f} per second'.format(axis, target, velocity))
+        return True
+
+    def _make_recorder(self, axis):
+        """
+        Creates the recorder of the actual position of an axis, triggered by the next MOV command.
+        """
+        if self.recorder is not None:
+            return self.recorder(self.pidevice, axis)
+        drec = datarectools.Datarecorder(self.pidevice)
+        drec.options = datarectools.RecordOptions.ACTUAL_POSITION_2
+        drec.sources = axis
+        drec.trigsources = datarectools.TriggerSources.NEXT_COMMAND_WITH_RESET_2 # starts with the MOV command of the sweep
+        return drec
+
+    def end_sweep(self):
+        """
+        Waits for the sweep to finish, restores the previous velocity and reads the recorded trajectory.
+
+        Returns:
+        tuple: The sample times (list, time.time() scale) and the recorded positions (list) of the swept axis.
+        """
+        sweep, self._sweep = self._sweep, None
+        axis = sweep['axis']
+        while self.is_moving(axis): # also ends when the sweep is stopped
+            time.sleep(0.01)
+        self.set_velocity(sweep['velocity'], axis)
+        header, data = sweep['recorder'].getdata() # waits until all samples are recorded
+        positions = data[0]
+        times = [sweep['time'] + k * header['SAMPLE_TIME'] for k in range(len(positions))]
+        self.get_pos()
+        return times, positions
+
+    def abort_sweep(self):
+        """
+        Stops the stage and restores the velocity of a sweep in progress without reading its trajectory, e.g. when the scan failed.
+        """
+        sweep, self._sweep = self._sweep, None
+        self.stop()
+        if sweep is not None:
+            self.set_velocity(sweep['velocity'], sweep['axis'])
 
     def stop(self):
         """
         Immediately stops all movements of the linear stage.
         """
-        pitools.stopall(self.pidevice) # stops all the movements immediately
-
-# record data? datarectools??
\ No newline at end of file
+        self.pidevice.StopAll(noraise=True) # stops all the movements immediately (without raising the 'motion stopped' error)
@@ -0,0 +1,156 @@
+import json
+import time
+
+import numpy as np
+# Per-step timing of the scans.
+# The scan loops record how long each phase of a step took (sending the move command, moving, settling,
+# waiting for a fresh frame, reading the spectrum from the device, handing the frame over to the scan thread,
+# submitting to the pipeline, storing) into a preallocated ring buffer, so recording costs one array store
+# per phase. The phases are timed around the device calls, e.g. 'spectrum' is the spectrum() call of the
+# frame, which takes its integration and readout when the integration was restarted for it. The summary (percentiles and histograms of every
+# phase) is printed at the end of a scan and saved next to the scan file.
+
+PHASES = ('command', 'move', 'settle', 'wait', 'spectrum', 'handover', 'submit', 'store', 'step')
+
+
+class phaseTimer:
+    """
+    A class to record the durations of the phases of each scan step in a ring buffer.
+
+    Attributes:
+    phases (tuple): The names of the phases.
+    durations (array): The ring buffer of the durations in seconds, one row per step (NaN where not recorded).
+    steps (int): The number of steps recorded so far.
+
+    Methods:
+    record(step, phase, seconds): Records the duration of a phase of a step.
+    step_done(step): Marks the end of a step (for the rate).
+    rate(window=20): Returns the steps per second over the last steps.
+    latest(): Returns the durations of the last complete step.
+    summary(bins=20): Returns the percentiles and histograms of the phases.
+    save(path): Saves the summary as JSON.
+    """
+    def __init__(self, phases=PHASES, size=4096):
+        """
+        Args:
+        phases (tuple): The names of the phases (default is PHASES).
+        size (int): The number of steps kept in the ring buffer (default is 4096).
+        """
+        self.phases = tuple(phases)
+        self.size = size
+        self.durations = np.full((size, len(self.phases)), np.nan)
+        self.ends = np.full(size, np.nan) # time.time() at the end of each step
+        self.steps = 0
+        self._columns = {phase: k for k, phase in enumerate(self.phases)}
+        self._started = time.time()
+
+    def record(self, step, phase, seconds):
+        """
+        Records the duration of a phase of a step. Can be called from any thread.
+
+        Args:
+        step (int): The number of the step.
+        phase (str): The phase, one of phases.
+        seconds (float): The duration in seconds.
+        """
+        row = step % self.size
+        if step >= self.steps: # a new step overwrites the oldest row of the ring buffer
+            self.durations[row] = np.nan
+            self.steps = step + 1
+        self.durations[row, self._columns[phase]] = seconds
+
+    def step_done(self, step):
+        """
+        Marks the end of a step.
+
+        Args:
+        step (int): The number of the step.
+        """
+        self.ends[step % self.size] = time.time()
+
+    def _recorded(self):
+        """
+        Returns the rows of the ring buffer that hold recorded steps, oldest first.
+        """
+        if self.steps <= self.size:
+            return np.arange(self.steps)
+        return (np.arange(self.steps - self.size, self.steps)) % self.size
+
+    def rate(self, window=20):
+        """
+        Returns the number of steps per second over the last steps.
+
+        Args:
+        window (int): The number of steps to average over (default is 20).
+
+        Returns:
+        float: The steps per second (0 until two steps are done).
+        """
+        ends = self.ends[self._recorded()[-window:]]
+        ends = ends[~np.isnan(ends)]
+        if len(ends) < 2:
+            return 0.0
+        return (len(ends) - 1) / (ends[-1] - ends[0])
+
+    def latest(self):
+        """
+        Returns the durations of the last complete step.
+
+        Returns:
+        dict: The duration of each recorded phase in seconds (empty before the first step).
+        """
+        rows = self._recorded()
+        done = rows[~np.isnan(self.ends[rows])]
+        if len(done) == 0:
+            return {}
+        row = self.durations[done[-1]]
+        return {phase: float(row[k]) for k, phase in enumerate(self.phases) if not np.isnan(row[k])}
+
+    def summary(self, bins=20):
+        """
+        Returns the percentiles and histograms of the durations of every recorded phase.
+
+        Args:
+        bins (int): The number of histogram bins (default is 20).
+
+        Returns:
+        dict: The number of steps, the overall rate and, for each phase, the count, mean, p50, p90, p99 and max
+              in milliseconds, and the histogram ('counts' and bin 'edges' in milliseconds).
+        """
+        rows = self._recorded()
+        ends = self.ends[rows]
+        ends = ends[~np.isnan(ends)]
+        summary = {'steps': self.steps,
+                   'steps per second': (len(ends) - 1) / (ends[-1] - ends[0]) if len(ends) > 1 else 0.0,
+                   'phases': {}}
+        for k, phase in enumerate(self.phases):
+            values = self.durations[rows, k]
+            values = values[~np.isnan(values)] * 1e3
+            if len(values) == 0:
+                continue
+            counts, edges = np.histogram(values, bins=bins)
+            p50, p90, p99 = np.percentile(values, (50, 90, 99))
+            summary['phases'][phase] = {'count': len(values), 'mean': float(values.mean()),
+                                        'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(values.max()),
+                                        'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()}}
+        return summary
+
+    def report(self):
+        """
+        Returns a short text summary: the rate and the median and p90 of every phase.
+        """
+        summary = self.summary()
+        lines = ['{} steps, {:.2f} steps per second'.format(summary['steps'], summary['steps per second'])]
+        for phase, values in summary['phases'].items():
+            lines.append('  {:<12} p50 {:9.2f} ms   p90 {:9.2f} ms   max {:9.2f} ms'.format(phase, values['p50'], values['p90'], values['max']))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """
+        Saves the summary as JSON.
+
+        Args:
+        path (str): The path of the JSON file.
+        """
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
@@ -0,0 +1,209 @@
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import ScanStorage # Memory-mapped scan files
+# Catalog of the scans of a measurement directory.
+# An SQLite index (catalog.sqlite in the measurement directory) holds one row per scan file with its
+# name, mode, creation time, number of points and the full header metadata, so past scans can be
+# queried without opening their files. Unique names are allocated from a counter per requested name
+# instead of listing the directory, and scans are opened lazily (memory-mapped) through load().
+#
+#   catalog = scanCatalog('./measurements')
+#   for row in catalog.find(mode='step', since=time.time() - 7*24*3600, step=0.5):
+#       with catalog.load(row['name']) as scan:
+#           ...
+
+CATALOG = 'catalog.sqlite'
+SUFFIX = re.compile(r'^(.*)_\((\d+)\)$') # name_(n), the names given to repeated measurements
+
+
+class scanCatalog:
+    """
+    A class to index the scan files of a measurement directory.
+
+    Attributes:
+    directory (str): The measurement directory.
+    path (str): The path of the catalog database.
+
+    Methods:
+    allocate(name): Reserves a unique scan file path for a requested name.
+    finish(path, status='complete'): Records the parameters of a finished (or failed) scan from its file header.
+    register(path, status=None): Adds (or updates) a scan file in the catalog.
+    rebuild(): Indexes all the scan files of the directory.
+    find(...): Returns the scans matching the given parameters.
+    load(name): Opens a scan lazily and memory-mapped.
+    """
+    def __init__(self, directory='./measurements'):
+        """
+        Opens the catalog of a directory. A new catalog indexes the scan files that are already in the directory.
+
+        Args:
+        directory (str): The measurement directory (default is './measurements').
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, CATALOG)
+        os.makedirs(directory, exist_ok=True)
+        new = not os.path.exists(self.path)
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS scans (name TEXT PRIMARY KEY, file TEXT, mode TEXT, created REAL, '
+                       'points INTEGER, status TEXT, metadata TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS scans_created ON scans (created)')
+            db.execute('CREATE TABLE IF NOT EXISTS names (base TEXT PRIMARY KEY, count INTEGER)') # the next suffix of each name
+        if new:
+            self.rebuild()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Opens a connection for one transaction; a connection per call so that any thread can use the catalog.
+        """
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE') # one writer at a time, so two scans never get the same name
+            yield db
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+    def allocate(self, name):
+        """
+        Reserves a unique scan file path for a requested name: name, then name_(1), name_(2), ...
+
+        Args:
+        name (str): The requested file name.
+
+        Returns:
+        str: The path of the scan file; the scan is listed as 'running' until finish() is called.
+        """
+        with self._transaction() as db:
+            row = db.execute('SELECT count FROM names WHERE base = ?', (name,)).fetchone()
+            count = row[0] if row else 0
+            while True: # normally once, unless a file was copied into the directory by hand
+                candidate = name if count == 0 else f'{name}_({count})'
+                taken = db.execute('SELECT 1 FROM scans WHERE name = ?', (candidate,)).fetchone()
+                if not taken and not os.path.exists(self._file(candidate)):
+                    break
+                count += 1
+            db.execute('INSERT OR REPLACE INTO names VALUES (?, ?)', (name, count + 1))
+            db.execute('INSERT INTO scans VALUES (?, ?, NULL, ?, 0, ?, ?)',
+                       (candidate, os.path.basename(self._file(candidate)), time.time(), 'running', '{}'))
+        return self._file(candidate)
+
+    def _file(self, name):
+        return os.path.join(self.directory, f'{name}.gscan')
+
+    def finish(self, path, status='complete'):
+        """
+        Records the parameters of a finished scan from its file header.
+        A scan that failed before its file was created is removed from the catalog.
+
+        Args:
+        path (str): The path of the scan file.
+        status (str): 'complete' or 'failed' (default is 'complete').
+        """
+        if not os.path.exists(path):
+            with self._transaction() as db:
+                db.execute('DELETE FROM scans WHERE name = ?', (os.path.basename(path)[:-len('.gscan')],))
+            return
+        self.register(path, status)
+
+    def register(self, path, status=None):
+        """
+        Adds a scan file to the catalog, or updates its row, from the file header.
+
+        Args:
+        path (str): The path of the scan file.
+        status (str): 'complete', 'failed' or 'running' (default is None, from the header: 'failed' if the scan raised an error,
+                      'running' if the file was never closed with its number of points, e.g. an interrupted scan, else 'complete').
+        """
+        name = os.path.basename(path)[:-len('.gscan')]
+        with ScanStorage.load_scan(path) as scan: # only the header is read
+            metadata = scan.metadata
+        if status is None:
+            status = 'failed' if metadata.get('failed') else 'complete' if 'points' in metadata else 'running'
+        with self._transaction() as db:
+            row = db.execute('SELECT created FROM scans WHERE name = ?', (name,)).fetchone()
+            created = row[0] if row else os.path.getmtime(path)
+            db.execute('INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (name, os.path.basename(path), metadata.get('mode'), created, metadata.get('points'), status,
+                        json.dumps(metadata)))
+            match = SUFFIX.match(name)
+            base, count = (match.group(1), int(match.group(2)) + 1) if match else (name, 1)
+            db.execute('INSERT INTO names VALUES (?, ?) ON CONFLICT (base) DO UPDATE SET count = max(count, excluded.count)',
+                       (base, count))
+
+    def rebuild(self):
+        """
+        Indexes all the scan files of the directory, e.g. scans made before the catalog existed.
+        """
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.gscan'))):
+            try:
+                self.register(path)
+            except ValueError: # not a scan file
+                print(f'{path} is not a scan file, it is not indexed')
+
+    def find(self, name=None, mode=None, since=None, until=None, status='complete', metadata=None, **parameters):
+        """
+        Returns the scans matching the given parameters, oldest first.
+
+        Args:
+        name (str): A pattern of the names, with * as wildcard (default is None, any name).
+        mode (str): The scan mode (default is None, any mode).
+        since, until (float): The range of the creation times (time.time()) (default is None, no limit).
+        status (str): 'complete', 'failed' (the scan raised an error), 'running' (unfinished or interrupted) or None for all (default is 'complete').
+        metadata (dict): Header metadata values to match by their exact keys, e.g. {'integration time [microseconds]': 1e5} (default is None).
+        parameters: Header metadata values to match, e.g. step=0.5; spaces in the keys are given as underscores.
+
+        Returns:
+        list: The scans as dicts with 'name', 'path', 'mode', 'created', 'points', 'status' and 'metadata'.
+        """
+        conditions, values = [], []
+        if name is not None:
+            conditions.append('name GLOB ?')
+            values.append(name)
+        for column, value, operator in (('mode', mode, '='), ('created', since, '>='), ('created', until, '<='), ('status', status, '=')):
+            if value is not None:
+                conditions.append(f'{column} {operator} ?')
+                values.append(value)
+        match = dict(metadata or {})
+        match.update({key.replace('_', ' '): value for key, value in parameters.items()})
+        for key, value in match.items():
+            conditions.append('json_extract(metadata, ?) = ?')
+            values.extend(('$."{}"'.format(key), value))
+        query = 'SELECT name, file, mode, created, points, status, metadata FROM scans'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._transaction() as db:
+            rows = db.execute(query + ' ORDER BY created', values).fetchall()
+        return [{'name': name, 'path': os.path.join(self.directory, file), 'mode': mode, 'created': created,
+                 'points': points, 'status': status, 'metadata': json.loads(metadata)}
+                for name, file, mode, created, points, status, metadata in rows]
+
+    def load(self, name):
+        """
+        Opens a scan of the catalog read-only and memory-mapped; nothing but the header is read until its arrays are used.
+        The file stays mapped until the scan is closed, e.g. with catalog.load(name) as scan: ...
+
+        Args:
+        name (str): The name of the scan.
+
+        Returns:
+        scanStorage: The scan file, to close() when it is no longer used.
+        """
+        with self._transaction() as db:
+            row = db.execute('SELECT file FROM scans WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(f'{name} is not in the catalog of {self.directory}')
+        return ScanStorage.load_scan(os.path.join(self.directory, row[0]))
+
+    def __len__(self):
+        with self._transaction() as db:
+            return db.execute("SELECT count(*) FROM scans WHERE status = 'complete'").fetchone()[0]
@@ -0,0 +1,757 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from LinearStage import linearStage # Import the linearStage class to control the linear stage device
+from Spectrometer import spectrometer, list_spectrometers # Import the spectrometer class to measure spectra
+import ScanPath # Path planning for the 2D scans
+import ScanStorage # Memory-mapped scan files
+from ScanCatalog import scanCatalog # Index of the saved scans
+from ScanPipeline import scanPipeline # Processing and storage of the frames on worker threads
+from Profiling import phaseTimer # Per-step timing of the scans
+
+
+class scanEngine:
+    """
+    A class to run gel scans without the GUI.
+
+    The linear stage and the spectrometers are connected lazily, the first time they are used, and each
+    spectrometer streams frames from its own acquisition thread while it is connected. With several
+    spectrometers (channels), every scan point gets one frame of each channel, lined up by timestamp.
+
+    Attributes:
+    integration_time (float): Integration time of the spectrometer in microseconds.
+    directory (str): The directory the scan files are saved to.
+    catalog (scanCatalog): The index of the scans of the directory.
+    stop_all (bool): Set to True to interrupt the running scan.
+    dark (array): The dark spectrum subtracted from the stored spectra (None to store them as measured), see spectrometer.processor.
+    normalize (str): None, 'max' or 'sum' to normalize the stored spectra, see spectrometer.processor.
+    auto_exposure (bool): If True, the step, adaptive and raster scans adapt the integration time to each point
+                          (at most integration_time, see spectrometer.expose) and store the spectra in counts per second.
+    frames_per_point (int): The number of frames the step, adaptive and raster scans average into each point without
+                            auto-exposure (see spectrometer.average_frame), to lower the noise of weak bands.
+    workers (int): The number of threads processing and storing the frames of a scan.
+    poll_rate (float): The number of position polls of the linear stage per second.
+    timer (phaseTimer): The per-step timing of the running (or last) scan.
+    live (liveScanView): Gets the stored spectra of the running scan for the live image in the GUI (None for no live view).
+
+    Methods:
+    connect(): Connects all the devices now instead of on first use.
+    run(mode='step', ...): Runs one scan and optionally saves it.
+    step_scan(_start, _stop, _step, ...): Moves the vertical axis step by step and takes one spectrum at each position.
+    adaptive_scan(_start, _stop, _step, min_step=None, threshold=0.05, ...): Refines a coarse step scan at the bands.
+    fly_scan(_start, _stop, _step, ...): Sweeps the vertical axis at constant velocity while streaming spectra.
+    raster_scan(x_range, y_range, _step, ...): Scans a rectangle or lane polygons on both axes.
+    set_integration_time(int_T): Sets the integration time of the spectrometer.
+    take_dark(frames=10): Measures the dark spectrum (the light source must be off).
+    take_reference(frames=10): Measures the reference spectrum the stored spectra are divided by.
+    set_processing(roi=None, binning=1): Crops the stored spectra to a wavelength range and bins their pixels.
+    process(intensities, frames=1, integration_time=None): Processes a spectrum for storage with spectrometer.processor.
+    stop(): Interrupts the running scan and stops the linear stage.
+    """
+    def __init__(self, integration_time=1e6, directory='./measurements', stage=None, spec=None, reference=False, serials=None):
+        """
+        Initializes the scan engine. Nothing is connected until the devices are used.
+
+        Args:
+        integration_time (float): The integration time in microseconds (default is 1e6 (1 second)).
+        directory (str): The directory the scan files are saved to (default is './measurements').
+        stage (linearStage): An already connected linear stage (default is None, connect on first use).
+        spec (spectrometer or list): An already connected spectrometer, or a list of them with the main channel first
+                                     (default is None, connect on first use).
+        reference (bool): If True, the stage does the reference run even if it is already referenced (default is False).
+        serials (list): The serial numbers of the spectrometers to connect, the main channel first, or 'all' for all the
+                        connected ones (default is None, the first available one).
+        """
+        self.integration_time = integration_time
+        self.directory = directory
+        self.stop_all = False
+        self.auto_exposure = False
+        self.frames_per_point = 1
+        self.workers = 1
+        self.poll_rate = 20
+        self.timer = None
+        self.live = None
+        self._stage = stage
+        self._spectrometers = list(spec) if isinstance(spec, (list, tuple)) else [spec] if spec is not None else None
+        self._serials = serials
+        self._exposer = None # exposes the channels at the same time with auto-exposure
+        self._reference = reference
+        self._catalog = None
+        self._connect_lock = threading.Lock() # so that the devices are connected only once when several threads need them
+
+    @property
+    def stage(self):
+        """
+        The linear stage, connected (and referenced if needed) and polled in the background from the first use on.
+        """
+        with self._connect_lock:
+            if self._stage is None:
+                stage = linearStage()
+                stage.connect_and_start(reference=self._reference)
+                self._stage = stage
+            self._stage.start_polling(self.poll_rate) # does nothing if it is already polling
+        return self._stage
+
+    @property
+    def spectrometers(self):
+        """
+        All the spectrometer channels, the main channel first, connected and acquiring on first use.
+        """
+        with self._connect_lock:
+            if self._spectrometers is None:
+                serials = list_spectrometers() if self._serials == 'all' else self._serials or [None]
+                channels = []
+                for serial in serials:
+                    spec = spectrometer(self.integration_time, serial=serial)
+                    spec.connect()
+                    channels.append(spec)
+                self._spectrometers = channels
+            for spec in self._spectrometers:
+                spec.start_acquisition() # does nothing if it is already acquiring
+        return self._spectrometers
+
+    @property
+    def spectrometer(self):
+        """
+        The main spectrometer channel, connected and acquiring on first use.
+        """
+        return self.spectrometers[0]
+
+    def connect(self):
+        """
+        Connects all the devices now instead of on first use.
+        """
+        return self.stage, self.spectrometers
+
+    def set_integration_time(self, int_T):
+        """
+        Sets the integration time of all the spectrometers.
+
+        Args:
+        int_T (float): The integration time in microseconds.
+        """
+        self.integration_time = int_T
+        for S in self.spectrometers:
+            S.set_integration_time(int_T)
+
+    @property
+    def dark(self):
+        return self.spectrometer.processor.dark
+
+    @dark.setter
+    def dark(self, dark):
+        self.spectrometer.processor.dark = dark
+
+    @property
+    def normalize(self):
+        return self.spectrometer.processor.normalize
+
+    @normalize.setter
+    def normalize(self, normalize):
+        self.spectrometer.processor.normalize = normalize
+
+    def set_processing(self, roi=None, binning=1, channel=0):
+        """
+        Crops the stored spectra of a channel to a wavelength range and bins their pixels.
+
+        Args:
+        roi (tuple): The (min, max) wavelengths in nm to keep (default is None, keep all the pixels).
+        binning (int): The number of neighbouring pixels summed into one (default is 1).
+        channel (int): The spectrometer channel (default is 0, the main one).
+        """
+        self.spectrometers[channel].processor.configure(roi, binning)
+
+    def take_dark(self, frames=10):
+        """
+        Measures the dark spectrum of each channel as the average of fresh frames. The light source must be off.
+
+        Args:
+        frames (int): The number of frames to average (default is 10).
+        """
+        for channel, S in enumerate(self.spectrometers):
+            result = S.average(frames)
+            if result is None:
+                print('No spectrum is received from the spectrometer!')
+                return
+            mean, variance = result
+            S.processor.dark = mean
+            print(f'Dark spectrum of channel {channel} is measured ({frames} frames, noise {np.sqrt(variance).mean():.1f} counts)')
+
+    def take_reference(self, frames=10):
+        """
+        Measures the reference spectrum of each channel (e.g. the light source without the gel) as the average of fresh frames.
+        The stored spectra are divided by it (both dark subtracted) from now on.
+
+        Args:
+        frames (int): The number of frames to average (default is 10).
+        """
+        for channel, S in enumerate(self.spectrometers):
+            result = S.average(frames)
+            if result is None:
+                print('No spectrum is received from the spectrometer!')
+                return
+            S.processor.set_reference(result[0], S.integration_time)
+            print(f'Reference spectrum of channel {channel} is measured ({frames} frames)')
+
+    def process(self, intensities, frames=1, integration_time=None, channel=0, **values):
+        """
+        Processes a spectrum with spectrometer.processor (runs on the pipeline workers).
+
+        Args:
+        intensities (array): The raw intensities (summed over the co-added frames).
+        frames (int): The number of co-added frames (default is 1).
+        integration_time (float): The total exposure in microseconds; if given, the spectrum is converted to counts per second (default is None).
+        channel (int): The spectrometer channel of the spectrum (default is 0).
+        values: The other values of the point (not used).
+
+        Returns:
+        array: The processed intensities, in a buffer of the worker thread that is reused for its next frame.
+        """
+        return self.spectrometers[channel].processor.process(intensities, frames, integration_time)
+
+    def stop(self):
+        """
+        Interrupts the running scan and stops all movements of the linear stage.
+        """
+        self.stop_all = True
+        if self._stage is not None:
+            self._stage.stop()
+
+    def _exposure_fields(self):
+        """
+        Returns the per-point arrays of the exposure of each channel (total integration time in microseconds and
+        number of co-added frames) stored with auto-exposure.
+        """
+        if not self.auto_exposure:
+            return {}
+        fields = {}
+        for channel in range(len(self.spectrometers)):
+            fields[ScanStorage.channel_name('integration_time', channel)] = 'float64'
+            fields[ScanStorage.channel_name('frames', channel)] = 'uint16'
+        return fields
+
+    def _channel_wavelengths(self):
+        """
+        Returns the wavelengths of the stored spectra of the other channels, see ScanStorage.create_scan.
+        """
+        return [S.processor.wavelengths for S in self.spectrometers[1:]]
+
+    def _frame_timeout(self, S=None):
+        """
+        Returns how long to wait for a frame of a spectrometer (default is the main one): at most two integrations plus some slack for the readout.
+        """
+        S = self.spectrometer if S is None else S
+        return 3*S.integration_time*1e-6 + 1
+
+    def _frames(self):
+        """
+        Returns the first frame of each channel that started integrating from now on (None for a missing frame).
+
+        The channels integrate at the same time, so waiting for all of them takes as long as the slowest one.
+        The integration of each channel is restarted first, so that its frames after the restart (by sequence number,
+        the computed start times are late by the readout) certainly started after the call. The acquisition of each
+        channel then pauses after the frames of the point, so that the restart at the next point does not wait for a
+        frame that is being read out (the scan releases it at the end).
+        With auto-exposure, the channels are exposed on threads so that their adjustments overlap too.
+        """
+        channels = self.spectrometers
+        if self.auto_exposure:
+            if len(channels) == 1:
+                return [channels[0].expose(max_integration_time=self.integration_time)]
+            if self._exposer is None:
+                self._exposer = ThreadPoolExecutor(max_workers=len(channels))
+            return list(self._exposer.map(lambda S: S.expose(max_integration_time=self.integration_time), channels))
+        seqs = [S.restart(frames=self.frames_per_point) for S in channels]
+        if self.frames_per_point > 1: # the frames of the other channels queue up meanwhile
+            return [S.average_frame(self.frames_per_point, seq=seq) for S, seq in zip(channels, seqs)]
+        return [S.wait_for_frame(timeout=self._frame_timeout(S), seq=seq) for S, seq in zip(channels, seqs)]
+
+    def _exposure(self, frame):
+        """
+        Returns the exposure values of a frame to store with auto-exposure.
+        """
+        if not self.auto_exposure:
+            return {}
+        return {'integration_time': frame['integration_time'] * frame['frames'], 'frames': frame['frames']}
+
+    @property
+    def catalog(self):
+        """
+        The catalog of the scans of the measurement directory, opened on first use.
+        """
+        with self._connect_lock:
+            if self._catalog is None or self._catalog.directory != self.directory:
+                self._catalog = scanCatalog(self.directory)
+        return self._catalog
+
+    def storage_path(self, f_name):
+        """
+        Returns a path in the measurement directory that does not overwrite an existing measurement
+        (f_name, f_name_(1), f_name_(2), ...), reserved in the catalog.
+
+        Args:
+        f_name (str): The requested file name.
+
+        Returns:
+        str: The path of the scan file.
+        """
+        return self.catalog.allocate(f_name) # positions, wavelengths, intensities and metadata in one file
+
+    def run(self, mode='step', start=100, stop=125, step=0.5, x_start=None, x_stop=None, lanes=None, path='auto',
+            name=None, integration_time=None, min_step=None, threshold=0.05, auto_exposure=None, frames_per_point=None):
+        """
+        Runs one scan and optionally saves it.
+
+        Args:
+        mode (str): 'step', 'fly', 'adaptive' or 'raster' (default is 'step').
+        start, stop, step (float): The range of the vertical axis and the step size (default is 100, 125, 0.5).
+        x_start, x_stop (float): The range of the horizontal axis for raster scans.
+        lanes (list): The lane polygons for raster scans (default is None, scan the whole rectangle).
+        path (str): The path planning method for raster scans (default is 'auto').
+        name (str): The file name to save the scan as (default is None, the scan is not saved).
+        integration_time (float): The integration time in microseconds (default is None, keep the current one).
+        min_step (float): The finest step size of adaptive scans (default is None, a quarter of step).
+        threshold (float): The relative change of the band signal that adaptive scans refine (default is 0.05).
+        auto_exposure (bool): Sets auto_exposure (default is None, keep the current setting).
+        frames_per_point (int): Sets frames_per_point (default is None, keep the current setting).
+
+        Returns:
+        tuple: The number of measured points and the path of the scan file (None if not saved).
+        """
+        if mode not in ('raster', 'fly', 'step', 'adaptive'): # checked before any device is connected
+            raise ValueError(f'Unknown scan mode: {mode}')
+        if mode == 'raster' and (x_start is None or x_stop is None):
+            raise ValueError('A raster scan needs x_start and x_stop!')
+        if integration_time is not None:
+            self.set_integration_time(float(integration_time))
+        if auto_exposure is not None:
+            self.auto_exposure = bool(auto_exposure)
+        if frames_per_point is not None:
+            self.frames_per_point = max(int(frames_per_point), 1)
+        start, stop, step = map(float, (start, stop, step))
+        print('Start: ', start, 'Stop: ', stop, 'Step: ', step, 'Mode: ', mode)
+        self.stop_all = False
+
+        metadata = {'integration time [microseconds]': self.spectrometer.integration_time,
+                    'date-time': datetime.now().strftime("%d.%m.%Y-%H:%M"),
+                    'mode': mode, 'start': start, 'stop': stop, 'step': step,
+                    'dark subtracted': self.dark is not None, 'normalize': self.normalize,
+                    'reference divided': self.spectrometer.processor.reference is not None,
+                    'roi': self.spectrometer.processor.roi, 'binning': self.spectrometer.processor.binning,
+                    'auto exposure': self.auto_exposure and mode != 'fly',
+                    'frames per point': self.frames_per_point if not self.auto_exposure and mode != 'fly' else 1,
+                    'channels': [str(S.spec) for S in self.spectrometers],
+                    'units': self.spectrometer.processor.units(per_second=self.auto_exposure and mode != 'fly')}
+        if mode == 'raster':
+            x_range = (float(x_start), float(x_stop))
+            metadata.update({'horizontal start': x_range[0], 'horizontal stop': x_range[1], 'lanes': lanes or []})
+        if mode == 'adaptive':
+            min_step = abs(step) / 4 if min_step is None else float(min_step)
+            metadata.update({'min step': min_step, 'threshold': float(threshold)})
+        storage_path = self.storage_path(name) if name else None
+
+        status = 'failed'
+        try:
+            if mode == 'raster':
+                count = self.raster_scan(x_range, (start, stop), step, lanes, path, storage_path, metadata)
+            elif mode == 'fly':
+                count = self.fly_scan(start, stop, step, storage_path, metadata)
+            elif mode == 'step':
+                count = self.step_scan(start, stop, step, storage_path, metadata)
+            else:
+                count = self.adaptive_scan(start, stop, step, min_step, float(threshold), storage_path, metadata)
+            status = 'complete'
+        finally: # also when the scan failed
+            for S in self.spectrometers:
+                S.release() # the acquisition paused after the last point goes on
+            if self.auto_exposure:
+                self.set_integration_time(self.integration_time) # back to the integration time of the live view
+            if storage_path:
+                self.catalog.finish(storage_path, status) # index the parameters of the scan
+        print(f'Measurement is complete! ({count} spectra)')
+        print(self.timer.report())
+        if storage_path:
+            self.timer.save(storage_path[:-len('.gscan')] + '-profile.json') # the timing summary next to the scan file
+        return count, storage_path
+
+    def _move(self, targets, wait=False):
+        """
+        Moves the axes given in targets ({axis: position}) with a single command.
+        """
+        if len(targets) == 1:
+            (axis, target), = targets.items()
+            self.stage.move(target, axis, wait=wait)
+        else:
+            self.stage.move_xy(targets['1'], targets['2'], wait=wait) # both axes move at the same time
+
+    def _acquire_points(self, points, pipeline, timer, first=0, signals=None):
+        """
+        Moves to each point and hands the first frame of each channel taken after the stage settled over to the pipeline.
+
+        The next move starts as soon as the integration windows of the frames close; the frames are processed
+        and stored on the pipeline workers while the stage moves. Every phase of each step is recorded by the timer.
+
+        Args:
+        points (list): The points as (storage index, {axis: position}).
+        pipeline (scanPipeline): Processes and stores the frames.
+        timer (phaseTimer): Records the phases of the steps.
+        first (int): The number of the first step for the timer, when a scan is acquired in several passes (default is 0).
+        signals (dict): If given, the band signal of each point is stored in it by storage index (default is None).
+
+        Returns:
+        int: The number of measured points.
+        """
+        LS = self.stage
+        count = 0
+        received = time.time()
+        if points:
+            axes = list(points[0][1])
+            moved = time.time()
+            self._move(points[0][1])
+            self._settle(axes, timer, first, moved, time.time())
+        for k, (index, targets) in enumerate(points):
+            step = first + k
+            settled = time.time() # the stage is on target from now on
+            # at each step of the stage, take the first spectrum of each channel that started integrating after the stage settled
+            # (with auto-exposure, adapt the integration time to this point)
+            frames = self._frames()
+            if any(frame is None for frame in frames):
+                print('No spectrum is received from the spectrometer!')
+                break
+            frame = frames[0] # the main channel
+            last, received = received, time.time()
+            timer.record(step, 'wait', frame['called'] - settled)
+            timer.record(step, 'spectrum', frame['end'] - frame['called'])
+            timer.record(step, 'handover', received - max(f['end'] for f in frames))
+            if k + 1 < len(points) and not self.stop_all:
+                moved = time.time()
+                self._move(points[k + 1][1]) # the integration window is closed, the stage can move on right away
+                commanded = time.time()
+            # Process and store the intensity measurement on the workers while the stage moves
+            position = targets['2'] if len(targets) == 1 else (targets['1'], targets['2'])
+            exposure = self._exposure(frame)
+            pipeline.submit(index, frame['intensities'], step=step, positions=position, times=(frame['start'] + frame['end']) / 2, **exposure)
+            for channel, other in enumerate(frames[1:], 1):
+                pipeline.submit(index, other['intensities'], channel=channel, times=(other['start'] + other['end']) / 2, **self._exposure(other))
+            timer.record(step, 'submit', time.time() - received)
+            timer.record(step, 'step', received - last)
+            timer.step_done(step)
+            if signals is not None:
+                if self.auto_exposure: # in counts per second, so that points with different exposures compare
+                    dark = self.dark * frame['frames'] if self.dark is not None else None
+                    signals[index] = ScanPath.band_signal(frame['intensities'], dark) / (exposure['integration_time']*1e-6)
+                else:
+                    signals[index] = ScanPath.band_signal(frame['intensities'], self.dark)
+            count += 1
+
+            if self.stop_all: # Check if the scan should be stopped
+                print('Measurement is stopped!')
+                break
+            if k + 1 < len(points):
+                self._settle(axes, timer, step + 1, moved, commanded)
+        return count
+
+    def _settle(self, axes, timer, step, moved, commanded):
+        """
+        Waits until the axes are on target and records the phases of the move of a step: sending the move command
+        (from moved to commanded), moving until the first poll that found the axes stopped, and settling until they are on target.
+        """
+        stopped = max(self.stage.wait_on_target(axes), commanded)
+        timer.record(step, 'command', commanded - moved)
+        timer.record(step, 'move', stopped - commanded)
+        timer.record(step, 'settle', time.time() - stopped)
+
+    def _abort(self, pipeline, storage, positions=True):
+        """
+        Cleans up after a scan that raised an exception: stops the pipeline workers once the queued frames are
+        stored and closes the scan file with the number of points written so far ('failed' in its header).
+        An error of the workers is only printed, the exception of the scan is the one that is raised.
+
+        Args:
+        pipeline (scanPipeline): The pipeline of the scan.
+        storage (scanStorage): The scan file (None if the scan is not saved).
+        positions (bool): False if the positions of the written points are not known yet (fly scans), so that none is kept (default is True).
+        """
+        try:
+            pipeline.close()
+        except Exception as error:
+            print(f'Storing the spectra failed as well: {error!r}')
+        finally:
+            if storage is not None:
+                if not positions:
+                    for channel in range(len(self.spectrometers)):
+                        storage[ScanStorage.channel_name('written', channel)][:] = 0
+                storage.close(points=int(np.count_nonzero(storage['written'])), failed=True)
+
+    def _pipeline(self, storage, timer):
+        """
+        Starts the pipeline of a scan, feeding the live view if there is one.
+        """
+        listener = self.live.add if self.live is not None else None
+        return scanPipeline(storage, self.process, self.workers, timer=timer, listener=listener)
+
+    def _live_begin(self, kind, shape, extent=None):
+        """
+        Clears the live view for a new scan, see GuiRender.liveScanView.begin.
+        """
+        if self.live is not None:
+            self.live.begin(kind, shape, self.spectrometer.processor.wavelengths, extent)
+
+    def step_scan(self, _start, _stop, _step, storage_path=None, metadata=None):
+        """
+        Moves the vertical axis step by step and takes one spectrum at each position after the stage settled.
+
+        Args:
+        _start, _stop, _step (float): The scan range and step size.
+        storage_path (str): The scan file each spectrum is written to as it arrives (default is None, nothing is saved).
+        metadata (dict): The header metadata of the scan file (default is None).
+
+        Returns:
+        int: The number of measured positions.
+        """
+        S = self.spectrometer
+        positions = np.arange(_start, _stop + _step, _step)
+        self._live_begin('line', (len(positions),), (positions[0], positions[-1]))
+        storage = ScanStorage.create_scan(storage_path, len(positions), S.processor.wavelengths, metadata=metadata,
+                                          fields=self._exposure_fields(), channels=self._channel_wavelengths()) if storage_path else None
+        timer = self.timer = phaseTimer()
+        pipeline = self._pipeline(storage, timer)
+
+        try:
+            count = self._acquire_points([(k, {'2': i}) for k, i in enumerate(positions)], pipeline, timer)
+            pipeline.close()
+        except BaseException:
+            self._abort(pipeline, storage)
+            raise
+        if storage is not None:
+            storage.close(points=count)
+        return count
+
+    def adaptive_scan(self, _start, _stop, _step, min_step=None, threshold=0.05, storage_path=None, metadata=None):
+        """
+        Scans the vertical axis coarse to fine: a first pass at _step, then passes that only measure the middle
+        of the intervals where the band signal changes (see ScanPath.refine), until they are min_step wide.
+
+        The positions end up dense at the bands and sparse on the empty gel. The scan file is sized for the
+        densest possible grid; the points are stored in the order they were measured, sort them by 'positions'.
+
+        Args:
+        _start, _stop, _step (float): The scan range and the step size of the coarse pass.
+        min_step (float): The finest step size (default is None, a quarter of _step).
+        threshold (float): The change of the band signal between neighbours, relative to its range, that is refined (default is 0.05).
+        storage_path (str): The scan file each spectrum is written to as it arrives (default is None, nothing is saved).
+        metadata (dict): The header metadata of the scan file (default is None).
+
+        Returns:
+        int: The number of measured positions.
+        """
+        S = self.spectrometer
+        min_step = abs(_step) / 4 if min_step is None else min_step
+        if not min_step > 0:
+            raise ValueError(f'The minimum step must be positive, not {min_step}!')
+        if min_step > abs(_step):
+            print(f'The minimum step {min_step} is larger than the step {_step}, the coarse pass is not refined')
+        positions = np.arange(_start, _stop + _step, _step)
+        spacing = min(min_step, abs(_step)) # no two points are closer than min_step, nor than the coarse step
+        size = int(np.ptp(positions) / spacing + 1e-9) + 1
+        self._live_begin('line', (size,), (positions[0], positions[0] + (size - 1) * spacing * np.sign(_step))) # rows on the finest grid
+        storage = ScanStorage.create_scan(storage_path, size, S.processor.wavelengths, metadata=metadata,
+                                          fields={'level': 'uint8', **self._exposure_fields()},
+                                          channels=self._channel_wavelengths()) if storage_path else None
+        timer = self.timer = phaseTimer()
+        pipeline = self._pipeline(storage, timer)
+
+        measured, signals = [], {} # positions and band signals by storage index
+        level = 0
+        try:
+            while len(positions):
+                count = len(measured)
+                points = [(count + k, {'2': i}) for k, i in enumerate(positions)]
+                done = self._acquire_points(points, pipeline, timer, first=count, signals=signals)
+                measured.extend(positions[:done])
+                if storage is not None:
+                    storage['level'][count:count + done] = level # 0 for the coarse pass, then the refinement passes
+                if done < len(positions) or self.stop_all:
+                    break
+                positions = ScanPath.refine(measured, [signals[k] for k in range(len(measured))], threshold, min_step)
+                if len(positions) and abs(self.stage.current_position['2'] - positions[-1]) < abs(self.stage.current_position['2'] - positions[0]):
+                    positions = positions[::-1] # start the next pass from the end the stage is at
+                level += 1
+                print(f'Refinement pass {level}: {len(positions)} positions')
+            pipeline.close()
+        except BaseException:
+            self._abort(pipeline, storage)
+            raise
+        if storage is not None:
+            storage.close(points=len(measured), levels=level)
+        return len(measured)
+
+    def fly_scan(self, _start, _stop, _step, storage_path=None, metadata=None):
+        """
+        Sweeps the vertical axis at constant velocity while the spectrometer streams back-to-back spectra.
+
+        The velocity is chosen so that the stage travels one step per integration time. The position of
+        each spectrum is interpolated from the trajectory recorded by the controller at the middle of its
+        integration window once the sweep is over. Auto-exposure is not used, the velocity depends on the integration time.
+
+        Args:
+        _start, _stop, _step (float): The scan range and step size.
+        storage_path (str): The scan file each spectrum is written to as it arrives (default is None, nothing is saved).
+        metadata (dict): The header metadata of the scan file (default is None).
+
+        Returns:
+        int: The number of spectra with a recorded position.
+        """
+        LS, S = self.stage, self.spectrometer
+        integration = S.integration_time*1e-6
+        velocity = abs(_step) / integration # one step of travel per spectrum
+        if velocity > LS.max_velocity:
+            velocity = LS.max_velocity
+            print(f'The stage is limited to {velocity} per second, the spectra are {velocity * integration:.3g} apart instead of {abs(_step)}')
+        # one spectrum per step plus the spectra taken during about two seconds of acceleration and deceleration
+        size = int(abs(_stop - _start) / (velocity * integration)) + 1 + int(2 / integration) + 2
+        self._live_begin('line', (size,)) # rows in the order of the spectra, the positions are only known after the sweep
+        storage = ScanStorage.create_scan(storage_path, size, S.processor.wavelengths, metadata=metadata,
+                                          channels=self._channel_wavelengths()) if storage_path else None
+        timer = self.timer = phaseTimer()
+        pipeline = self._pipeline(storage, timer)
+        try:
+            LS.move(_start, wait=True) # go to the start position at the normal velocity
+            times = [] # List to store the middle of the integration window of each spectrum
+            pending = [deque() for _ in self.spectrometers[1:]] # the spectra of the main channel waiting for a spectrum of each other channel
+
+            after = received = time.time()
+            sweep_start = after
+            seq = None # the first frame is the first one that started after the sweep start, then the frames follow by sequence number
+            dropped = 0 # the spectra that did not fit into the scan file
+            if not LS.start_sweep(_stop, velocity):
+                pipeline.close()
+                if storage is not None:
+                    storage.close(points=0)
+                return 0
+            while True:
+                frame = S.wait_for_frame(after, timeout=self._frame_timeout(), seq=seq)
+                if frame is None:
+                    print('No spectrum is received from the spectrometer!')
+                    LS.stop()
+                    break
+                last, received = received, time.time()
+                seq = frame['seq'] # the next frame is the one right after this one
+                if len(times) < size:
+                    k = len(times)
+                    times.append((frame['start'] + frame['end']) / 2)
+                    timer.record(k, 'spectrum', frame['end'] - frame['called'])
+                    timer.record(k, 'handover', received - frame['end'])
+                    pipeline.submit(k, frame['intensities'], step=k, times=times[-1])
+                    for channel, waiting in enumerate(pending, 1):
+                        waiting.append((k, times[-1]))
+                        self._match_frames(channel, waiting, pipeline, sweep_start)
+                    timer.record(k, 'submit', time.time() - received)
+                    timer.record(k, 'step', received - last)
+                    timer.step_done(k)
+                else: # the sweep takes longer than expected
+                    dropped += 1
+
+                if self.stop_all: # Check if the scan should be stopped (the stage is already stopped by stop())
+                    print('Measurement is stopped!')
+                    break
+                if not LS.is_moving(): # the sweep has reached the stop position
+                    break
+            rec_times, rec_pos = LS.end_sweep()
+            for channel, waiting in enumerate(pending, 1):
+                self._match_frames(channel, waiting, pipeline, sweep_start, final=True)
+            pipeline.close()
+        except BaseException:
+            LS.abort_sweep() # the stage does not go on sweeping at the sweep velocity
+            self._abort(pipeline, storage, positions=False)
+            raise
+        if dropped:
+            print(f'The sweep took longer than expected, the last {dropped} spectra did not fit into the scan file and are not stored!')
+
+        # Keep the spectra that are covered by the recorded trajectory and assign their positions
+        times = np.array(times)
+        if len(rec_times):
+            keep = (times >= rec_times[0]) & (times <= rec_times[-1])
+            positions = np.interp(times, rec_times, rec_pos)
+        else:
+            print('No trajectory is recorded, the positions of the spectra are unknown!')
+            keep = np.zeros(len(times), dtype=bool)
+            positions = np.full(len(times), np.nan)
+        if storage is not None:
+            storage['positions'][:len(times)] = positions
+            for channel in range(len(self.spectrometers)): # the spectra of the other channels are kept with the main one
+                written = storage[ScanStorage.channel_name('written', channel)]
+                written[:len(times)] = keep & (written[:len(times)] == 1) if channel else keep
+            storage.close(points=int(keep.sum()))
+        return int(keep.sum())
+
+    def _match_frames(self, channel, waiting, pipeline, after, final=False):
+        """
+        Lines up the spectra of another channel with the spectra of the main channel of a fly scan by timestamp:
+        each spectrum of the main channel gets the spectrum of the channel whose integration window has the nearest middle.
+
+        Args:
+        channel (int): The channel.
+        waiting (deque): The (index, middle time) of the spectra of the main channel that have no spectrum of the channel yet.
+        pipeline (scanPipeline): Processes and stores the spectra.
+        after (float): The start of the sweep, older spectra are not used.
+        final (bool): If True, the sweep is over and the nearest spectrum so far is taken even if a later one could be nearer (default is False).
+        """
+        frames = self.spectrometers[channel].frames_since(after)
+        if not frames:
+            return
+        middles = np.array([(frame['start'] + frame['end']) / 2 for frame in frames])
+        while waiting:
+            k, t = waiting[0]
+            if middles[-1] < t and not final: # a spectrum that is still integrating may be nearer
+                return
+            nearest = int(np.argmin(np.abs(middles - t)))
+            pipeline.submit(k, frames[nearest]['intensities'], channel=channel, times=middles[nearest])
+            waiting.popleft()
+
+    def raster_scan(self, x_range, y_range, _step, lanes=None, method='auto', storage_path=None, metadata=None):
+        """
+        Scans a rectangle or a set of lane polygons on both axes along a travel-optimized path.
+
+        The spectra are written into an (x, y, wavelength) cube; the grid axes are stored as 'x' and 'y'.
+
+        Args:
+        x_range, y_range (tuple): The start and stop positions of the horizontal and vertical axes.
+        _step (float): The step size of both axes.
+        lanes (list): The lane polygons (default is None, scan the whole rectangle).
+        method (str): The path planning method, see ScanPath.plan_path (default is 'auto').
+        storage_path (str): The scan file each spectrum is written to as it arrives (default is None, nothing is saved).
+        metadata (dict): The header metadata of the scan file (default is None).
+
+        Returns:
+        int: The number of measured points.
+        """
+        LS, S = self.stage, self.spectrometer
+        xs, ys = ScanPath.grid_axes(x_range, y_range, _step)
+        points = ScanPath.lane_points(xs, ys, lanes) if lanes else ScanPath.raster_points(xs, ys)
+        path = ScanPath.plan_path(points, xs, ys, method, start=(LS.current_position['1'], LS.current_position['2']))
+        self._live_begin('map', (len(xs), len(ys)), ((xs[0], xs[-1]), (ys[0], ys[-1])))
+        storage = None
+        if storage_path:
+            storage = ScanStorage.create_scan(storage_path, (len(xs), len(ys)), S.processor.wavelengths, position_size=2, metadata=metadata,
+                                              fields={'x': 'float64', 'y': 'float64', **self._exposure_fields()},
+                                              channels=self._channel_wavelengths())
+            storage['x'][:] = xs[:, None] # grid axes, broadcast over the cube
+            storage['y'][:] = ys[None, :]
+        timer = self.timer = phaseTimer()
+        pipeline = self._pipeline(storage, timer)
+
+        try:
+            count = self._acquire_points([((ix, iy), {'1': xs[ix], '2': ys[iy]}) for ix, iy in path], pipeline, timer)
+            pipeline.close()
+        except BaseException:
+            self._abort(pipeline, storage)
+            raise
+        if storage is not None:
+            storage.close(points=count)
+        return count
@@ -0,0 +1,259 @@
+import numpy as np
+# Path planning for 2D gel scans.
+# A scan grid is given by the horizontal (axis '1') positions xs and the vertical (axis '2') positions ys.
+# The points to be measured are stored as an (n, 2) array of grid indices (ix, iy) so that the
+# measured spectra can be written straight into an (x, y, wavelength) cube.
+# Both axes of the stage move at the same time, so the travel time between two points is set by
+# the longer of the two moves (Chebyshev distance).
+# Adaptive 1D scans start with a coarse pass and refine only the intervals where the band signal
+# changes between neighbouring points (band edges), halving them down to a minimum step.
+
+
+def parse_lanes(text):
+    """
+    Parses lane polygons given as text (e.g. entered in the GUI or on the command line).
+
+    Args:
+    text (str): The polygons separated by '|', each given as 'x,y;x,y;...' vertices, e.g. '10,100;20,100;20,125;10,125'.
+
+    Returns:
+    list: The lane polygons as lists of (x, y) vertices (empty if no lanes are given).
+    """
+    lanes = []
+    for polygon in text.split('|'):
+        if polygon.strip():
+            lanes.append([tuple(map(float, vertex.split(','))) for vertex in polygon.split(';') if vertex.strip()])
+    return lanes
+
+
+def grid_axes(x_range, y_range, step):
+    """
+    Builds the horizontal and vertical positions of a rectangular scan grid.
+
+    Args:
+    x_range (tuple): The start and stop positions of the horizontal axis.
+    y_range (tuple): The start and stop positions of the vertical axis.
+    step (float): The step size of both axes.
+
+    Returns:
+    tuple: The horizontal positions (xs) and the vertical positions (ys).
+    """
+    xs = np.arange(x_range[0], x_range[1] + step/2, step) # + step/2 so that the stop position is included
+    ys = np.arange(y_range[0], y_range[1] + step/2, step)
+    return xs, ys
+
+
+def raster_points(xs, ys):
+    """
+    Returns the grid indices of all the points of the rectangle.
+
+    Args:
+    xs, ys (array): The horizontal and vertical positions of the grid.
+
+    Returns:
+    array: The (n, 2) grid indices (ix, iy).
+    """
+    ix, iy = np.meshgrid(np.arange(len(xs)), np.arange(len(ys)), indexing='ij')
+    return np.column_stack((ix.ravel(), iy.ravel()))
+
+
+def inside_polygon(x, y, polygon):
+    """
+    Checks which points are inside a polygon (ray casting, points on the edges may fall on either side).
+
+    Args:
+    x, y (array): The coordinates of the points.
+    polygon (list): The (x, y) vertices of the polygon.
+
+    Returns:
+    array: A boolean array which is True for the points inside the polygon.
+    """
+    px, py = np.asarray(polygon, dtype=float).T
+    qx, qy = np.roll(px, -1), np.roll(py, -1) # the other end of each edge
+    x = np.asarray(x, dtype=float)[..., None]
+    y = np.asarray(y, dtype=float)[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = ((py > y) != (qy > y)) & (x < (qx - px) * (y - py) / (qy - py) + px)
+    return np.count_nonzero(crossing, axis=-1) % 2 == 1
+
+
+def lane_points(xs, ys, lanes):
+    """
+    Returns the grid indices of the points that are inside at least one of the lanes.
+
+    Args:
+    xs, ys (array): The horizontal and vertical positions of the grid.
+    lanes (list): The lane polygons, each given as a list of (x, y) vertices.
+
+    Returns:
+    array: The (n, 2) grid indices (ix, iy).
+    """
+    points = raster_points(xs, ys)
+    x, y = xs[points[:, 0]], ys[points[:, 1]]
+    inside = np.zeros(len(points), dtype=bool)
+    for lane in lanes:
+        inside |= inside_polygon(x, y, lane)
+    return points[inside]
+
+
+def serpentine(points, fast_axis=1):
+    """
+    Orders the points in a boustrophedon (serpentine) path.
+
+    The points are grouped in lines along the fast axis and every other line is walked backwards,
+    so that there is no return stroke between the lines.
+
+    Args:
+    points (array): The (n, 2) grid indices.
+    fast_axis (int): 1 to walk along the vertical axis (columns), 0 to walk along the horizontal axis (rows).
+
+    Returns:
+    array: The order of the points (indices into points).
+    """
+    slow_axis = 1 - fast_axis
+    order = np.lexsort((points[:, fast_axis], points[:, slow_axis])) # sort by line, then along the line
+    _, starts = np.unique(points[order, slow_axis], return_index=True)
+    segments = np.split(order, starts[1:])
+    return np.concatenate([segment[::-1] if k % 2 else segment for k, segment in enumerate(segments)])
+
+
+def nearest_neighbour(points, xs, ys, start=None):
+    """
+    Orders the points by always moving to the closest point that has not been measured yet.
+
+    The closest point is searched in a growing window of the grid around the current point, so that a
+    step costs about the number of grid cells around it instead of the number of points.
+
+    Args:
+    points (array): The (n, 2) grid indices.
+    xs, ys (array): The horizontal and vertical positions of the grid.
+    start (tuple): The (x, y) position of the stage before the scan (default is None, start at the first point).
+
+    Returns:
+    array: The order of the points (indices into points).
+    """
+    coords = np.column_stack((xs[points[:, 0]], ys[points[:, 1]]))
+    grid = np.full((len(xs), len(ys)), -1) # the index of the point at each grid cell, -1 for none or measured
+    grid[points[:, 0], points[:, 1]] = np.arange(len(points))
+    spacing = min(np.abs(np.diff(axis)).min() if len(axis) > 1 else np.inf for axis in (xs, ys)) # the smallest grid step
+    order = np.empty(len(points), dtype=int)
+    current = 0
+    if start is not None: # the stage may be anywhere, search all the points once
+        current = int(np.argmin(np.abs(coords - np.asarray(start, dtype=float)).max(axis=1)))
+    for k in range(len(points)):
+        order[k] = current
+        ix, iy = points[current]
+        grid[ix, iy] = -1
+        if k + 1 == len(points):
+            break
+        r = 1
+        while True:
+            window = grid[max(ix - r, 0):ix + r + 1, max(iy - r, 0):iy + r + 1]
+            candidates = window[window >= 0]
+            whole = window.shape == grid.shape
+            if len(candidates):
+                distance = np.abs(coords[candidates] - coords[current]).max(axis=1) # both axes move at the same time
+                closest = distance.min()
+                # the window holds every point closer than r grid steps, so a point that far is the closest of all
+                if closest <= r * spacing * (1 + 1e-9) or whole:
+                    current = int(candidates[distance == closest].min()) # the first of equally close points
+                    break
+                r = int(np.ceil(closest / spacing)) # grow the window to all the points at most that far
+            else:
+                r *= 2
+    return order
+
+
+def travel(points, order, xs, ys, start=None):
+    """
+    Computes the travel of the stage along a path.
+
+    Args:
+    points (array): The (n, 2) grid indices.
+    order (array): The order of the points.
+    xs, ys (array): The horizontal and vertical positions of the grid.
+    start (tuple): The (x, y) position of the stage before the scan (default is None).
+
+    Returns:
+    float: The sum of the Chebyshev distances between consecutive points of the path.
+    """
+    coords = np.column_stack((xs[points[order, 0]], ys[points[order, 1]]))
+    if start is not None:
+        coords = np.vstack((np.asarray(start, dtype=float), coords))
+    return float(np.abs(np.diff(coords, axis=0)).max(axis=1).sum())
+
+
+def plan_path(points, xs, ys, method='auto', start=None):
+    """
+    Orders the scan points to cut the dead travel of the stage.
+
+    Args:
+    points (array): The (n, 2) grid indices.
+    xs, ys (array): The horizontal and vertical positions of the grid.
+    method (str): 'serpentine' (columns), 'serpentine_rows', 'nearest' or 'auto' (the shortest of them; nearest is
+                  only tried for lanes, not for a full rectangle) (default is 'auto').
+    start (tuple): The (x, y) position of the stage before the scan (default is None).
+
+    Returns:
+    array: The (n, 2) grid indices in the order they should be measured.
+    """
+    if len(points) == 0:
+        return points
+    candidates = {}
+    if method in ('serpentine', 'auto'):
+        candidates['serpentine'] = serpentine(points, fast_axis=1)
+    if method in ('serpentine_rows', 'auto'):
+        candidates['serpentine_rows'] = serpentine(points, fast_axis=0)
+    full = len(points) == len(xs) * len(ys) # on a full rectangle the serpentine paths are already the shortest
+    if method == 'nearest' or (method == 'auto' and not full):
+        candidates['nearest'] = nearest_neighbour(points, xs, ys, start)
+    if not candidates:
+        raise ValueError(f'Unknown path planning method: {method}')
+
+    lengths = {name: travel(points, order, xs, ys, start) for name, order in candidates.items()}
+    best = min(lengths, key=lengths.get)
+    print('Path: {} ({} points, travel {:.1f})'.format(best, len(points), lengths[best]))
+    return points[candidates[best]]
+
+
+def band_signal(intensities, dark=None):
+    """
+    Returns the integrated band signal of a spectrum: the counts above the dark spectrum, or above the median when there is no dark.
+
+    Args:
+    intensities (array): The raw intensities.
+    dark (array): The dark spectrum (default is None, use the median of the spectrum as the baseline).
+
+    Returns:
+    float: The integrated signal in counts.
+    """
+    data = np.asarray(intensities, dtype=float)
+    data = data - (dark if dark is not None else np.median(data))
+    return float(np.clip(data, 0, None).sum())
+
+
+def refine(positions, signals, threshold=0.05, min_step=0.1):
+    """
+    Returns the positions to add to an adaptive scan: the middle of every interval between neighbouring
+    measured positions where the band signal changes by more than threshold times its range, as long as
+    the halves are not shorter than min_step.
+
+    Args:
+    positions (array): The measured positions (in any order).
+    signals (array): The band signal at each position.
+    threshold (float): The change of the signal between neighbours, relative to its range, that is refined (default is 0.05).
+    min_step (float): The smallest distance between two positions (default is 0.1).
+
+    Returns:
+    array: The new positions in ascending order (empty when the scan is fine enough).
+    """
+    order = np.argsort(positions)
+    positions = np.asarray(positions, dtype=float)[order]
+    signals = np.asarray(signals, dtype=float)[order]
+    span = signals.max() - signals.min() if len(signals) else 0
+    if span <= 0:
+        return np.array([])
+    steep = np.abs(np.diff(signals)) > threshold * span
+    wide = np.diff(positions) >= 2 * min_step - 1e-9 # the halves are at least min_step
+    refined = steep & wide
+    return (positions[:-1][refined] + positions[1:][refined]) / 2
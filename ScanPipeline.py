@@ -0,0 +1,96 @@
+import queue
+import threading
+import time
+
+from ScanStorage import channel_name
+# Processing and storage of the scan frames on worker threads.
+# The scan loop only moves the stage and waits for frames; each frame is handed over to a bounded
+# queue and processed (dark subtraction, normalization, ...) and written to the scan file by the
+# workers. When the workers fall behind, submit() blocks (backpressure) instead of letting the queue grow.
+
+
+class scanPipeline:
+    """
+    A class to process and store the frames of a scan on worker threads behind a bounded queue.
+
+    Attributes:
+    storage (scanStorage): The scan file the processed frames are written to (None to only process them).
+    process (callable): Turns the raw intensities of a frame into the stored intensities; called as process(intensities, channel=channel, **values).
+    timer (phaseTimer): Records the 'store' phase of each step (None to not record it).
+    listener (callable): Gets each stored spectrum of the main channel as listener(index, intensities, positions), e.g. a live view (None for no listener).
+
+    Methods:
+    submit(index, intensities, step=None, channel=0, **values): Queues a frame; blocks while the queue is full.
+    close(): Waits until all the queued frames are stored and stops the workers.
+    """
+    def __init__(self, storage, process=None, workers=1, maxsize=16, timer=None, listener=None):
+        """
+        Starts the worker threads.
+
+        Args:
+        storage (scanStorage): The scan file to write to (None to only process the frames).
+        process (callable): Processes the raw intensities (default is None, store them as they are).
+        workers (int): The number of worker threads (default is 1).
+        maxsize (int): The number of frames that can wait in the queue (default is 16).
+        timer (phaseTimer): Records how long processing and storing each frame took (default is None).
+        listener (callable): Gets the processed spectra of the main channel (default is None).
+        """
+        self.storage = storage
+        self.process = process
+        self.timer = timer
+        self.listener = listener
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None # the first exception raised by a worker, raised again by close()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _work(self):
+        """
+        Processes and stores the queued frames until close() queues None.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            index, intensities, step, channel, values = item
+            start = time.time()
+            try:
+                if self.process is not None:
+                    intensities = self.process(intensities, channel=channel, **values)
+                if self.storage is not None:
+                    values['intensities'] = intensities
+                    self.storage.write(index, channel, **{channel_name(name, channel): value for name, value in values.items()})
+                if self.listener is not None and channel == 0:
+                    self.listener(index, intensities, values.get('positions'))
+                if self.timer is not None and step is not None:
+                    self.timer.record(step, 'store', time.time() - start)
+            except Exception as error: # keep draining the queue so that the scan does not block
+                if self._error is None:
+                    self._error = error
+
+    def submit(self, index, intensities, step=None, channel=0, **values):
+        """
+        Queues a frame to be processed and stored. Blocks while the queue is full.
+
+        Args:
+        index (int or tuple): The grid index of the point.
+        intensities (array): The raw intensities of the frame.
+        step (int): The number of the scan step, for the timer (default is None).
+        channel (int): The spectrometer channel; the values of channel k > 0 are stored as <name>_<k> (default is 0).
+        values: The other values of the point (e.g. positions, times).
+        """
+        self._queue.put((index, intensities, step, channel, values))
+
+    def close(self):
+        """
+        Waits until all the queued frames are stored and stops the workers; does nothing more when called again.
+        Raises the first exception of the workers, if any.
+        """
+        workers, self._workers = self._workers, []
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,227 @@
+import json
+import time
+
+import numpy as np
+# Binary scan files (.gscan).
+# A scan file is a fixed-size JSON header followed by the raw arrays of the scan, so the whole file
+# can be memory-mapped: spectra are written in place while the scan runs and the arrays of a saved
+# scan are read lazily without parsing anything but the header.
+#
+# Layout:
+#   8 bytes   magic b'GELSCAN1'
+#   8 bytes   size of the header in bytes (little-endian uint64)
+#   header    JSON {'metadata': {...}, 'arrays': {name: {'dtype', 'shape', 'offset'}}}, padded with spaces
+#   arrays    C-ordered, each starting at a multiple of ALIGNMENT bytes
+#
+# Every scan file has the arrays 'wavelengths', 'intensities' (grid shape + wavelengths), 'positions'
+# (grid shape, or grid shape + (2,) for 2D scans), 'times' and 'written' (1 where a spectrum is stored).
+# The other spectrometer channels k have their own 'wavelengths_k', 'intensities_k', 'times_k' and
+# 'written_k', since a point can miss the spectrum of one channel but not of the other.
+
+MAGIC = b'GELSCAN1'
+HEADER_SIZE = 65536 # reserved for the JSON header, so the metadata can be updated in place
+ALIGNMENT = 64
+
+
+class scanStorage:
+    """
+    A class to represent a memory-mapped scan file.
+
+    Attributes:
+    path (str): The path of the scan file.
+    metadata (dict): The header metadata of the scan (parameters, date, ...).
+    arrays (dict): The memory-mapped arrays of the scan by name.
+
+    Methods:
+    create(path, arrays, metadata=None): Creates a new scan file with preallocated arrays.
+    write(index, channel=0, **values): Writes the values of one scan point of a channel in place.
+    flush(): Flushes the written data to the disk.
+    close(**metadata): Updates the metadata, flushes and closes the file.
+
+    A scan file is also a context manager that closes it, e.g. with load_scan(path) as scan: ...
+    """
+    def __init__(self, path, mode='r'):
+        """
+        Opens an existing scan file.
+
+        Args:
+        path (str): The path of the scan file.
+        mode (str): 'r' to open read-only, 'r+' to open for writing (default is 'r').
+        """
+        self.path = path
+        self.mode = mode
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a scan file!')
+            self._header_size = int(np.frombuffer(file.read(8), dtype='<u8')[0])
+            header = json.loads(file.read(self._header_size).decode('utf-8'))
+        self.metadata = header['metadata']
+        self._layout = header['arrays']
+        self._map = np.memmap(path, dtype=np.uint8, mode=mode) # maps the whole file, pages are only read when accessed
+        self.arrays = {name: self._view(spec) for name, spec in self._layout.items()}
+        self._flushed = time.time()
+
+    @classmethod
+    def create(cls, path, arrays, metadata=None, header_size=HEADER_SIZE):
+        """
+        Creates a new scan file with preallocated (zero-filled) arrays and opens it for writing.
+
+        Args:
+        path (str): The path of the scan file.
+        arrays (dict): The shape and dtype of each array by name, e.g. {'intensities': ((51, 2048), 'float64')}.
+        metadata (dict): The header metadata (default is None).
+        header_size (int): The bytes reserved for the header (default is HEADER_SIZE).
+
+        Returns:
+        scanStorage: The scan file opened with mode 'r+'.
+        """
+        layout = {}
+        offset = _align(len(MAGIC) + 8 + header_size)
+        for name, (shape, dtype) in arrays.items():
+            shape = [int(n) for n in np.atleast_1d(shape)] if shape != () else []
+            layout[name] = {'dtype': np.dtype(dtype).str, 'shape': shape, 'offset': offset}
+            offset = _align(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+        with open(path, 'wb') as file:
+            file.write(MAGIC)
+            file.write(np.array(header_size, dtype='<u8').tobytes())
+            file.write(_encode_header({'metadata': metadata or {}, 'arrays': layout}, header_size))
+            file.truncate(offset) # the arrays are allocated at once (sparse on most file systems) and read as zeros
+        return cls(path, mode='r+')
+
+    def _view(self, spec):
+        """
+        Returns the array described by a header entry as a view into the memory map.
+        """
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        data = self._map[spec['offset']:spec['offset'] + count * dtype.itemsize]
+        return data.view(dtype).reshape(spec['shape'])
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def write(self, index, channel=0, **values):
+        """
+        Writes the values of one scan point in place and marks it as written for the channel ('written' or 'written_<channel>').
+
+        The data is flushed to the disk at most once per second, so a crash loses at most the last second of the scan.
+
+        Args:
+        index (int or tuple): The grid index of the point.
+        channel (int): The spectrometer channel the values belong to (default is 0, the main one).
+        values: The values of the point by array name, e.g. intensities=..., positions=..., times=...
+        """
+        for name, value in values.items():
+            self.arrays[name][index] = value
+        self.arrays[channel_name('written', channel)][index] = 1
+        if time.time() - self._flushed > 1:
+            self.flush()
+
+    def flush(self):
+        """
+        Flushes the written data to the disk.
+        """
+        self._map.flush()
+        self._flushed = time.time()
+
+    def close(self, **metadata):
+        """
+        Updates the header metadata, flushes the data and closes the file.
+
+        Args:
+        metadata: Metadata to add to the header (e.g. the end time of the scan).
+        """
+        if self._map is None: # already closed
+            return
+        if self.mode != 'r':
+            self.metadata.update(metadata)
+            self._map[len(MAGIC) + 8:len(MAGIC) + 8 + self._header_size] = np.frombuffer(
+                _encode_header({'metadata': self.metadata, 'arrays': self._layout}, self._header_size), dtype=np.uint8)
+            self.flush()
+        self.arrays = {}
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _align(offset):
+    """
+    Rounds an offset up to the next multiple of ALIGNMENT.
+    """
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _encode_header(header, header_size):
+    """
+    Encodes the header as JSON padded with spaces to the reserved size.
+    """
+    encoded = json.dumps(header).encode('utf-8')
+    if len(encoded) > header_size:
+        raise ValueError(f'The scan header ({len(encoded)} bytes) does not fit into {header_size} bytes!')
+    return encoded.ljust(header_size, b' ')
+
+
+def channel_name(name, channel=0):
+    """
+    Returns the name of an array of a spectrometer channel: the name itself for the first channel, name_<channel> for the others.
+    """
+    return name if channel == 0 else f'{name}_{channel}'
+
+
+def create_scan(path, shape, wavelengths, position_size=1, metadata=None, fields=None, channels=None):
+    """
+    Creates a scan file sized for the whole scan.
+
+    Args:
+    path (str): The path of the scan file.
+    shape (tuple): The grid shape of the scan, e.g. (number of positions,) or (nx, ny).
+    wavelengths (array): The wavelengths of the spectrometer.
+    position_size (int): 1 for 1D scans (one position per point), 2 for 2D scans (x and y per point) (default is 1).
+    metadata (dict): The header metadata (default is None).
+    fields (dict): Additional per-point arrays by name and dtype, e.g. {'integration_time': 'float64'} (default is None).
+    channels (list): The wavelengths of the other spectrometers; each gets wavelengths_<k>, intensities_<k>, times_<k> and written_<k> arrays (default is None).
+
+    Returns:
+    scanStorage: The scan file opened for writing.
+    """
+    shape = tuple(np.atleast_1d(shape))
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    arrays = {'wavelengths': (wavelengths.shape, 'float64'),
+              'intensities': (shape + wavelengths.shape, 'float64'),
+              'positions': (shape if position_size == 1 else shape + (position_size,), 'float64'),
+              'times': (shape, 'float64'),
+              'written': (shape, 'uint8')}
+    channels = [np.asarray(channel, dtype=float) for channel in (channels or [])]
+    for k, channel in enumerate(channels, 1):
+        arrays[channel_name('wavelengths', k)] = (channel.shape, 'float64')
+        arrays[channel_name('intensities', k)] = (shape + channel.shape, 'float64')
+        arrays[channel_name('times', k)] = (shape, 'float64')
+        arrays[channel_name('written', k)] = (shape, 'uint8')
+    for name, dtype in (fields or {}).items():
+        arrays[name] = (shape, dtype)
+    storage = scanStorage.create(path, arrays, metadata)
+    storage['wavelengths'][:] = wavelengths
+    for k, channel in enumerate(channels, 1):
+        storage[channel_name('wavelengths', k)][:] = channel
+    return storage
+
+
+def load_scan(path):
+    """
+    Opens a saved scan read-only and memory-mapped. Nothing but the header is read until the arrays are accessed.
+
+    Args:
+    path (str): The path of the scan file.
+
+    Returns:
+    scanStorage: The scan file; e.g. scan['intensities'][scan['written'] == 1] are the measured spectra.
+    """
+    return scanStorage(path, mode='r')
@@ -0,0 +1,324 @@
+import threading
+import time
+
+import numpy as np
+
+from LinearStage import linearStage
+from Spectrometer import spectrometer
+from ScanEngine import scanEngine
+# Simulated linear stage and spectrometer, so that scans can run (and be benchmarked) without the hardware.
+#
+# simulatedGCSDevice implements the GCS commands linearStage uses, with trapezoidal motion profiles
+# (velocity, acceleration) and a settling time before an axis reports on target.
+# simulatedDatarecorder records the actual position of a sweep like the PI data recorder.
+# simulatedSpectrometer implements the seabreeze Spectrometer interface. It runs free (frames end every
+# integration time) and measures a synthetic gel: Gaussian bands along the vertical axis inside lanes
+# along the horizontal axis, each band with its own emission peak.
+
+
+class simulatedGCSDevice:
+    """
+    A class to simulate the C-843 controller with two M-404.8PD stages.
+
+    Attributes:
+    velocity (dict): The velocity of each axis in mm/s.
+    acceleration (float): The acceleration (and deceleration) of the axes in mm/s^2.
+    settle_time (float): The time after the end of a move until the axis is on target, in seconds.
+
+    Methods:
+    position(axis, t=None): Returns the position of an axis at a given time.
+    The GCS commands used by linearStage (MOV, qPOS, qONT, IsMoving, VEL, qVEL, StopAll, ...).
+    """
+    axes = ['1', '2']
+
+    def __init__(self, velocity=1.5, acceleration=20, settle_time=0.05, travel=(0, 200), position=(52, 100)):
+        """
+        Initializes the simulated controller.
+
+        Args:
+        velocity (float): The velocity of both axes in mm/s (default is 1.5).
+        acceleration (float): The acceleration of both axes in mm/s^2 (default is 20).
+        settle_time (float): The settling time in seconds (default is 0.05).
+        travel (tuple): The travel range of both axes (default is (0, 200)).
+        position (tuple): The initial positions of the axes '1' and '2' (default is (52, 100), in the first lane).
+        """
+        self.velocity = {axis: float(velocity) for axis in self.axes}
+        self.acceleration = float(acceleration)
+        self.settle_time = float(settle_time)
+        self.travel = travel
+        self.recorders = [] # armed data recorders, triggered by the next MOV
+        self._lock = threading.Lock()
+        now = time.time()
+        # the motion history of each axis as (start time, start position, target, velocity); the last one is the current move
+        self._moves = {axis: [(now, float(p), float(p), self.velocity[axis])] for axis, p in zip(self.axes, position)}
+
+    def _axes(self, axes):
+        if axes is None:
+            return list(self.axes)
+        return [axes] if isinstance(axes, str) else list(axes)
+
+    def _profile(self, move, t):
+        """
+        Returns the position and the end time of a trapezoidal move at time t.
+        """
+        t0, start, target, velocity = move
+        distance = abs(target - start)
+        a = self.acceleration
+        if distance < velocity**2 / a: # triangular profile, the full velocity is never reached
+            t_acc = np.sqrt(distance / a)
+            t_total = 2 * t_acc
+            velocity = a * t_acc
+        else:
+            t_acc = velocity / a
+            t_total = distance / velocity + t_acc
+        dt = min(max(t - t0, 0), t_total)
+        if dt < t_acc:
+            s = 0.5 * a * dt**2
+        elif dt < t_total - t_acc:
+            s = 0.5 * a * t_acc**2 + velocity * (dt - t_acc)
+        else:
+            s = distance - 0.5 * a * (t_total - dt)**2
+        return start + np.sign(target - start) * s, t0 + t_total
+
+    def position(self, axis, t=None):
+        """
+        Returns the position of an axis at a given time.
+
+        Args:
+        axis (str): The axis.
+        t (float): The time (time.time() scale) (default is None, now).
+
+        Returns:
+        float: The position of the axis.
+        """
+        t = time.time() if t is None else t
+        moves = self._moves[axis]
+        for move in reversed(moves): # the move that was running at time t
+            if move[0] <= t:
+                return float(self._profile(move, t)[0])
+        return moves[0][1]
+
+    # GCS commands
+    def ConnectPciBoard(self, board=1):
+        pass
+
+    def qIDN(self):
+        return 'Simulated C-843 (Simulation.py)\n'
+
+    def qCST(self, axes=None):
+        return {axis: 'M-404.8PD' for axis in self._axes(axes)}
+
+    def qFRF(self, axes=None):
+        return {axis: True for axis in self._axes(axes)}
+
+    def SVO(self, axes, values):
+        pass
+
+    def qTMN(self, axes=None):
+        return {axis: float(self.travel[0]) for axis in self._axes(axes)}
+
+    def qTMX(self, axes=None):
+        return {axis: float(self.travel[1]) for axis in self._axes(axes)}
+
+    def qPOS(self, axes=None):
+        now = time.time()
+        return {axis: self.position(axis, now) for axis in self._axes(axes)}
+
+    def qONT(self, axes=None):
+        now = time.time()
+        return {axis: now >= self._profile(self._moves[axis][-1], now)[1] + self.settle_time for axis in self._axes(axes)}
+
+    def IsMoving(self, axes=None):
+        now = time.time()
+        return {axis: now < self._profile(self._moves[axis][-1], now)[1] for axis in self._axes(axes)}
+
+    def MOV(self, axes, values):
+        axes = self._axes(axes)
+        values = np.atleast_1d(values).astype(float)
+        with self._lock:
+            now = time.time()
+            for recorder in self.recorders:
+                recorder.trigger(now)
+            self.recorders = []
+            for axis, target in zip(axes, values):
+                self._moves[axis].append((now, self.position(axis, now), float(target), self.velocity[axis]))
+
+    def VEL(self, axes, values):
+        for axis, velocity in zip(self._axes(axes), np.atleast_1d(values)):
+            self.velocity[axis] = float(velocity)
+
+    def qVEL(self, axes=None):
+        return {axis: self.velocity[axis] for axis in self._axes(axes)}
+
+    def StopAll(self, noraise=False):
+        with self._lock:
+            now = time.time()
+            for axis in self.axes:
+                position = self.position(axis, now)
+                self._moves[axis].append((now, position, position, self.velocity[axis]))
+
+
+class simulatedDatarecorder:
+    """
+    A class to simulate the PI data recorder recording the actual position of one axis.
+
+    Attributes:
+    numvalues (int): The number of samples to record.
+    samplefreq (float): The sampling frequency in Hz.
+
+    Methods:
+    arm(): Arms the recorder, it starts with the next MOV command of the device.
+    getdata(): Waits until all the samples are recorded and returns them.
+    """
+    def __init__(self, device, axis):
+        """
+        Args:
+        device (simulatedGCSDevice): The simulated controller.
+        axis (str): The recorded axis.
+        """
+        self.device = device
+        self.axis = axis
+        self.numvalues = 1024
+        self.samplefreq = 1000
+        self._start = None
+
+    def arm(self):
+        self.device.recorders.append(self)
+
+    def trigger(self, t):
+        self._start = t
+
+    def getdata(self):
+        """
+        Returns:
+        tuple: The header (with 'SAMPLE_TIME') and the recorded data (one list per recorded value).
+        """
+        sample_time = 1 / self.samplefreq
+        end = self._start + self.numvalues * sample_time
+        time.sleep(max(end - time.time(), 0)) # like the controller, the data is complete only at the end of the recording
+        positions = [self.device.position(self.axis, self._start + k * sample_time) for k in range(self.numvalues)]
+        return {'SAMPLE_TIME': sample_time}, [positions]
+
+
+class simulatedSpectrometer:
+    """
+    A class to simulate a free-running Ocean Optics spectrometer looking at a gel on the simulated stage.
+
+    Attributes:
+    max_intensity (float): The saturation level of the detector in counts.
+    bands (list): The bands of the gel as (vertical position, width, wavelength, spectral width, counts per second).
+    lanes (list): The lanes of the gel as (horizontal center, width); a band appears in every lane.
+
+    Methods:
+    integration_time_micros(int_T): Sets the integration time.
+    wavelengths(): Returns the wavelengths of the pixels.
+    intensities(): Waits for the next frame and returns its intensities.
+    spectrum(): Waits for the next frame and returns the wavelengths and intensities.
+    """
+    def __init__(self, stage=None, pixels=2048, wavelength_range=(200, 1100), max_intensity=65535, dark=1000,
+                 bands=None, lanes=None, seed=None):
+        """
+        Initializes the simulated spectrometer.
+
+        Args:
+        stage (simulatedGCSDevice): The simulated stage carrying the gel (default is None, the gel does not move).
+        pixels (int): The number of pixels (default is 2048).
+        wavelength_range (tuple): The wavelengths of the first and last pixels in nm (default is (200, 1100)).
+        max_intensity (float): The saturation level in counts (default is 65535).
+        dark (float): The dark level in counts (default is 1000).
+        bands (list): The bands of the gel (default is None, three bands between 100 and 125 mm).
+        lanes (list): The lanes of the gel (default is None, two lanes between 50 and 60 mm).
+        seed (int): The seed of the noise (default is None).
+        """
+        self.stage = stage
+        self._wavelengths = np.linspace(wavelength_range[0], wavelength_range[1], pixels)
+        self.max_intensity = float(max_intensity)
+        self.integration_time_micros_limits = (1000, 65000000) # like seabreeze, the shortest and longest integration time
+        self.dark = float(dark)
+        self.bands = bands if bands is not None else [(105, 0.8, 520, 15, 2e5), (110, 0.5, 580, 20, 6e4), (118, 1.2, 650, 25, 1.5e4)]
+        self.lanes = lanes if lanes is not None else [(52, 3), (58, 3)]
+        self._integration_time = 0.1
+        self._origin = time.time() # frames end at origin + k * integration time
+        self._last = None # end time of the last frame returned
+        self._random = np.random.default_rng(seed)
+
+    def __str__(self):
+        return 'simulatedSpectrometer'
+
+    def integration_time_micros(self, int_T):
+        self._integration_time = float(int_T) * 1e-6
+        self._origin = time.time() # the running frame is aborted
+
+    def wavelengths(self):
+        return self._wavelengths
+
+    def _signal(self, x, y):
+        """
+        Returns the spectrum of the gel (counts per second) at the positions x, y (arrays of samples within one integration).
+        """
+        lane = sum(np.exp(-0.5 * ((x - center) / (width / 2))**8) for center, width in self.lanes) # flat-topped lanes
+        signal = np.zeros_like(self._wavelengths)
+        for position, width, wavelength, spectral_width, rate in self.bands:
+            profile = np.mean(lane * np.exp(-0.5 * ((y - position) / width)**2)) # averaged over the motion during the integration
+            signal += rate * profile * np.exp(-0.5 * ((self._wavelengths - wavelength) / spectral_width)**2)
+        return signal
+
+    def intensities(self):
+        """
+        Waits for the end of the next frame and returns its intensities.
+
+        Returns:
+        array: The intensities in counts.
+        """
+        while True:
+            integration, origin = self._integration_time, self._origin
+            now = time.time()
+            end = origin + np.ceil((now - origin) / integration) * integration
+            if self._last is not None and end <= self._last + integration / 2: # each frame is returned only once
+                end = self._last + integration
+            time.sleep(max(end - now, 0))
+            if self._origin == origin: # otherwise the frame was aborted by setting the integration time, wait for the new one
+                break
+        self._last = end
+
+        samples = np.linspace(end - integration, end, 5) # stage positions during the integration
+        if self.stage is not None:
+            x = np.array([self.stage.position('1', t) for t in samples])
+            y = np.array([self.stage.position('2', t) for t in samples])
+        else:
+            x = y = np.full(len(samples), np.nan)
+        counts = self.dark + self._signal(x, y) * integration
+        counts = counts + self._random.normal(0, np.sqrt(counts)) # shot noise
+        return np.clip(counts, 0, self.max_intensity)
+
+    def spectrum(self):
+        """
+        Returns:
+        array: The wavelengths and intensities of the next frame.
+        """
+        return np.vstack((self._wavelengths, self.intensities()))
+
+
+def simulated_engine(integration_time=1e5, velocity=1.5, acceleration=20, settle_time=0.05, channels=1, **kwargs):
+    """
+    Creates a scan engine with a connected simulated stage and spectrometer.
+
+    Args:
+    integration_time (float): The integration time in microseconds (default is 1e5 (0.1 seconds)).
+    velocity, acceleration, settle_time (float): The motion profile of the stage, see simulatedGCSDevice.
+    channels (int): The number of spectrometers; the others cover 450-900 nm with 1024 pixels and free-run out of phase (default is 1).
+    kwargs: Passed to scanEngine (e.g. directory).
+
+    Returns:
+    scanEngine: The scan engine.
+    """
+    device = simulatedGCSDevice(velocity=velocity, acceleration=acceleration, settle_time=settle_time)
+    stage = linearStage(device=device, recorder=simulatedDatarecorder)
+    stage.connect_and_start()
+    specs = []
+    for channel in range(channels):
+        simulated = simulatedSpectrometer(device) if channel == 0 else simulatedSpectrometer(device, pixels=1024, wavelength_range=(450, 900))
+        spec = spectrometer(integration_time, device=simulated)
+        spec.connect()
+        specs.append(spec)
+    return scanEngine(integration_time, stage=stage, spec=specs, **kwargs)
@@ -0,0 +1,229 @@
+import threading
+
+import numpy as np
+# Processing of the spectra before they are stored.
+# spectralProcessor crops the spectra to a wavelength region of interest (leaving out the inactive
+# pixels at the edges of the detector), subtracts the dark spectrum, bins neighbouring pixels, divides
+# by a reference spectrum and converts to counts per second or normalizes. Everything runs in place
+# on buffers allocated once per thread, so processing a frame allocates nothing.
+# runningMean co-adds frames with Welford's algorithm, giving their mean and variance in one pass.
+
+
+class runningMean:
+    """
+    A class to co-add spectra into a running mean and variance (Welford's algorithm) on preallocated buffers.
+
+    Attributes:
+    count (int): The number of spectra added.
+    mean (array): The mean of the spectra.
+
+    Methods:
+    reset(): Starts over.
+    add(intensities): Adds a spectrum.
+    variance(): Returns the sample variance of each pixel.
+    """
+    def __init__(self, size):
+        """
+        Args:
+        size (int): The number of pixels of the spectra.
+        """
+        self.count = 0
+        self.mean = np.zeros(size)
+        self._squares = np.zeros(size) # sum of the squared differences from the mean
+        self._delta = np.empty(size)
+        self._scratch = np.empty(size)
+
+    def reset(self):
+        """
+        Starts over, keeping the buffers.
+        """
+        self.count = 0
+        self.mean[:] = 0
+        self._squares[:] = 0
+
+    def add(self, intensities):
+        """
+        Adds a spectrum to the mean and variance.
+
+        Args:
+        intensities (array): The intensities.
+        """
+        self.count += 1
+        np.subtract(intensities, self.mean, out=self._delta)
+        np.multiply(self._delta, 1 / self.count, out=self._scratch)
+        self.mean += self._scratch
+        np.subtract(intensities, self.mean, out=self._scratch) # the difference from the updated mean
+        self._scratch *= self._delta
+        self._squares += self._scratch
+
+    def variance(self):
+        """
+        Returns:
+        array: The sample variance of each pixel (zeros until two spectra are added).
+        """
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self._squares / (self.count - 1)
+
+
+class spectralProcessor:
+    """
+    A class to correct, crop and bin spectra in place.
+
+    The steps are: crop to the ROI, subtract the dark spectrum (once per co-added frame), bin the pixels
+    (sum), divide by the reference spectrum, convert to counts per second (if the exposure is given) and normalize.
+
+    Attributes:
+    raw_wavelengths (array): The wavelengths of all the pixels of the detector.
+    wavelengths (array): The wavelengths of the processed spectra (the mean wavelength of each bin).
+    roi (tuple): The (min, max) wavelengths in nm that are kept (None to keep all the pixels).
+    binning (int): The number of neighbouring pixels summed into one.
+    dark (array): The dark spectrum of all the pixels (None to not subtract it).
+    reference (array): The reference spectrum of all the pixels, e.g. of the light source without the gel (None to not divide by it).
+    reference_time (float): The integration time of the reference spectrum in microseconds.
+    normalize (str): None, 'max' or 'sum' to normalize the processed spectra.
+
+    Methods:
+    configure(roi=None, binning=1): Sets the ROI and the binning.
+    set_reference(reference, integration_time): Sets the reference spectrum.
+    process(intensities, frames=1, integration_time=None): Processes a spectrum.
+    units(per_second=False): Returns the units of the processed spectra.
+    """
+    def __init__(self, wavelengths, roi=None, binning=1):
+        """
+        Args:
+        wavelengths (array): The wavelengths of the pixels of the detector.
+        roi (tuple): The (min, max) wavelengths in nm to keep (default is None, keep all the pixels).
+        binning (int): The number of neighbouring pixels to sum (default is 1).
+        """
+        self.raw_wavelengths = np.asarray(wavelengths, dtype=float)
+        self.normalize = None
+        self.reference_time = None
+        self._dark = self._reference = None
+        self.configure(roi, binning)
+
+    def configure(self, roi=None, binning=1):
+        """
+        Sets the wavelength region of interest and the binning.
+
+        Args:
+        roi (tuple): The (min, max) wavelengths in nm to keep (default is None, keep all the pixels).
+        binning (int): The number of neighbouring pixels to sum (default is 1); the pixels left over at the end of the ROI are dropped.
+        """
+        first, last = 0, len(self.raw_wavelengths)
+        if roi is not None:
+            first = int(np.searchsorted(self.raw_wavelengths, roi[0]))
+            last = int(np.searchsorted(self.raw_wavelengths, roi[1], side='right'))
+        self.binning = max(int(binning), 1)
+        bins = (last - first) // self.binning
+        if bins < 1:
+            raise ValueError(f'The ROI {roi} holds less than one bin of {self.binning} pixels!')
+        self.roi = tuple(roi) if roi is not None else None
+        self.pixels = slice(first, first + bins * self.binning)
+        self.wavelengths = self.raw_wavelengths[self.pixels].reshape(bins, self.binning).mean(axis=1)
+        self._local = threading.local() # the buffers of each thread, allocated on first use
+        self._prepare()
+
+    @property
+    def dark(self):
+        return self._dark
+
+    @dark.setter
+    def dark(self, dark):
+        self._dark = None if dark is None else np.asarray(dark, dtype=float)
+        self._prepare()
+
+    @property
+    def reference(self):
+        return self._reference
+
+    def set_reference(self, reference, integration_time):
+        """
+        Sets the reference spectrum the processed spectra are divided by (None to stop dividing).
+
+        Args:
+        reference (array): The reference spectrum of all the pixels (raw, the dark spectrum is subtracted from it).
+        integration_time (float): Its integration time in microseconds.
+        """
+        self._reference = None if reference is None else np.asarray(reference, dtype=float)
+        self.reference_time = integration_time
+        self._prepare()
+
+    def _prepare(self):
+        """
+        Crops (and bins) the dark and reference spectra once, so that processing only uses ready arrays.
+        """
+        self._roi_dark = None if self._dark is None else np.ascontiguousarray(self._dark[self.pixels])
+        self._binned_reference = None
+        if self._reference is not None:
+            reference = self._reference[self.pixels] - (self._roi_dark if self._roi_dark is not None else 0)
+            reference = reference.reshape(-1, self.binning).sum(axis=1)
+            reference[reference <= 0] = np.nan # no light in the reference, no ratio
+            self._binned_reference = reference
+
+    def units(self, per_second=False):
+        """
+        Returns the units of the processed spectra.
+
+        Args:
+        per_second (bool): True if process() is given the exposure (default is False).
+
+        Returns:
+        str: 'normalized (max)' or 'normalized (sum)', 'ratio to the reference' (at its exposure when per_second),
+             'counts per second' or 'counts'.
+        """
+        if self.normalize is not None:
+            return f'normalized ({self.normalize})'
+        if self._binned_reference is not None:
+            return 'ratio to the reference'
+        return 'counts per second' if per_second else 'counts'
+
+    def _buffers(self):
+        """
+        Returns the buffers of the calling thread (the pipeline workers process frames at the same time).
+        """
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            size = self.pixels.stop - self.pixels.start
+            buffers = self._local.buffers = {'pixels': np.empty(size), 'scratch': np.empty(size),
+                                             'binned': np.empty(len(self.wavelengths))}
+        return buffers
+
+    def process(self, intensities, frames=1, integration_time=None):
+        """
+        Processes a spectrum in place on the buffers of the calling thread.
+
+        Args:
+        intensities (array): The raw intensities of all the pixels (summed over the co-added frames).
+        frames (int): The number of co-added frames (default is 1).
+        integration_time (float): The total exposure in microseconds; if given, the spectrum is converted to
+                                  counts per second (or scaled to the reference exposure) (default is None).
+
+        Returns:
+        array: The processed spectrum. It is overwritten by the next call from the same thread, copy it to keep it.
+        """
+        buffers = self._buffers()
+        pixels = buffers['pixels']
+        np.copyto(pixels, intensities[self.pixels], casting='unsafe')
+        if self._roi_dark is not None:
+            if frames == 1:
+                pixels -= self._roi_dark
+            else:
+                np.multiply(self._roi_dark, frames, out=buffers['scratch'])
+                pixels -= buffers['scratch']
+        if self.binning > 1:
+            data = buffers['binned']
+            np.sum(pixels.reshape(-1, self.binning), axis=1, out=data)
+        else:
+            data = pixels
+        if self._binned_reference is not None:
+            data /= self._binned_reference
+            if integration_time is not None:
+                data *= self.reference_time / integration_time # both per unit of time
+        elif integration_time is not None:
+            data *= 1e6 / integration_time # counts per second
+        if self.normalize == 'max':
+            data /= np.nanmax(data) # Normalize by maximum intensity (the pixels without reference light are NaN)
+        elif self.normalize == 'sum':
+            data /= np.nansum(data) # Normalize by the sum of intensities
+        return data
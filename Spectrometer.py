@@ -1,8 +1,27 @@
 import sys
-from seabreeze.spectrometers import Spectrometer, list_devices
-from LinearStage import linearStage
-import pandas as pd
+try:
+    from seabreeze.spectrometers import Spectrometer, list_devices
+except ImportError: # seabreeze is only needed for real spectrometers, the simulated one (Simulation.py) runs without it
+    Spectrometer = list_devices = None
 import time
+import threading
+from collections import deque
+
+import numpy as np
+
+from SpectralProcessing import spectralProcessor, runningMean # In-place correction, cropping and binning of the spectra
+
+def list_spectrometers():
+    """
+    Returns the serial numbers of the connected spectrometers.
+
+    Returns:
+    list: The serial numbers (empty if seabreeze is not installed or no spectrometer is connected).
+    """
+    if list_devices is None:
+        return []
+    return [device.serial_number for device in list_devices()]
+
 
 class spectrometer:
     """
@@ -10,48 +29,96 @@ class spectrometer:
 
     Attributes:
     integration_time (int): Integration time for the spectrometer in microseconds.
-    spec (Spectrometer): The spectrometer object used to measure the spectrum.
+    spec (Spectrometer): The spectrometer object used to measure the spectrum (or a simulated spectrometer).
     wavelengths (list): The wavelengths returned from the spectrometer.
     intensities (list): The intensity values corresponding to the wavelengths.
+    serial (str): The serial number of the spectrometer to connect to (None for the first available one).
+    frames (deque): The latest frames, oldest first, so that frames can be matched by time even when newer ones arrived.
+    frame (dict): The latest frame with its sequence number ('seq'), start and end timestamps ('start', 'end', in seconds since the epoch),
+                  the time spectrum() was called for it ('called'),
+                  'integration_time' (microseconds) and 'intensities'.
+    exposure_target (tuple): The window of the peak counts, as fractions of the detector range, that expose() aims for.
+    max_frames (int): The maximum number of frames expose() co-adds when the signal is weak.
+    time_budget (float): The longest exposure in seconds expose() spends on a point, the adjusting frames included;
+                         no more frames are co-added than fit into it.
+    processor (spectralProcessor): The dark/reference correction, ROI cropping and binning of the stored spectra.
+    min_signal (float): The band signal (peak above the median, as a fraction of the detector range) worth co-adding for.
 
     Methods:
-    connect(): Connects to the first available spectrometer and sets its integration time.
+    connect(): Connects to the spectrometer (the given serial number or the first available one) and sets its integration time.
     measure(normalize=False, method='max'): Measures the spectrum and optionally normalizes the intensities.
+    wait_for_frame(after=None, timeout=None, seq=None): Waits for the first frame that started integrating after a given time or frame.
+    restart(int_T=None, frames=None): Restarts the integration (with a new integration time) so that the next frame starts now.
+    release(): Resumes the background acquisition paused by restart(frames=...).
+    frames_since(after): Returns the frames that started integrating after a given time, without waiting.
+    start_acquisition(): Starts measuring continuously in a background thread.
+    stop_acquisition(): Stops the background measurement.
     set_integration_time(int_T): Sets a new integration time for the spectrometer.
+    average(frames, seq=None): Co-adds fresh frames into their mean and variance.
+    average_frame(frames, seq=None): Co-adds fresh frames into one frame with their mean and variance.
+    expose(after=None, max_integration_time=None): Auto-exposure: adapts the integration time and co-adds weak frames.
     """
-    def __init__(self, integration_time=100000):
+    def __init__(self, integration_time=100000, device=None, serial=None):
         """
         Initializes the spectrometer object.
 
         Args:
         integration_time (int): The integration time in microseconds (default is 100000 (0.1 seconds)).
+        device: A device with the seabreeze Spectrometer interface to use instead of the first available one,
+                e.g. Simulation.simulatedSpectrometer (default is None).
+        serial (str): The serial number of the spectrometer, see list_spectrometers() (default is None, the first available one).
         """
         self.integration_time = integration_time
+        self.device = device
+        self.serial = serial
         self.spec = None # Placeholder for the Spectrometer object
         self.wavelengths = None # Placeholder for the wavelengths measured
         self.intensities = None # Placeholder for the intensity values measured
+        self.processor = None # Placeholder for the processing of the spectra, set up for the wavelengths of the device
+        self.frame = None # Placeholder for the latest frame (sequence number, timestamps and intensities)
+        self.frame_count = 0 # Sequence number of the latest frame
+        self.frames = deque(maxlen=32) # The latest frames, the frame queue of this spectrometer
+        self._frame_condition = threading.Condition() # Notifies the threads waiting for a new frame
+        self._acquisition = None # Background thread measuring continuously
+        self._acquiring = False # Keeps the background thread running
+        self._applied = integration_time # The integration time of the frames being measured
+        self._pending = None # An integration time to apply before the next frame of the background thread
+        self._restart = None # Asks the background thread to restart the integration before its next frame: (integration time, frames)
+        self._hold = None # The sequence number of the frame after which the background thread pauses until the next restart
+        self._changed = 0 # The sequence number of the last frame before the integration time was last applied
+        self.exposure_target = (0.5, 0.85) # Peak counts between 50 and 85 % of the detector range
+        self.max_frames = 4
+        self.time_budget = 1.0
+        self.min_signal = 0.05
         # if self.spec is not None:
         #     self.wavelengths = self.spec.wavelengths() # returns in an array, in nm
         #     self.intensities = self.spec.intensities() # in a.u
         #     # Pixels at the start and end of the array might not be optically active so interpret their returned measurements with care.!!
     def connect(self):
-         """
-        Connects to the first available spectrometer and sets its integration time.
+        """
+        Connects to the spectrometer with the given serial number (or the first available one) and sets its integration time.
 
         If no spectrometer is found, the program exits with an error message.
         """
         try:
             # Connect to the first available spectrometer and set the integration time
-            self.spec = Spectrometer.from_first_available()
+            if self.device is not None:
+                self.spec = self.device
+            elif self.serial is not None:
+                self.spec = Spectrometer.from_serial_number(self.serial)
+            else:
+                self.spec = Spectrometer.from_first_available()
             self.spec.integration_time_micros(self.integration_time) # Set integration time in microseconds
+            self._applied = self.integration_time
             print(f'Connected to {self.spec}') # Notify that the connection was successful
             self.wavelengths = self.spec.wavelengths() # Fetch the wavelength range from the spectrometer
+            self.processor = spectralProcessor(self.wavelengths)
         except:
             print('No connected spectrometer is found!')
             sys.exit()  # Exit the program if no spectrometer is found
 
     def measure(self, normalize = False, method = 'max'):
-         """
+        """
         Measures the spectrum from the connected spectrometer.
 
         Args:
@@ -60,26 +127,295 @@ class spectrometer:
 
         Sets:
         intensities (list): The raw or normalized intensity values measured by the spectrometer.
+        frame (dict): The sequence number, start/end timestamps and intensities of the new frame.
         """
+        integration_time = self._applied
+        called = time.time()
         wavelengths, intensities = self.spec.spectrum() # Get the spectrum (wavelengths and intensities)
+        end = time.time() # the spectrum is read out right after its integration window closes
+        start = end - integration_time*1e-6 # so it started integrating one integration time earlier
         # Normalize the intensities if required
         if normalize:
             if method == 'max':
-                normalized_intensity = intensities / max(intensities) # Normalize by maximum intensity
+                normalized_intensity = intensities / intensities.max() # Normalize by maximum intensity
 
             if method == 'sum':
-                normalized_intensity = intensities / sum(intensities) # Normalize by the sum of intensities
+                normalized_intensity = intensities / intensities.sum() # Normalize by the sum of intensities
             self.intensities = normalized_intensity
         else:
             self.intensities = intensities # Use raw intensities without normalization
 
+        # Publish the new frame and wake up the threads waiting for it
+        with self._frame_condition:
+            self.frame_count += 1
+            self.frame = {'seq': self.frame_count, 'called': called, 'start': start, 'end': end, 'integration_time': integration_time,
+                          'intensities': self.intensities}
+            self.frames.append(self.frame)
+            self._frame_condition.notify_all()
+
         # return df
+    def wait_for_frame(self, after=None, timeout=None, seq=None):
+        """
+        Waits for the first frame that started integrating after a given time or after a given frame.
+
+        The frames are produced by a thread that calls measure() continuously (e.g. update_data in Gelscanner.py).
+        The start of a frame is computed from its readout, so it is late by the readout latency: to be sure that a
+        frame started after an event, restart() the integration at the event and wait for the frames after the one it returns.
+
+        Args:
+        after (float): The time (time.time()) after which the frame must have started integrating (default is None, any time).
+        timeout (float): The maximum time to wait in seconds (default is None, wait forever).
+        seq (int): The sequence number of the frame after which the frame must have started, e.g. from restart() (default is None, any frame).
+
+        Returns:
+        dict: The frame ('seq', 'start', 'end', 'intensities'), or None if no such frame arrived within the timeout.
+        """
+        def fresh(frame):
+            return (after is None or frame['start'] > after) and (seq is None or frame['seq'] > seq)
+        with self._frame_condition:
+            found = self._frame_condition.wait_for(lambda: self.frame is not None and fresh(self.frame), timeout=timeout)
+            if not found:
+                return None
+            for frame in self.frames: # the first one, even if newer frames arrived in the meantime
+                if fresh(frame):
+                    return frame
+
+    def restart(self, int_T=None, frames=None):
+        """
+        Restarts the integration by setting the integration time (Ocean Optics spectrometers restart the
+        integration when it is set), so that the next frame starts integrating now and not before, e.g. before the stage settled.
+
+        While the background acquisition runs, the device is only called by its thread: the restart is applied
+        as soon as the frame being read out has arrived (right away if the acquisition is paused), and restart() waits for it.
+        With frames, the acquisition pauses after that many frames until the next restart (or release()), so that
+        no frame is being read out when the next restart comes, e.g. after the next move or after checking the exposure.
+
+        Args:
+        int_T (float): The integration time in microseconds to apply with the restart (default is None, keep the current one).
+        frames (int): The number of frames after which the background acquisition pauses (default is None, it does not pause).
+
+        Returns:
+        int: The sequence number of the last frame before the restart; the later frames started after it.
+        """
+        if int_T is not None:
+            self.integration_time = int_T
+        int_T = (self._pending or self._applied) if int_T is None else int_T
+        if self._acquisition is None:
+            self._apply_integration_time(int_T)
+            return self._changed
+        with self._frame_condition:
+            self._restart = (int_T, frames)
+            self._frame_condition.notify_all() # wakes up the paused acquisition
+            if not self._frame_condition.wait_for(lambda: self._restart is None, timeout=3*self._applied*1e-6 + 1):
+                return self.frame_count + 1 # no frame arrived, do not use the one that is being read out
+            return self._changed
+
+    def release(self):
+        """
+        Resumes the background acquisition paused by restart(frames=...), e.g. at the end of a scan.
+        """
+        with self._frame_condition:
+            self._hold = None
+            self._frame_condition.notify_all()
+
+    def frames_since(self, after):
+        """
+        Returns the frames of the frame queue that started integrating after a given time, without waiting.
+
+        Args:
+        after (float): The time (time.time()).
+
+        Returns:
+        list: The frames, oldest first.
+        """
+        with self._frame_condition:
+            return [frame for frame in self.frames if frame['start'] > after]
+
+    def start_acquisition(self):
+        """
+        Starts measuring continuously in a background thread, so that there is always a fresh frame to wait for.
+        Does nothing if the acquisition is already running.
+        """
+        if self._acquisition is not None:
+            return
+        self._acquiring = True
+        self._acquisition = threading.Thread(target=self._acquire, daemon=True) # does not keep the program alive
+        self._acquisition.start()
+
+    def _acquire(self):
+        """
+        Measures back-to-back until the acquisition is stopped, pausing after the frame given by restart(frames=...).
+        A new integration time or a restart is applied between two frames, so that every frame knows its own integration time
+        and the device is never called while it is being read out.
+        """
+        def paused():
+            return self._hold is not None and self.frame_count >= self._hold
+        while self._acquiring:
+            with self._frame_condition:
+                self._frame_condition.wait_for(lambda: not self._acquiring or self._restart is not None or not paused())
+                restart = self._restart
+            if not self._acquiring:
+                break
+            if restart is not None:
+                int_T, frames = restart
+                self._pending = None # applied with the restart
+                self._apply_integration_time(int_T)
+                with self._frame_condition:
+                    self._restart = None
+                    self._hold = None if frames is None else self._changed + frames
+                    self._frame_condition.notify_all() # wakes up restart()
+            elif self._pending is not None:
+                int_T, self._pending = self._pending, None
+                self._apply_integration_time(int_T)
+            self.measure()
+
+    def stop_acquisition(self):
+        """
+        Stops the background measurement after the current frame.
+        """
+        if self._acquisition is None:
+            return
+        with self._frame_condition:
+            self._acquiring = False
+            self._frame_condition.notify_all() # wakes up the paused acquisition
+        self._acquisition.join()
+        self._acquisition = None
+
     def set_integration_time(self, int_T):
-         """
+        """
         Sets the integration time for the spectrometer.
 
+        While the background acquisition runs, the new integration time is applied before its next frame
+        (use restart(int_T) to apply it right away, without waiting for the running frame).
+
         Args:
         int_T (int): The integration time in microseconds.
         """
-        self.spec.integration_time_micros(int_T) # Set the new integration time
         self.integration_time = int_T # Update the integration time attribute
+        if self._acquisition is not None:
+            self._pending = int_T
+        else:
+            self._apply_integration_time(int_T)
+
+    def _apply_integration_time(self, int_T):
+        """
+        Sets the integration time of the device (between two frames of the background acquisition).
+        """
+        self.spec.integration_time_micros(int_T) # Set the new integration time
+        self._applied = int_T
+        self._changed = self.frame_count # the frames after this one have the new integration time
+
+    def _fresh_frame(self, after, seq, int_T):
+        """
+        Waits for the first frame that started after a given time and frame, and after the integration time was set to int_T.
+        """
+        deadline = time.time() + 3*int_T*1e-6 + 1 # at most two integrations plus some slack for the readout
+        while True:
+            frame = self.wait_for_frame(after, timeout=max(deadline - time.time(), 0), seq=max(seq or 0, self._changed))
+            if frame is None or frame['integration_time'] == int_T:
+                return frame
+            seq = frame['seq'] # a frame that was already running when the integration time changed
+
+    def average(self, frames, seq=None):
+        """
+        Co-adds fresh frames into their running mean and variance, e.g. for the dark and reference spectra.
+
+        Args:
+        frames (int): The number of frames.
+        seq (int): The sequence number of the frame after which the first frame must have started (default is None, restart() now).
+
+        Returns:
+        tuple: The mean and the variance of each pixel, or None if the frames stopped arriving.
+        """
+        frame = self.average_frame(frames, seq)
+        if frame is None:
+            return None
+        return frame['intensities'], frame['variance']
+
+    def average_frame(self, frames, seq=None):
+        """
+        Co-adds fresh frames into one frame with their running mean and variance, e.g. to average the frames of a scan point.
+
+        Args:
+        frames (int): The number of frames.
+        seq (int): The sequence number of the frame after which the first frame must have started (default is None, restart() now).
+
+        Returns:
+        dict: The averaged frame ('called' and 'start' of the first frame, 'end' and 'seq' of the last one, 'integration_time'
+              of one frame, 'frames', the mean 'intensities' and their 'variance'), or None if the frames stopped arriving.
+        """
+        stats = runningMean(len(self.wavelengths))
+        seq = self.restart() if seq is None else seq
+        first = None
+        for _ in range(frames):
+            frame = self._fresh_frame(None, seq, self._applied)
+            if frame is None:
+                return None
+            first = frame if first is None else first
+            stats.add(frame['intensities'])
+            seq = frame['seq'] # the next frame is the one right after this one
+        return {'seq': frame['seq'], 'called': first['called'], 'start': first['start'], 'end': frame['end'],
+                'integration_time': frame['integration_time'], 'frames': frames, 'intensities': stats.mean, 'variance': stats.variance()}
+
+    def expose(self, after=None, max_integration_time=None):
+        """
+        Measures one point with auto-exposure.
+
+        Starting from the current integration time, the integration time is scaled until the peak counts are
+        inside exposure_target: the shortest integration time that uses the detector range well and does not
+        saturate. The integration time is kept for the next point, whose spectrum is usually similar.
+        When the peak stays below the window at the longest integration time and there is a band signal,
+        up to max_frames frames are co-added, as many as fit into time_budget.
+
+        Every frame is restarted with its integration time, and the background acquisition pauses after it while
+        its exposure is checked, so that a new integration time never waits for a frame that is being read out.
+        The acquisition stays paused after the point until the next restart() or release().
+
+        Args:
+        after (float): The time (time.time()) after which the frames must have started integrating (default is None, any time).
+        max_integration_time (float): The longest integration time of a frame in microseconds (default is None, the limit of the device).
+
+        Returns:
+        dict: The co-added frame ('called' and 'start' of the first frame, 'end' of the last one, 'integration_time' of one frame,
+              'frames', 'intensities' summed over the frames), or None if no frame arrived.
+        """
+        low_limit, high_limit = getattr(self.spec, 'integration_time_micros_limits', (1000, 65e6))
+        high_limit = min(high_limit, max_integration_time or high_limit)
+        detector = float(getattr(self.spec, 'max_intensity', 65535)) # the saturation level in counts
+        low, high = self.exposure_target
+        int_T = min(max(self.integration_time, low_limit), high_limit)
+        spent = 0 # the exposure time of the point so far in seconds
+        while True:
+            frame = self._fresh_frame(after, self.restart(int_T, frames=1), int_T)
+            if frame is None:
+                return None
+            spent += int_T*1e-6
+            intensities = np.asarray(frame['intensities'], dtype=float)
+            peak = intensities.max() / detector
+            if low <= peak <= high:
+                break
+            scale = (low + high) / 2 / max(peak, 1e-3)
+            if peak >= 0.99:
+                scale /= 2 # saturated, the true peak is higher than measured
+            new = min(max(int_T * scale, low_limit), high_limit)
+            if abs(new - int_T) < 0.05 * int_T: # the limits of the device are reached
+                break
+            int_T = new
+
+        frames = 1
+        signal = (intensities.max() - np.median(intensities)) / detector
+        if peak < low and signal > self.min_signal: # a weak band: co-add more frames, as many as the time budget allows
+            fit = int((self.time_budget - spent) / (int_T*1e-6) + 1e-9)
+            frames = int(min(self.max_frames, np.ceil(low / peak), 1 + max(fit, 0)))
+        total = intensities.copy()
+        first = frame
+        if frames > 1:
+            seq = self.restart(int_T, frames=frames - 1)
+            for _ in range(frames - 1):
+                frame = self._fresh_frame(None, seq, int_T)
+                if frame is None:
+                    return None
+                total += frame['intensities']
+                seq = frame['seq']
+        return {'seq': frame['seq'], 'called': first['called'], 'start': first['start'], 'end': frame['end'], 'integration_time': int_T,
+                'frames': frames, 'intensities': total}
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the modules are at the top level of the repository
+
+from Simulation import simulated_engine # Simulated stage and spectrometer
+# Shared fixtures of the tests.
+# The scans run on the simulated devices with a fast stage and short integrations, so that every
+# scan mode can be checked in a few seconds without hardware.
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """
+    A scan engine on the simulated devices saving to a temporary directory; the devices are stopped afterwards.
+    """
+    engine = simulated_engine(5e3, velocity=20, acceleration=500, settle_time=0.005, directory=str(tmp_path))
+    engine.connect()
+    yield engine
+    for S in engine.spectrometers:
+        S.stop_acquisition()
+    engine.stage.stop_polling()
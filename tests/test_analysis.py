@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import Analysis
+import ScanStorage
+# The offline analysis of saved scans: baseline removal, Gaussian fits and band detection.
+
+
+def gaussian(x, center, fwhm, height):
+    return height * np.exp(-4 * np.log(2) * (x - center)**2 / fwhm**2)
+
+
+def test_fit_peak():
+    x = np.linspace(100, 110, 41)
+    fit = Analysis.fit_peak(x, gaussian(x, 104.3, 1.7, 250))
+    assert fit['center'] == pytest.approx(104.3) and fit['fwhm'] == pytest.approx(1.7, rel=1e-3)
+    assert fit['height'] == pytest.approx(250) and fit['area'] == pytest.approx(250 * 1.7 * 1.0645, rel=1e-3)
+    assert Analysis.fit_peak(x, -gaussian(x, 104.3, 1.7, 250)) is None # not a peak
+
+
+def test_remove_baseline():
+    wavelengths = np.linspace(200, 1100, 2048)
+    baseline = 1000 + 0.5 * (wavelengths - 200) # a slow slope under a narrow emission peak
+    spectra = np.array([baseline + gaussian(wavelengths, 520, 15, 3000), baseline])
+    removed = Analysis.remove_baseline(spectra, window=101)
+    assert removed.shape == spectra.shape
+    assert np.abs(removed[1]).max() < 30 # no peak, (almost) nothing left
+    assert removed[0].max() == pytest.approx(3000, rel=0.05) # the peak is kept
+    assert np.abs(removed[0][np.abs(wavelengths - 520) > 100]).max() < 30
+
+
+def test_detect_bands():
+    rng = np.random.default_rng(0)
+    positions = np.sort(rng.uniform(100, 125, 200)) # e.g. the non-uniform grid of an adaptive scan
+    signal = 50 + gaussian(positions, 105, 0.8, 1000) + gaussian(positions, 110, 0.5, 300) + gaussian(positions, 118, 1.2, 120)
+    bands = Analysis.detect_bands(positions[::-1], signal[::-1], threshold=0.05) # in any order
+    assert [band['position'] for band in bands] == pytest.approx([105, 110, 118], abs=0.05) # highest first
+    assert [band['fwhm'] for band in bands] == pytest.approx([0.8, 0.5, 1.2], rel=0.1)
+    assert len(Analysis.detect_bands(positions, signal, threshold=0.5)) == 1
+    assert Analysis.detect_bands(positions, np.full(200, 50.0)) == []
+
+
+def test_analyze(tmp_path):
+    path = str(tmp_path / 'line.gscan')
+    wavelengths = np.linspace(400, 700, 301)
+    positions = np.arange(100, 120, 0.25)
+    storage = ScanStorage.create_scan(path, len(positions), wavelengths, metadata={'mode': 'step'})
+    for k, y in enumerate(positions): # two bands with their own emission peaks on a constant offset
+        spectrum = 1000 + gaussian(wavelengths, 520, 15, gaussian(y, 105, 0.8, 2000)) + gaussian(wavelengths, 580, 20, gaussian(y, 110, 0.5, 800))
+        storage.write(k, intensities=spectrum, positions=y)
+    storage.close(points=len(positions))
+    result = Analysis.analyze(path)
+    assert result['points'] == len(positions)
+    bands = result['bands']
+    assert [band['position'] for band in bands] == pytest.approx([105, 110], abs=0.05)
+    assert [band['wavelength'] for band in bands] == pytest.approx([520, 580], abs=1.5)
+
+
+def test_baseline_without_offset():
+    rng = np.random.default_rng(1)
+    wavelengths = np.linspace(200, 1100, 2048)
+    spectra = rng.normal(1000 + 0.1 * wavelengths, 30, size=(64, 2048)) # noise on a sloped dark level, no emission
+    spectra[:, 700:760] += gaussian(wavelengths[700:760], 520, 15, 300)[None] # and a weak peak in every spectrum
+    removed = Analysis.remove_baseline(spectra)
+    empty = np.abs(wavelengths - 520) > 100
+    assert abs(removed[:, empty].mean()) < 1 # the noise averages to zero, not to a positive floor
+    assert removed[:, 725:735].mean() == pytest.approx(gaussian(wavelengths[725:735], 520, 15, 300).mean(), rel=0.1)
+    profile = removed[:, empty].sum(axis=1) # pure noise: no bands
+    assert Analysis.detect_bands(np.arange(64), profile) == []
+
+
+def test_simulated_gel(engine):
+    count, path = engine.run(mode='step', start=100, stop=125, step=0.5, integration_time=2e4, name='gel')
+    result = Analysis.analyze(path)
+    bands = sorted(result['bands'], key=lambda band: band['position'])
+    assert [band['position'] for band in bands] == pytest.approx([105, 110, 118], abs=0.3) # the bands of the simulated gel, and only these
+    assert [band['wavelength'] for band in bands] == pytest.approx([520, 580, 650], abs=10) # with their emission peaks
@@ -0,0 +1,71 @@
+import os
+import time
+
+import numpy as np
+
+import ScanStorage
+from ScanCatalog import scanCatalog
+# The SQLite catalog of a measurement directory: unique names and queries by the header metadata.
+
+
+def _save(path, **metadata):
+    ScanStorage.create_scan(path, 2, np.arange(4.0), metadata=metadata).close(points=2)
+
+
+def test_allocate(tmp_path):
+    catalog = scanCatalog(str(tmp_path))
+    paths = [catalog.allocate('gel') for _ in range(3)]
+    assert [os.path.basename(path) for path in paths] == ['gel.gscan', 'gel_(1).gscan', 'gel_(2).gscan']
+    assert [row['name'] for row in catalog.find(status='running')] == ['gel', 'gel_(1)', 'gel_(2)']
+    assert len(catalog) == 0
+
+
+def test_find(tmp_path):
+    catalog = scanCatalog(str(tmp_path))
+    started = time.time()
+    for name, mode, step in (('a', 'step', 0.5), ('b', 'fly', 0.5), ('c', 'step', 1.0)):
+        path = catalog.allocate(name)
+        _save(path, mode=mode, step=step, **{'integration time [microseconds]': 1e5})
+        catalog.finish(path)
+    assert len(catalog) == 3
+    assert [row['name'] for row in catalog.find(mode='step')] == ['a', 'c']
+    assert [row['name'] for row in catalog.find(step=0.5)] == ['a', 'b']
+    assert [row['name'] for row in catalog.find(mode='step', step=1.0)] == ['c']
+    assert len(catalog.find(since=started)) == 3 and catalog.find(until=started - 1) == []
+    assert [row['name'] for row in catalog.find(metadata={'integration time [microseconds]': 1e5}, name='[ab]')] == ['a', 'b']
+    assert catalog.load('c').metadata['step'] == 1.0
+
+
+def test_rebuild(tmp_path):
+    catalog = scanCatalog(str(tmp_path))
+    path = catalog.allocate('gel')
+    _save(path, mode='raster')
+    catalog.finish(path)
+    catalog.allocate('unfinished')
+    path = catalog.allocate('failed')
+    ScanStorage.create_scan(path, 2, np.arange(4.0), metadata={'mode': 'step'}).close(points=1, failed=True)
+    catalog.finish(path, 'failed')
+    path = catalog.allocate('interrupted')
+    ScanStorage.create_scan(path, 2, np.arange(4.0), metadata={'mode': 'step'}).flush() # never closed with its number of points
+
+    os.remove(catalog.path) # a new catalog indexes the files that are already in the directory
+    rebuilt = scanCatalog(str(tmp_path))
+    assert [row['name'] for row in rebuilt.find(mode='raster')] == ['gel']
+    assert {row['name']: row['status'] for row in rebuilt.find(status=None)} == {'gel': 'complete', 'failed': 'failed',
+                                                                              'interrupted': 'running'}
+    assert os.path.basename(rebuilt.allocate('gel')) == 'gel_(1).gscan'
+    with rebuilt.load('gel') as scan:
+        assert scan['written'].sum() == 0
+    assert scan.arrays == {} # the file is closed
+
+
+def test_finish_failed(tmp_path):
+    catalog = scanCatalog(str(tmp_path))
+    never_created = catalog.allocate('lost')
+    catalog.finish(never_created, 'failed') # the scan failed before its file was created
+    assert catalog.find(status=None) == []
+    path = catalog.allocate('gel')
+    _save(path, mode='raster')
+    catalog.finish(path, 'failed')
+    assert [row['status'] for row in catalog.find(status=None)] == ['failed']
+    assert catalog.find() == [] and len(catalog) == 0
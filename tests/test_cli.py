@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+import GelscannerCLI
+# The command line: the arguments of a scan are checked before any device is connected.
+
+
+def test_raster_needs_horizontal_range(capsys):
+    with pytest.raises(SystemExit):
+        GelscannerCLI.parse_args(['--mode', 'raster', '--x-start', '50'])
+    assert '--x-stop' in capsys.readouterr().err
+    args = GelscannerCLI.parse_args(['--mode', 'raster', '--x-start', '50', '--x-stop', '60'])
+    assert (args.x_start, args.x_stop) == (50, 60)
+
+
+def test_queue_raster_needs_horizontal_range(tmp_path):
+    path = tmp_path / 'queue.json'
+    path.write_text(json.dumps([{'mode': 'step', 'name': 'a'}, {'mode': 'raster', 'x_start': 50, 'name': 'b'}]))
+    with pytest.raises(ValueError):
+        GelscannerCLI.load_queue([str(path)])
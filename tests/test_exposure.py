@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+import pytest
+
+import ScanStorage
+from LinearStage import linearStage
+from Simulation import simulatedGCSDevice, simulatedSpectrometer
+from Spectrometer import spectrometer
+# Auto-exposure: the integration time is scaled into the exposure target, weak points co-add frames,
+# and auto-exposed scans store counts per second.
+
+
+@pytest.fixture
+def band():
+    """
+    A stage on the strongest band of the simulated gel (105 mm, about 0.2 Mcounts per second) and a spectrometer looking at it.
+    """
+    device = simulatedGCSDevice(velocity=20, acceleration=500, settle_time=0.005)
+    stage = linearStage(device=device)
+    stage.connect_and_start()
+    stage.move(105, '2', wait=True)
+    spec = spectrometer(1e6, device=simulatedSpectrometer(device, seed=1))
+    spec.connect()
+    spec.start_acquisition()
+    yield spec
+    spec.stop_acquisition()
+
+
+def test_saturated_point(band):
+    low, high = band.exposure_target
+    frame = band.expose(time.time())
+    assert frame['frames'] == 1 and frame['integration_time'] < 1e6 # shorter than the saturating start
+    assert low <= frame['intensities'].max() / band.spec.max_intensity <= high
+    assert band.integration_time == frame['integration_time'] # kept for the next point
+
+
+def test_weak_point_coadds_frames(band):
+    after = time.time()
+    frame = band.expose(after, max_integration_time=6e4) # about 20 % of the detector range per frame
+    assert frame['integration_time'] == 6e4 and 1 < frame['frames'] <= band.max_frames
+    assert frame['start'] >= after and frame['end'] - frame['start'] > 0.9 * frame['frames'] * 6e4 * 1e-6
+    band.release() # the acquisition paused after the point
+    single = band.wait_for_frame(time.time(), timeout=1)['intensities']
+    assert frame['intensities'].max() == pytest.approx(frame['frames'] * single.max(), rel=0.1)
+
+
+def test_new_exposure_is_applied_with_the_restart(band):
+    band.expose() # the acquisition pauses after the point
+    seq = band.frame_count
+    band.integration_time = 1e6 # saturating
+    frame = band.expose()
+    measured = [f['integration_time'] for f in band.frames if f['seq'] > seq]
+    assert frame['frames'] == 1 and measured[-1] == frame['integration_time']
+    assert len(measured) == len(set(measured)) # one frame per integration time, no frame waited out at the old one
+
+
+def test_time_budget(band):
+    band.time_budget = 0.15 # one more frame of 60 ms after the first one
+    frame = band.expose(max_integration_time=6e4)
+    assert frame['integration_time'] == 6e4 and frame['frames'] == 2 < np.ceil(band.exposure_target[0] / 0.2)
+
+
+def test_counts_per_second(engine):
+    engine.dark = np.full(len(engine.spectrometer.wavelengths), engine.spectrometer.spec.dark)
+    count, fixed = engine.run(mode='step', start=105, stop=105, step=1, name='fixed')
+    count, auto = engine.run(mode='step', start=105, stop=105, step=1, integration_time=1e6, auto_exposure=True, name='auto')
+    fixed, auto = ScanStorage.load_scan(fixed), ScanStorage.load_scan(auto)
+    assert auto.metadata['units'] == 'counts per second' and (auto['frames'] >= 1).all()
+    assert auto['integration_time'][0] < 1e6 # the band needs less than the longest integration time
+    rate = fixed['intensities'][0].max() / (fixed.metadata['integration time [microseconds]'] * 1e-6)
+    assert auto['intensities'][0].max() == pytest.approx(rate, rel=0.1) # the same band in the same units
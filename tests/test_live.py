@@ -0,0 +1,32 @@
+import numpy as np
+
+from GuiRender import liveScanView
+# The live image of a running scan: the spectra of a line scan as heatmap rows, the band intensity of a
+# 2D scan on the grid.
+
+
+def test_line_scan():
+    view = liveScanView(width=64, height=32)
+    view.begin('line', (8,), np.linspace(400, 700, 256), extent=(100, 107))
+    assert view.bounds == ((400, 100), (700, 107)) and view.labels == ('Wavelength [nm]', 'Position')
+    black = view.texture.copy()
+    version = view.version
+    view.add(0, np.linspace(0, 1, 256), positions=100)
+    view.add(7, np.full(256, np.nan), positions=107) # e.g. a spectrum that could not be normalized
+    assert view.version == version + 2
+    assert view.texture[-4:, :, :3].any() # the first point at the bottom
+    assert not view.texture[:4, :, :3].any() # the NaN spectrum stays black at the top
+    np.testing.assert_array_equal(view.texture[8:24], black[8:24]) # not measured yet
+    assert (view.texture[..., 3] == 1).all()
+
+
+def test_map_scan():
+    view = liveScanView(width=40, height=20)
+    view.begin('map', (4, 2), np.arange(16.0), extent=((50, 53), (104, 105)))
+    assert view.bounds == ((50, 104), (53, 105))
+    view.add((3, 0), np.ones(16))
+    view.add((0, 1), 2 * np.ones(16))
+    assert view.texture[15:, 30:, :3].any() and view.texture[:10, :10, :3].any() # x to the right, y upwards
+    assert not view.texture[:10, 30:, :3].any() and not view.texture[15:, :10, :3].any()
+    view.begin('map', (4, 2), np.arange(16.0), extent=((50, 53), (104, 105))) # the next scan starts black
+    assert not view.texture[..., :3].any()
@@ -0,0 +1,47 @@
+import numpy as np
+
+import ScanPath
+# Path planning of the 2D scans and the refinement of the adaptive scans.
+
+
+def test_serpentine():
+    xs, ys = ScanPath.grid_axes((0, 2), (0, 2), 1)
+    points = ScanPath.raster_points(xs, ys)
+    columns = points[ScanPath.serpentine(points, fast_axis=1)]
+    assert columns.tolist() == [[0, 0], [0, 1], [0, 2], [1, 2], [1, 1], [1, 0], [2, 0], [2, 1], [2, 2]]
+    rows = points[ScanPath.serpentine(points, fast_axis=0)]
+    assert rows.tolist() == [[0, 0], [1, 0], [2, 0], [2, 1], [1, 1], [0, 1], [0, 2], [1, 2], [2, 2]]
+
+
+def test_nearest_neighbour_matches_exhaustive_search():
+    rng = np.random.default_rng(0)
+    xs, ys = ScanPath.grid_axes((0, 12), (0, 7), 0.5)
+    points = ScanPath.raster_points(xs, ys)
+    points = points[rng.random(len(points)) < 0.3]
+    start = (3.2, -1.0)
+    coords = np.column_stack((xs[points[:, 0]], ys[points[:, 1]]))
+    expected, remaining, current = [], list(range(len(points))), np.array(start)
+    for _ in range(len(points)): # the closest remaining point (Chebyshev distance), the first one of equally close points
+        nearest = min(remaining, key=lambda k: (np.abs(coords[k] - current).max(), k))
+        expected.append(nearest)
+        remaining.remove(nearest)
+        current = coords[nearest]
+    assert ScanPath.nearest_neighbour(points, xs, ys, start).tolist() == expected
+
+
+def test_plan_path_full_rectangle():
+    xs, ys = ScanPath.grid_axes((0, 4), (0, 9), 1)
+    points = ScanPath.raster_points(xs, ys)
+    path = ScanPath.plan_path(points, xs, ys, 'auto')
+    assert len(path) == len(points) and len(np.unique(path, axis=0)) == len(points)
+    steps = np.abs(np.diff(path, axis=0)).max(axis=1)
+    assert (steps == 1).all() # no dead travel
+
+
+def test_refine():
+    positions = [0, 1, 2, 3, 4]
+    signals = [0, 0, 10, 0, 0]
+    np.testing.assert_allclose(ScanPath.refine(positions, signals, threshold=0.05, min_step=0.25), [1.5, 2.5])
+    np.testing.assert_allclose(ScanPath.refine(positions[::-1], signals[::-1], min_step=0.25), [1.5, 2.5]) # in any order
+    assert len(ScanPath.refine(positions, signals, min_step=0.6)) == 0 # the halves would be closer than min_step
+    assert len(ScanPath.refine(positions, [1, 1, 1, 1, 1])) == 0 # no band
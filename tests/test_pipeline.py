@@ -0,0 +1,48 @@
+import threading
+
+import numpy as np
+import pytest
+
+import ScanStorage
+from ScanPipeline import scanPipeline
+# The worker pipeline of the scans: every submitted frame is processed and stored, and the errors of
+# the workers are raised by close().
+
+
+def test_process_and_store(tmp_path):
+    storage = ScanStorage.create_scan(str(tmp_path / 'scan.gscan'), 32, np.arange(8.0))
+    pipeline = scanPipeline(storage, process=lambda intensities, **values: intensities * 2, workers=3, maxsize=2)
+    for k in range(32):
+        pipeline.submit(k, np.full(8, float(k)), positions=100 + k)
+    pipeline.close() # waits for the queued frames
+    pipeline.close() # and does nothing more when called again
+    storage.close(points=32)
+    scan = ScanStorage.load_scan(storage.path)
+    assert (scan['written'] == 1).all()
+    np.testing.assert_allclose(scan['intensities'][:, 0], 2 * np.arange(32))
+    np.testing.assert_allclose(scan['positions'], 100 + np.arange(32))
+
+
+def test_channel_written_flags(tmp_path):
+    storage = ScanStorage.create_scan(str(tmp_path / 'scan.gscan'), 4, np.arange(8.0), channels=[np.arange(4.0)])
+    pipeline = scanPipeline(storage, process=lambda intensities, **values: intensities, workers=2)
+    for k in range(4):
+        pipeline.submit(k, np.ones(8), positions=100 + k)
+    pipeline.submit(1, np.ones(4), channel=1, times=12.0) # the other channel has a spectrum of one point only
+    pipeline.close()
+    np.testing.assert_array_equal(storage['written'], [1, 1, 1, 1])
+    np.testing.assert_array_equal(storage['written_1'], [0, 1, 0, 0])
+
+
+def test_worker_error(tmp_path):
+    def process(intensities, **values):
+        if intensities[0] == 3:
+            raise ValueError('bad frame')
+        return intensities
+    threads = threading.active_count()
+    pipeline = scanPipeline(None, process=process, workers=2)
+    for k in range(8):
+        pipeline.submit(k, np.full(4, float(k))) # the frames after the bad one are still taken from the queue
+    with pytest.raises(ValueError):
+        pipeline.close()
+    assert threading.active_count() == threads
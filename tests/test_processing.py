@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from SpectralProcessing import runningMean, spectralProcessor
+# The spectral processing of the stored spectra: ROI, binning, dark and reference correction,
+# exposure and normalization, and the running mean of co-added spectra.
+
+
+@pytest.fixture
+def processor():
+    return spectralProcessor(np.arange(400.0, 420.0)) # 20 pixels, 1 nm each
+
+
+def test_roi_and_binning(processor):
+    processor.configure(roi=(402, 410.5), binning=3)
+    np.testing.assert_allclose(processor.wavelengths, [403, 406, 409]) # the pixel left over at the end is dropped
+    np.testing.assert_allclose(processor.process(np.arange(20.0)), [9, 18, 27])
+    with pytest.raises(ValueError):
+        processor.configure(roi=(402, 403), binning=3)
+
+
+def test_dark_and_exposure(processor):
+    processor.dark = np.full(20, 100.0)
+    raw = 3 * 100 + np.arange(20.0) * 1000 # three co-added frames
+    np.testing.assert_allclose(processor.process(raw, frames=3), np.arange(20.0) * 1000)
+    np.testing.assert_allclose(processor.process(raw, frames=3, integration_time=5e5), np.arange(20.0) * 2000) # counts per second
+
+
+def test_reference_and_normalize(processor):
+    processor.dark = np.full(20, 100.0)
+    reference = 100 + np.linspace(1000, 2000, 20)
+    processor.set_reference(reference, integration_time=1e5)
+    sample = 100 + 0.5 * np.linspace(1000, 2000, 20) # half of the reference light through the whole spectrum
+    np.testing.assert_allclose(processor.process(sample), 0.5)
+    np.testing.assert_allclose(processor.process(200 + np.linspace(1000, 2000, 20), frames=2, integration_time=2e5), 0.5) # per unit of time
+    processor.normalize = 'max'
+    processor.set_reference(None, None)
+    spectrum = processor.process(100 + np.arange(20.0)).copy()
+    assert spectrum.max() == 1 and spectrum[0] == 0
+    processor.normalize = 'sum'
+    assert processor.process(100 + np.arange(20.0)).sum() == pytest.approx(1)
+    reference[:5] = 100 # no light in the reference at the first pixels
+    processor.set_reference(reference, integration_time=1e5)
+    spectrum = processor.process(sample)
+    assert np.isnan(spectrum[:5]).all() and np.nansum(spectrum) == pytest.approx(1) # only the pixels without a ratio are NaN
+
+
+def test_units(processor):
+    assert processor.units() == 'counts' and processor.units(per_second=True) == 'counts per second'
+    processor.set_reference(np.ones(20), integration_time=1e5)
+    assert processor.units(per_second=True) == 'ratio to the reference'
+    processor.normalize = 'sum'
+    assert processor.units() == 'normalized (sum)'
+
+
+def test_running_mean():
+    rng = np.random.default_rng(0)
+    spectra = rng.normal(10, 2, size=(50, 8))
+    mean = runningMean(8)
+    for spectrum in spectra:
+        mean.add(spectrum)
+    assert mean.count == 50
+    np.testing.assert_allclose(mean.mean, spectra.mean(axis=0))
+    np.testing.assert_allclose(mean.variance(), spectra.var(axis=0, ddof=1))
@@ -0,0 +1,53 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+from Profiling import phaseTimer
+# The per-step timing of the scans: the ring buffer of phase durations and its summary.
+
+
+def test_ring_buffer():
+    timer = phaseTimer(phases=('move', 'wait'), size=4)
+    for step in range(6):
+        timer.record(step, 'move', 0.001 * step)
+        if step % 2:
+            timer.record(step, 'wait', 0.002)
+        timer.step_done(step)
+    assert timer.steps == 6
+    assert timer.latest() == pytest.approx({'move': 0.005, 'wait': 0.002})
+    summary = timer.summary(bins=2)
+    assert summary['phases']['move']['count'] == 4 # only the last size steps are kept
+    assert summary['phases']['move']['max'] == pytest.approx(5) and summary['phases']['move']['p50'] == pytest.approx(3.5)
+    assert summary['phases']['wait']['count'] == 2 # NaN where a phase is not recorded
+    assert sum(summary['phases']['wait']['histogram']['counts']) == 2
+    assert phaseTimer().rate() == 0.0 and phaseTimer().latest() == {}
+
+
+def test_scan_profile(engine):
+    count, path = engine.run(mode='step', start=104, stop=106, step=0.5, name='timed')
+    phases = engine.timer.summary()['phases']
+    for phase in ('command', 'move', 'settle', 'wait', 'spectrum', 'handover', 'submit', 'store', 'step'):
+        assert phases[phase]['count'] >= count - 1, phase
+    with open(os.path.splitext(path)[0] + '-profile.json') as file:
+        saved = json.load(file)
+    assert saved['steps'] == count and np.isclose(saved['phases']['move']['p50'], phases['move']['p50'])
+
+
+def test_device_calls_are_timed(engine, monkeypatch):
+    spectrum, MOV = engine.spectrometer.spec.spectrum, engine.stage.pidevice.MOV
+    def slow_spectrum(): # a readout of 20 ms
+        result = spectrum()
+        time.sleep(0.02)
+        return result
+    def slow_MOV(*args, **kwargs): # a move command taking 10 ms
+        time.sleep(0.01)
+        return MOV(*args, **kwargs)
+    monkeypatch.setattr(engine.spectrometer.spec, 'spectrum', slow_spectrum)
+    monkeypatch.setattr(engine.stage.pidevice, 'MOV', slow_MOV)
+    engine.run(mode='step', start=104, stop=106, step=0.5, integration_time=2e4)
+    phases = engine.timer.summary()['phases']
+    assert phases['command']['p50'] >= 10
+    assert phases['spectrum']['p50'] >= 20 + 20 # the integration after the restart and the readout
@@ -0,0 +1,53 @@
+import time
+
+import numpy as np
+
+from GuiRender import decimate, renderScheduler
+# Rate-limited rendering of the GUI: decimation of the spectra and redraws only on changes.
+
+
+def test_decimate_keeps_peaks():
+    x = np.arange(10000.0)
+    y = np.zeros(10000)
+    y[4321] = 5 # a one-pixel peak
+    y[77] = -3
+    dx, dy = decimate(x, y, 100)
+    assert len(dx) == len(dy) == 200
+    assert dy.max() == 5 and dy.min() == -3
+    short = np.arange(50.0)
+    np.testing.assert_array_equal(decimate(short, short, 100)[1], short) # short enough, kept as it is
+
+
+def test_redraw_on_change():
+    state = {'version': 0}
+    drawn = []
+    scheduler = renderScheduler(fps=200)
+    scheduler.add(lambda: state['version'], lambda: drawn.append(state['version']))
+    scheduler.start()
+    try:
+        time.sleep(0.05)
+        assert drawn == [0] # drawn once, then only when the version changes
+        state['version'] = 1
+        time.sleep(0.05)
+        assert drawn == [0, 1]
+    finally:
+        scheduler.stop()
+
+
+def test_failing_redraw():
+    state = {'version': 0}
+    drawn = []
+    def broken():
+        raise TypeError('no frame yet')
+    scheduler = renderScheduler(fps=200)
+    scheduler.add(lambda: state['version'], broken)
+    scheduler.add(lambda: state['version'], lambda: drawn.append(state['version']))
+    scheduler.start()
+    try:
+        time.sleep(0.05)
+        state['version'] = 1
+        time.sleep(0.05)
+        assert scheduler._thread.is_alive()
+        assert drawn == [0, 1] # the other items are still redrawn
+    finally:
+        scheduler.stop()
@@ -0,0 +1,115 @@
+import threading
+
+import numpy as np
+import pytest
+
+import ScanPath
+import ScanStorage
+from Simulation import simulated_engine
+# Regression tests of the scan modes on the simulated devices: the stored positions, the written
+# flags and the number of points of every mode. The simulated gel has its strongest band at 105 mm
+# inside the lane at 52 mm, where the stage starts.
+
+
+def test_step_scan(engine):
+    count, path = engine.run(mode='step', start=104, stop=106, step=0.5, name='step')
+    scan = ScanStorage.load_scan(path)
+    assert count == scan.metadata['points'] == 5
+    assert (scan['written'] == 1).all()
+    np.testing.assert_allclose(scan['positions'], [104, 104.5, 105, 105.5, 106])
+    assert scan['positions'][np.argmax(scan['intensities'].sum(axis=1))] == 105 # the band
+
+
+def test_frames_per_point(engine):
+    count, single = engine.run(mode='step', start=100, stop=101, step=0.5, name='single') # no band, dark and shot noise only
+    count, averaged = engine.run(mode='step', start=100, stop=101, step=0.5, frames_per_point=9, name='averaged')
+    single, averaged = ScanStorage.load_scan(single), ScanStorage.load_scan(averaged)
+    assert averaged.metadata['frames per point'] == 9 and engine.timer.summary()['phases']['spectrum']['p50'] >= 9 * 5
+    noise = [np.diff(scan['intensities'], axis=1).std() for scan in (single, averaged)]
+    assert noise[1] < noise[0] / 2 # a third with 9 frames
+    assert averaged['intensities'].mean() == pytest.approx(single['intensities'].mean(), rel=0.01) # the mean, not the sum
+
+
+def test_fly_scan(engine):
+    count, path = engine.run(mode='fly', start=103, stop=107, step=0.1, name='fly')
+    scan = ScanStorage.load_scan(path)
+    written = scan['written'] == 1
+    assert count == scan.metadata['points'] == written.sum() > 0
+    assert not written[count:].any() # the spectra are stored in the order they were measured
+    positions = scan['positions'][written]
+    assert np.all(np.diff(positions) >= 0) # one sweep upwards
+    assert positions.min() >= 103 - 1e-6 and positions.max() > 106
+    assert abs(positions[np.argmax(scan['intensities'][written].sum(axis=1))] - 105) < 0.3 # the band
+
+
+def test_raster_scan(engine):
+    lanes = [[(51, 103), (53, 103), (53, 107), (51, 107)]]
+    count, path = engine.run(mode='raster', start=104, stop=106, step=1, x_start=50, x_stop=54, lanes=lanes, name='raster')
+    scan = ScanStorage.load_scan(path)
+    xs, ys = ScanPath.grid_axes((50, 54), (104, 106), 1)
+    points = ScanPath.lane_points(xs, ys, lanes)
+    expected = np.zeros((len(xs), len(ys)), dtype=bool)
+    expected[points[:, 0], points[:, 1]] = True
+    assert count == scan.metadata['points'] == expected.sum()
+    assert ((scan['written'] == 1) == expected).all() # only the points inside the lane
+    np.testing.assert_allclose(scan['positions'][points[:, 0], points[:, 1]], np.column_stack((xs[points[:, 0]], ys[points[:, 1]])))
+    np.testing.assert_allclose(scan['x'][:, 0], xs)
+    np.testing.assert_allclose(scan['y'][0], ys)
+
+
+def test_adaptive_scan(engine):
+    count, path = engine.run(mode='adaptive', start=102, stop=108, step=1, min_step=0.25, name='adaptive')
+    scan = ScanStorage.load_scan(path)
+    written = scan['written'] == 1
+    assert count == scan.metadata['points'] == written.sum()
+    positions = np.sort(scan['positions'][written])
+    assert np.isin(np.arange(102, 109), positions).all() # the coarse pass
+    assert np.all(np.diff(positions) >= 0.25 - 1e-9) # never finer than min_step
+    assert count < len(np.arange(102, 108.25, 0.25)) # fewer points than a fine step scan
+    refined = scan['positions'][written][scan['level'][written] > 0]
+    assert len(refined) and np.all(np.abs(refined - 105) < 2) # only at the band, not on the empty gel around it
+
+def test_multichannel_scan(tmp_path):
+    engine = simulated_engine(5e3, velocity=20, acceleration=500, settle_time=0.005, channels=2, directory=str(tmp_path))
+    engine.connect()
+    try:
+        count, path = engine.run(mode='step', start=104, stop=106, step=0.5, name='channels')
+    finally:
+        for S in engine.spectrometers:
+            S.stop_acquisition()
+        engine.stage.stop_polling()
+    scan = ScanStorage.load_scan(path)
+    assert count == 5 and (scan['written'] == 1).all()
+    assert scan['intensities'].shape == (5, len(scan['wavelengths'])) and scan['intensities_1'].shape == (5, 1024)
+    np.testing.assert_allclose(scan['wavelengths_1'][[0, -1]], (450, 900))
+    assert scan['intensities_1'].any(axis=1).all() and (scan['written_1'] == 1).all() # every point has a spectrum of the second channel
+    assert np.all(np.abs(scan['times_1'] - scan['times']) < 0.1) # of the same step
+    assert scan['positions'][np.argmax(scan['intensities_1'].sum(axis=1))] == 105 # the band, seen by both channels
+
+def test_step_wait(engine):
+    engine.run(mode='step', start=104, stop=106, step=0.5, integration_time=5e4)
+    # the acquisition pauses after the frame of each point, so the restart when the stage settles is applied right away
+    # (only the first point waits for the frame that is being read out)
+    wait = engine.timer.summary()['phases']['wait']
+    assert wait['p50'] < 5 and wait['max'] < 55
+
+def test_failed_scan(engine, tmp_path):
+    def fail(intensities, **values):
+        raise RuntimeError('processing failed')
+    threads = threading.active_count()
+    engine.process = fail # the pipeline workers raise
+    with pytest.raises(RuntimeError):
+        engine.run(mode='step', start=104, stop=106, step=0.5, name='failed')
+    del engine.process
+    assert threading.active_count() == threads # the workers are stopped
+    scan = ScanStorage.load_scan(str(tmp_path / 'failed.gscan'))
+    assert scan.metadata['failed'] is True
+    assert [(row['name'], row['status']) for row in engine.catalog.find(status=None)] == [('failed', 'failed')]
+    count, path = engine.run(mode='step', start=104, stop=106, step=0.5, name='next') # the next scan runs normally
+    assert count == 5
+
+def test_adaptive_min_step_above_step(engine):
+    count, path = engine.run(mode='adaptive', start=104, stop=106, step=0.5, min_step=1, name='coarse')
+    scan = ScanStorage.load_scan(path)
+    assert count == scan.metadata['points'] == 5 # the whole coarse pass is stored, nothing is refined
+    np.testing.assert_allclose(np.sort(scan['positions'][scan['written'] == 1]), [104, 104.5, 105, 105.5, 106])
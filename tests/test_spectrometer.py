@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+
+from Simulation import simulatedGCSDevice, simulatedSpectrometer
+from Spectrometer import spectrometer
+# The frame queue of the spectrometer: the device is only called by the acquisition thread, and the frames
+# after a restart are found by sequence number even when the readout is late.
+
+
+class slowReadout(simulatedSpectrometer):
+    """
+    A simulated spectrometer whose frames arrive some time after their integration ended, and which counts the
+    calls that came while a frame was being read out.
+    """
+    def __init__(self, stage, latency, **kwargs):
+        super().__init__(stage, **kwargs)
+        self.latency = latency
+        self.busy = False
+        self.overlaps = 0
+        self.starts = [] # the true start of each returned frame
+
+    def integration_time_micros(self, int_T):
+        if self.busy:
+            self.overlaps += 1
+        super().integration_time_micros(int_T)
+
+    def spectrum(self):
+        self.busy = True
+        try:
+            spectrum = super().spectrum()
+            self.starts.append(self._last - self._integration_time)
+            time.sleep(self.latency)
+        finally:
+            self.busy = False
+        return spectrum
+
+
+def test_restart_with_readout_latency():
+    device = slowReadout(simulatedGCSDevice(), latency=0.02, seed=1)
+    spec = spectrometer(3e4, device=device)
+    spec.connect()
+    spec.start_acquisition()
+    try:
+        spec.wait_for_frame(timeout=1)
+        for delay in np.linspace(0, 0.05, 6):
+            time.sleep(delay)
+            restarted = time.time()
+            frame = spec.wait_for_frame(timeout=1, seq=spec.restart())
+            assert device.starts[frame['seq'] - 1] >= restarted # the frame started after the restart, not only by its computed start
+        assert spec.average(3)[0].shape == spec.wavelengths.shape
+    finally:
+        spec.stop_acquisition()
+    assert device.overlaps == 0 # the device was never called during a readout
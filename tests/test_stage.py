@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from LinearStage import linearStage
+from Simulation import simulatedGCSDevice
+# Moves of the linear stage on the simulated controller: a move with wait=True returns only once the
+# axes are on target, whether the position poller runs or not.
+
+
+@pytest.fixture
+def stage():
+    stage = linearStage(device=simulatedGCSDevice(velocity=20, acceleration=500, settle_time=0.02))
+    stage.connect_and_start()
+    yield stage
+    stage.stop_polling()
+
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_move_waits_on_target(stage, polling):
+    if polling:
+        stage.start_polling(rate=50)
+    device = stage.pidevice
+    for target in (110, 104, 104.5):
+        stage.move(target, '2', wait=True)
+        assert device.qONT('2')['2'] # moved and settled when move() returns
+        assert device.qPOS('2')['2'] == pytest.approx(target)
+        assert stage.current_position['2'] == target
+    stage.move_xy(60, 120, wait=True)
+    assert all(device.qONT(['1', '2']).values())
+    assert stage.current_position == {'1': 60, '2': 120}
+
+
+def test_position_cache(stage):
+    stage.start_polling(rate=50)
+    stage.move(112, '2') # returns right away
+    assert not stage.pidevice.qONT('2')['2']
+    time.sleep(1)
+    stage.stop_polling()
+    cache = stage.position_cache
+    assert time.time() - cache['time'] < 0.1 # polled in the background
+    assert cache['position']['2'] == pytest.approx(112) and cache['on_target'] == {'1': True, '2': True}
+    assert stage.current_position == cache['position']
+
+
+def test_wait_reads_the_cache(stage):
+    stage.start_polling(rate=50)
+    device, callers = stage.pidevice, []
+    for query in ('qPOS', 'qONT', 'IsMoving'):
+        def counted(axes=None, query=getattr(device, query)):
+            callers.append(threading.current_thread())
+            return query(axes)
+        setattr(device, query, counted)
+    stage.move(106, '2', wait=True)
+    assert callers and threading.current_thread() not in callers # only the poller queries the controller
+    assert stage.position_cache['on_target']['2'] and stage.position_cache['position']['2'] == pytest.approx(106)
+
+
+def test_poll_before_the_move_is_not_used(stage):
+    device = stage.pidevice
+    send = device.MOV
+    def slow_move(axes, values): # the command takes a while to reach the controller
+        time.sleep(0.05)
+        send(axes, values)
+    device.MOV = slow_move
+    stage.start_polling(rate=200) # polls start (and find the stage on target) while the command is on its way
+    for target in (110, 104):
+        stage.move(target, '2', wait=True)
+        assert device.qONT('2')['2'] and device.qPOS('2')['2'] == pytest.approx(target)
+
+
+def test_failing_poller(stage, capsys):
+    device = stage.pidevice
+    query, failing = device.qPOS, threading.Event()
+    def flaky(axes=None):
+        if failing.is_set():
+            raise RuntimeError('controller busy')
+        return query(axes)
+    device.qPOS = flaky
+    stage.start_polling(rate=50)
+    failing.set()
+    stage.move(110, '2', wait=True) # waits on the controller itself
+    assert device.qONT('2')['2'] and query('2')['2'] == pytest.approx(110)
+    assert capsys.readouterr().out.count('Polling the linear stage failed') == 1 # reported once
+    assert stage._poller.is_alive()
+    failing.clear()
+    stage.move(104, '2', wait=True) # on the position cache again
+    assert stage.position_cache['position']['2'] == pytest.approx(104) and stage._poll_error is None
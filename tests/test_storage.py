@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import ScanStorage
+# Round trip of the memory-mapped scan files.
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'scan.gscan')
+    wavelengths = np.linspace(400, 900, 16)
+    storage = ScanStorage.create_scan(path, 4, wavelengths, metadata={'mode': 'step', 'step': 0.5}, fields={'level': 'uint8'})
+    storage.write(1, intensities=np.arange(16.0), positions=100.5, times=12.0, level=2)
+    storage.write(3, intensities=np.ones(16), positions=101.5, times=13.0)
+    storage.close(points=2)
+
+    scan = ScanStorage.load_scan(path)
+    assert scan.metadata == {'mode': 'step', 'step': 0.5, 'points': 2}
+    np.testing.assert_allclose(scan['wavelengths'], wavelengths)
+    np.testing.assert_array_equal(scan['written'], [0, 1, 0, 1])
+    np.testing.assert_allclose(scan['intensities'][1], np.arange(16.0))
+    assert scan['positions'][1] == 100.5 and scan['times'][1] == 12.0 and scan['level'][1] == 2
+    np.testing.assert_allclose(scan['positions'][[1, 3]], [100.5, 101.5])
+    assert not scan['intensities'][0].any() # not written, still zeros
+
+def test_channels(tmp_path):
+    path = str(tmp_path / 'scan.gscan')
+    storage = ScanStorage.create_scan(path, 4, np.linspace(400, 900, 16), channels=[np.linspace(450, 900, 8)])
+    storage.write(1, intensities=np.arange(16.0), positions=100.5, times=12.0)
+    storage.write(3, 1, **{'intensities_1': np.ones(8), 'times_1': 13.0})
+    storage.close(points=2)
+
+    scan = ScanStorage.load_scan(path)
+    np.testing.assert_allclose(scan['wavelengths_1'], np.linspace(450, 900, 8))
+    assert scan['intensities_1'].shape == (4, 8) and scan['times_1'][3] == 13.0
+    np.testing.assert_allclose(scan['intensities_1'][3], np.ones(8))
+    np.testing.assert_allclose(scan['intensities'][1], np.arange(16.0))
+    assert 'intensities_2' not in scan
+    np.testing.assert_array_equal(scan['written'], [0, 1, 0, 0]) # each channel marks its own points
+    np.testing.assert_array_equal(scan['written_1'], [0, 0, 0, 1])
+
+def test_raster_shape(tmp_path):
+    path = str(tmp_path / 'raster.gscan')
+    storage = ScanStorage.create_scan(path, (3, 2), np.arange(5.0), position_size=2)
+    storage.write((2, 1), intensities=np.full(5, 7.0), positions=(52, 104))
+    storage.close()
+    scan = ScanStorage.load_scan(path)
+    assert scan['intensities'].shape == (3, 2, 5) and scan['positions'].shape == (3, 2, 2)
+    np.testing.assert_allclose(scan['positions'][2, 1], (52, 104))
+    assert scan['written'].sum() == 1
+
+
+def test_not_a_scan_file(tmp_path):
+    path = tmp_path / 'other.gscan'
+    path.write_bytes(b'not a scan file')
+    with pytest.raises(ValueError):
+        ScanStorage.load_scan(str(path))